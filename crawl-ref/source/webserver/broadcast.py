@@ -0,0 +1,112 @@
+import logging
+import time
+import zlib
+
+from tornado.escape import utf8
+from tornado.ioloop import IOLoop
+
+try:
+    from typing import Any, List, Set
+except ImportError:
+    pass
+
+
+def new_compressobj():  # type: () -> Any
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                            zlib.DEFLATED,
+                            -zlib.MAX_WBITS)
+
+
+def compress_frame(compressobj, binmsg):  # type: (Any, bytes) -> bytes
+    # Compress like in deflate-frame extension:
+    # Apply deflate, flush, then remove the 00 00 FF FF
+    # at the end
+    compressed = compressobj.compress(binmsg)
+    compressed += compressobj.flush(zlib.Z_SYNC_FLUSH)
+    return compressed[:-4]
+
+
+class BroadcastStream(object):
+    """A single deflate stream shared by all receivers of a game.
+
+    Game output is compressed once and the same frame is written to every
+    receiver. Clients keep one inflate context per connection, so sockets
+    that take part in the stream must not interleave their own compressed
+    frames with it; they send their private messages uncompressed instead
+    (see CrawlWebSocket.flush_messages).
+
+    New receivers are only let in at a resync point: the next frame is
+    compressed by a fresh compressor, which doesn't refer back to anything
+    sent earlier, so existing and new receivers can both decode it.
+
+    With a coalesce_window (in seconds), messages sent within the window go
+    out as a single frame.
+    """
+    def __init__(self, logger=None, coalesce_window=0):
+        self.logger = logger or logging.getLogger()
+        self.coalesce_window = coalesce_window
+        self.flush_timeout = None
+        self.receivers = set()  # type: Set[Any]
+        self.pending = set()  # type: Set[Any]
+        self.message_queue = []  # type: List[str]
+        self._compressobj = new_compressobj()
+        self.frames_sent = 0
+        self.resyncs = 0
+
+    def add(self, socket):  # type: (Any) -> None
+        if socket in self.receivers:
+            return
+        self.pending.add(socket)
+
+    def remove(self, socket):  # type: (Any) -> None
+        self.pending.discard(socket)
+        if socket in self.receivers:
+            self.receivers.remove(socket)
+            socket.leave_broadcast()
+
+    def close(self):  # type: () -> None
+        self.flush()
+        for socket in list(self.receivers):
+            self.remove(socket)
+        self.pending = set()
+
+    def append_message(self, msg, send=True):  # type: (str, bool) -> None
+        self.message_queue.append(msg)
+        if send:
+            if not self.coalesce_window:
+                self.flush()
+            elif self.flush_timeout is None:
+                self.flush_timeout = IOLoop.current().add_timeout(
+                                        time.time() + self.coalesce_window,
+                                        self.flush)
+
+    def _resync(self):  # type: () -> None
+        self._compressobj = new_compressobj()
+        self.resyncs += 1
+        for socket in self.pending:
+            socket.join_broadcast(self)
+        self.receivers |= self.pending
+        self.pending = set()
+
+    def flush(self):  # type: () -> None
+        if self.flush_timeout is not None:
+            IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        if len(self.message_queue) == 0:
+            return
+        msg = ("{\"msgs\":[" +
+               ",".join(self.message_queue) +
+               "]}")
+        message_count = len(self.message_queue)
+        self.message_queue = []
+
+        if self.pending:
+            self._resync()
+        if not self.receivers:
+            return
+
+        binmsg = utf8(msg)
+        compressed = compress_frame(self._compressobj, binmsg)
+        self.frames_sent += 1
+        for socket in list(self.receivers):
+            socket.write_broadcast_frame(binmsg, compressed, message_count)
@@ -0,0 +1,95 @@
+import json
+import zlib
+
+import broadcast
+
+
+class FakeSocket(object):
+    """Decodes frames the way client.js does: one inflater per connection."""
+
+    def __init__(self, deflate=True):
+        self.deflate = deflate
+        self.broadcast = None
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.received = []
+        self.left = 0
+
+    def join_broadcast(self, stream):
+        self.broadcast = stream
+
+    def leave_broadcast(self):
+        self.broadcast = None
+        self.left += 1
+
+    def receive_private(self, compressobj, msg):
+        compressed = broadcast.compress_frame(compressobj, msg.encode())
+        self._inflate(compressed)
+
+    def write_broadcast_frame(self, binmsg, compressed, message_count):
+        if self.deflate:
+            self._inflate(compressed)
+        else:
+            self.received += json.loads(binmsg.decode())["msgs"]
+
+    def _inflate(self, compressed):
+        data = self.inflater.decompress(compressed + b"\x00\x00\xff\xff")
+        self.received += json.loads(data.decode())["msgs"]
+
+
+class TestBroadcastStream:
+
+    def test_frames_are_compressed_once_for_all_receivers(self):
+        stream = broadcast.BroadcastStream()
+        sockets = [FakeSocket() for _ in range(3)]
+        for s in sockets:
+            stream.add(s)
+
+        stream.append_message('{"msg":"map"}')
+
+        assert stream.frames_sent == 1
+        for s in sockets:
+            assert s.broadcast is stream
+            assert s.received == [{"msg": "map"}]
+
+    def test_late_joiner_decodes_from_resync_point(self):
+        stream = broadcast.BroadcastStream()
+        early = FakeSocket()
+        stream.add(early)
+        for i in range(5):
+            stream.append_message('{"msg":"map","n":%d}' % i)
+
+        late = FakeSocket()
+        # The late joiner's inflater already holds unrelated history
+        late.receive_private(broadcast.new_compressobj(),
+                             '{"msgs":[{"msg":"lobby_entry"}]}')
+        stream.add(late)
+        for i in range(5):
+            stream.append_message('{"msg":"map","n":%d}' % i)
+
+        assert len(early.received) == 10
+        assert late.received[1:] == [{"msg": "map", "n": i} for i in range(5)]
+
+    def test_queued_messages_go_out_together_on_flush(self):
+        stream = broadcast.BroadcastStream()
+        s = FakeSocket(deflate=False)
+        stream.add(s)
+
+        stream.append_message('{"msg":"a"}', False)
+        stream.append_message('{"msg":"b"}', False)
+        assert s.received == []
+
+        stream.flush()
+        assert s.received == [{"msg": "a"}, {"msg": "b"}]
+        assert stream.frames_sent == 1
+
+    def test_close_releases_receivers(self):
+        stream = broadcast.BroadcastStream()
+        s = FakeSocket()
+        stream.add(s)
+        stream.append_message('{"msg":"a"}')
+
+        stream.close()
+
+        assert s.broadcast is None
+        assert s.left == 1
+        assert not stream.receivers
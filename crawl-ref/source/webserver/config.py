@@ -61,6 +61,9 @@ watch_socket_dirs = False
 # Game configs
 # %n in paths and urls is replaced by the current username
 # morgue_url is for a publicly available URL to access morgue_path
+# ttyrec_compression = "gz" or "xz" compresses ttyrecs while they are being
+# recorded, adding .gz or .xz to their names; xz compresses better, but uses
+# about 10MB more memory per running game
 games = OrderedDict([
     ("dcss-web-trunk", dict(
         name = "DCSS trunk",
@@ -73,6 +76,7 @@ games = OrderedDict([
         socket_path = "./rcs",
         client_path = "./webserver/game_data/",
         morgue_url = None,
+        ttyrec_compression = None,
         send_json_options = True)),
     ("seeded-web-trunk", dict(
         name = "DCSS trunk, custom seed",
@@ -122,6 +126,11 @@ milestone_file = "./milestones"
 
 status_file_update_rate = 5
 
+# Lobby changes (where info, idle state, spectator counts, milestones) are
+# batched and sent to lobby clients at most this often, in seconds. Set to 0
+# to send every change immediately.
+lobby_update_rate = 1
+
 recording_term_size = (80, 24)
 
 max_connections = 100
@@ -149,6 +158,38 @@ max_idle_time = 5 * 60 * 60
 
 use_gzip = True
 
+# Compress each game's output once and send the same frames to the player and
+# all spectators, instead of deflating it separately for every connection.
+# Saves a lot of CPU on games with many spectators, at the cost of sending
+# chat and other per-connection messages uncompressed while watching.
+broadcast_compression = False
+
+# Collect outgoing websocket messages for this many seconds (e.g. 0.005 to
+# 0.02) and send them as one frame, instead of one frame per message. Crawl's
+# own flush_messages requests are still sent immediately. 0 disables this.
+output_coalesce_window = 0
+
+# Outbound backpressure: once more than this many bytes are waiting to be
+# written to a spectator's connection, it is treated as a slow consumer.
+# With slow_consumer_policy "drop", game output to it is skipped until the
+# backlog has halved, and then it is caught up on the game view; with "disconnect"
+# the connection is closed. Players are never throttled. Set the limit to
+# None to disable.
+max_outbound_backlog = 4 * 1024 * 1024
+slow_consumer_policy = "drop"
+
+# New spectators are brought up to date by replaying the view crawl drew since
+# its last full redraw, which is kept for each game, so that crawl doesn't have
+# to redraw for everyone watching. If that exceeds this many bytes, crawl is
+# asked to redraw instead. 0 disables the cache.
+view_state_cache_size = 1024 * 1024
+
+# Spectators joining or leaving a game within this many seconds of each other
+# cause a single update of the spectator list. Crawl is asked to redraw for
+# the first one, and once more at the end of the window if others joined
+# after that redraw. 0 sends everything immediately.
+spectator_join_window = 0.5
+
 # Seconds until stale HTTP connections are closed
 # This needs a patch currently not in mainline tornado.
 http_connection_timeout = None
@@ -164,6 +205,13 @@ http_xheaders = None
 
 kill_timeout = 10 # Seconds until crawl is killed after HUP is sent
 
+# Serve live server statistics for Prometheus at /metrics. Only requests
+# from metrics_allowed_ips are answered (None allows everyone). If you are
+# behind a reverse proxy, enable http_xheaders as well, or every request will
+# appear to come from the proxy.
+metrics_enabled = False
+metrics_allowed_ips = ("127.0.0.1", "::1")
+
 nick_regex = r"^[a-zA-Z0-9]{3,20}$"
 max_passwd_length = 20
 
@@ -204,6 +252,51 @@ crypt_salt_length = 16
 
 login_token_lifetime = 7 # Days
 
+# Number of worker processes used for password hashing and user database
+# access during login, registration, password reset and email changes, so
+# these don't stall running games. 0 runs them in the server process.
+# The pool runs a management thread in the server, so only use it together
+# with spawn_helper; otherwise games are forked from a threaded process.
+userdb_workers = 0
+
+# Start games through a small helper process that is started with the server
+# and only creates ptys and runs crawl, instead of forking the whole webserver
+# for every game. Requires Python 3. The server waits for the helper for at
+# most spawn_helper_timeout seconds; if it doesn't answer in time, games are
+# started directly from then on.
+spawn_helper = False
+spawn_helper_timeout = 0.25
+
+# Input that a game's pty doesn't take right away is queued, up to this many
+# bytes; input beyond that is dropped until crawl reads its input again.
+pty_input_queue_size = 16 * 1024
+
+# Ttyrec frames are collected in memory and written once this many bytes have
+# piled up, or ttyrec_flush_interval seconds after the first unwritten frame,
+# or when the game ends. Frames keep the time they were received at. With
+# ttyrec_writer_thread, the writes are done on a separate thread, so that a
+# slow disk doesn't stall all games.
+ttyrec_buffer_size = 64 * 1024
+ttyrec_flush_interval = 1
+ttyrec_writer_thread = False
+# Compressed ttyrecs are made decompressible up to the current point at least
+# this often (in seconds), so that they can be watched while the game runs.
+# Each sync costs a little compression.
+ttyrec_sync_interval = 10
+# Write a seek index (the ttyrec's name plus .idx) next to uncompressed
+# ttyrecs, so that replays can jump to any point without reading the
+# recording from the start.
+ttyrec_index = False
+
+# Serve recorded games at /replay/<game id>/<username>/<ttyrec name>, over a
+# websocket, with adjustable speed and seeking. Idle stretches longer than
+# replay_max_delay seconds are shortened to that (None plays them in full).
+replay_enabled = False
+replay_max_delay = 5
+# Recordings are opened (and indexed, if they have no index) on this many
+# threads.
+replay_threads = 2
+
 uid = None  # If this is not None, the server will setuid to that (numeric) id
 gid = None  # after binding its sockets.
 
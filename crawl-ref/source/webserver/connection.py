@@ -1,4 +1,5 @@
 import socket
+import errno
 import fcntl
 import os, os.path, tempfile
 import time
@@ -10,6 +11,16 @@ from tornado.ioloop import IOLoop
 
 from config import server_socket_path
 
+# Like the pty, the socket is read until it would block, but at most this
+# many bytes or seconds at a time
+READ_BUDGET = 1024 * 1024
+READ_TIME_BUDGET = 0.005
+
+try:
+    from typing import List
+except ImportError:
+    pass
+
 class WebtilesSocketConnection(object):
     def __init__(self, socketpath, logger):
         self.crawl_socketpath = socketpath
@@ -20,7 +31,9 @@ class WebtilesSocketConnection(object):
         self.open = False
         self.close_callback = None
 
-        self.msg_buffer = None
+        # Fragments of an incomplete message; joined once it is complete,
+        # so that a message split over many reads is assembled in linear time
+        self.msg_buffer = [] # type: List[bytes]
 
     def connect(self, primary = True):
         if not os.path.exists(self.crawl_socketpath):
@@ -74,25 +87,45 @@ class WebtilesSocketConnection(object):
 
     def _handle_read(self, fd, events):
         if events & IOLoop.READ:
-            data = self.socket.recv(128 * 1024, socket.MSG_DONTWAIT)
-
-            self._handle_data(data)
+            datagrams = []
+            size = 0
+            deadline = time.time() + READ_TIME_BUDGET
+            while size < READ_BUDGET:
+                try:
+                    data = self.socket.recv(128 * 1024, socket.MSG_DONTWAIT)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                datagrams.append(data)
+                size += len(data)
+                if time.time() >= deadline:
+                    break
+
+            for data in datagrams:
+                if self.socket is None:
+                    # Closed by a message handler
+                    break
+                self._handle_data(data)
 
         if events & IOLoop.ERROR:
             pass
 
     def _handle_data(self, data): # type: (bytes) -> None
-        if self.msg_buffer is not None:
-            data = self.msg_buffer + data
+        if not data:
+            return
 
         # TODO: is this check safe? Decoding won't always work for
         # fragmented messages...
         if data[-1] != b'\n'[0]:
             # All messages from crawl end with \n.
             # If this one doesn't, it's fragmented.
-            self.msg_buffer = data
+            self.msg_buffer.append(data)
         else:
-            self.msg_buffer = None
+            if self.msg_buffer:
+                self.msg_buffer.append(data)
+                data = b"".join(self.msg_buffer)
+                self.msg_buffer = []
 
             if self.message_callback:
                 self.message_callback(to_unicode(data))
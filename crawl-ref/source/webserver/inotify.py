@@ -8,7 +8,7 @@ from tornado.ioloop import IOLoop
 import tornado.platform.posix
 
 try:
-    from typing import Any, Callable, Dict
+    from typing import Any, Callable, Dict, List, Tuple
 except ImportError:
     pass
 
@@ -74,8 +74,12 @@ class _CtypesLibcINotifyWrapper():
         return self._libc.inotify_rm_watch(fd, wd)
 
 class DirectoryWatcher(object):
+    CLOSE_WRITE = 0x8 # IN_CLOSE_WRITE
+    MOVED_TO = 0x80 # IN_MOVED_TO
     CREATE = 0x100 # IN_CREATE
     DELETE = 0x200 # IN_DELETE
+    IGNORED = 0x8000 # IN_IGNORED
+    MASK_ADD = 0x20000000 # IN_MASK_ADD
 
     def __init__(self):  # type: () -> None
         self.inotify = _CtypesLibcINotifyWrapper()
@@ -86,17 +90,45 @@ class DirectoryWatcher(object):
             tornado.platform.posix.set_close_exec(self.fd)
             IOLoop.current().add_handler(self.fd, self._handle_read,
                                          IOLoop.ERROR | IOLoop.READ)
-        self.handlers = dict() # type: Dict[int, Callable[[str, int], Any]]
+        # Several handlers can watch the same directory, each for its own
+        # events; the kernel watch gets the union of their masks
+        self.handlers = dict() # type: Dict[int, List[Tuple[Callable[[str, int], Any], int]]]
         self.paths = dict()  # type: Dict[int, str]
+        self.watches = dict()  # type: Dict[str, int]
         self.buffer = bytes()
 
-    def watch(self, path, handler):  # type: (str, Callable[[str, int], Any]) -> None
-        if self.enabled:
-            w = self.inotify._inotify_add_watch(self.fd, path.encode('utf-8'),
-                                                DirectoryWatcher.CREATE |
-                                                DirectoryWatcher.DELETE)
-            self.handlers[w] = handler
-            self.paths[w] = path
+    def watch(self, path, handler, mask=CREATE | DELETE):
+        # type: (str, Callable[[str, int], Any], int) -> bool
+        """Calls handler(path, mask) for the events in mask that happen in
+        the directory. Returns False if the directory can't be watched."""
+        if not self.enabled:
+            return False
+        w = self.inotify._inotify_add_watch(self.fd, path.encode('utf-8'),
+                                            mask | DirectoryWatcher.MASK_ADD)
+        if w < 0:
+            return False
+        self.handlers.setdefault(w, []).append((handler, mask))
+        self.paths[w] = path
+        self.watches[path] = w
+        return True
+
+    def unwatch(self, path, handler):
+        # type: (str, Callable[[str, int], Any]) -> None
+        w = self.watches.get(path)
+        if w is None:
+            return
+        handlers = [(h, m) for h, m in self.handlers[w] if h != handler]
+        if handlers:
+            self.handlers[w] = handlers
+            return
+        self._forget(w)
+        self.inotify._inotify_rm_watch(self.fd, w)
+
+    def _forget(self, w):  # type: (int) -> None
+        self.handlers.pop(w, None)
+        path = self.paths.pop(w, None)
+        if self.watches.get(path) == w:
+            del self.watches[path]
 
     def _handle_read(self, fd, event):
         if event & IOLoop.ERROR:
@@ -114,7 +146,16 @@ class DirectoryWatcher(object):
                 (name,) = struct.unpack_from("%ds" % l, data, i)
                 name = name.rstrip(b"\x00").decode('utf-8')
                 i += l
-                self.handlers[w](os.path.join(self.paths[w], name), mask)
+                if mask & DirectoryWatcher.IGNORED:
+                    # The watch is gone, e.g. because the directory was deleted
+                    self._forget(w)
+                    continue
+                if w not in self.paths:
+                    continue
+                path = os.path.join(self.paths[w], name)
+                for handler, handler_mask in list(self.handlers[w]):
+                    if mask & handler_mask:
+                        handler(path, mask)
         except OSError as e:
             if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return
@@ -0,0 +1,62 @@
+import os
+
+from tornado.ioloop import IOLoop
+
+from inotify import DirectoryWatcher
+
+
+class TestDirectoryWatcher:
+
+    def setup_method(self):
+        self.watcher = DirectoryWatcher()
+        self.events = []
+
+    def teardown_method(self):
+        if self.watcher.enabled:
+            IOLoop.current().remove_handler(self.watcher.fd)
+            os.close(self.watcher.fd)
+
+    def handler(self, path, mask):
+        self.events.append((os.path.basename(path), mask))
+
+    def other_handler(self, path, mask):
+        self.events.append(("other", mask))
+
+    def write(self, path):
+        with open(path, "w") as f:
+            f.write("x")
+        self.watcher._handle_read(self.watcher.fd, IOLoop.READ)
+
+    def test_handlers_only_get_their_events(self, tmpdir):
+        if not self.watcher.enabled:
+            return
+        path = str(tmpdir)
+        assert self.watcher.watch(path, self.handler,
+                                  DirectoryWatcher.CLOSE_WRITE)
+        assert self.watcher.watch(path, self.other_handler)
+
+        self.write(os.path.join(path, "a.where"))
+
+        assert self.events == [("other", DirectoryWatcher.CREATE),
+                               ("a.where", DirectoryWatcher.CLOSE_WRITE)]
+
+    def test_unwatch_keeps_other_handlers(self, tmpdir):
+        if not self.watcher.enabled:
+            return
+        path = str(tmpdir)
+        self.watcher.watch(path, self.handler, DirectoryWatcher.CLOSE_WRITE)
+        self.watcher.watch(path, self.other_handler,
+                           DirectoryWatcher.CLOSE_WRITE)
+
+        self.watcher.unwatch(path, self.other_handler)
+        self.write(os.path.join(path, "a.where"))
+        assert self.events == [("a.where", DirectoryWatcher.CLOSE_WRITE)]
+
+        self.watcher.unwatch(path, self.handler)
+        assert path not in self.watcher.watches
+
+    def test_missing_directory_cant_be_watched(self, tmpdir):
+        if not self.watcher.enabled:
+            return
+        missing = os.path.join(str(tmpdir), "missing")
+        assert not self.watcher.watch(missing, self.handler)
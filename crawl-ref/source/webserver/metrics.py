@@ -0,0 +1,279 @@
+import collections
+
+import tornado.web
+
+import config
+
+try:
+    from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+except ImportError:
+    pass
+
+registry = []  # type: List[_Metric]
+
+
+def _format_labels(names, values):
+    # type: (Sequence[str], Sequence[Any]) -> str
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):  # type: (float) -> str
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(object):
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        # type: (str, str, Sequence[str]) -> None
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+
+    def samples(self):  # type: () -> List[Tuple[str, Tuple[Any, ...], float]]
+        raise NotImplementedError()
+
+    def render(self):  # type: () -> str
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.type_name)]
+        for suffix, labelvalues, value in self.samples():
+            names = self.labelnames
+            if suffix == "_bucket":
+                names = names + ("le",)
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                                        _format_labels(names, labelvalues),
+                                        _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        # type: (str, str, Sequence[str]) -> None
+        super(Counter, self).__init__(name, documentation, labelnames)
+        self.values = {}  # type: Dict[Tuple[Any, ...], float]
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def inc(self, amount=1, labels=()):
+        # type: (float, Tuple[Any, ...]) -> None
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [("", k, v) for k, v in sorted(self.values.items())]
+
+
+class Gauge(_Metric):
+    """A gauge that is computed when the metrics are scraped.
+
+    The function returns either a number, or a dict mapping label value
+    tuples to numbers."""
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        # type: (str, str, Callable[[], Any], Sequence[str]) -> None
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.func = func
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return [("", k, v) for k, v in sorted(value.items())]
+        return [("", (), value)]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, buckets):
+        # type: (str, str, Sequence[float]) -> None
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = list(buckets) + [float("inf")]
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):  # type: (float) -> None
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self):
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            result.append(("_bucket", (_format_value(bound),), cumulative))
+        result.append(("_sum", (), self.sum))
+        result.append(("_count", (), self.count))
+        return result
+
+
+class LatencySamples(object):
+    """Keeps the most recent samples of a latency to report percentiles."""
+
+    def __init__(self, histogram=None, size=1000):
+        # type: (Optional[Histogram], int) -> None
+        self.samples = collections.deque(maxlen=size)  # type: Deque[float]
+        self.count = 0
+        self.histogram = histogram
+
+    def add(self, value):  # type: (float) -> None
+        self.samples.append(value)
+        self.count += 1
+        if self.histogram:
+            self.histogram.observe(value)
+
+    def percentile(self, p):  # type: (float) -> Optional[float]
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(p / 100.0 * len(ordered)))
+        return ordered[index]
+
+    def summary(self):  # type: () -> str
+        if not self.samples:
+            return "no samples"
+        return "p50 %.0fms, p90 %.0fms, p99 %.0fms, max %.0fms (%d samples)" % (
+            self.percentile(50) * 1000, self.percentile(90) * 1000,
+            self.percentile(99) * 1000, max(self.samples) * 1000, self.count)
+
+
+def render():  # type: () -> str
+    return "\n".join(m.render() for m in registry) + "\n"
+
+
+def _connections_by_state():
+    from ws_handler import sockets_by_state
+    return dict(((state,), len(s)) for state, s in sockets_by_state.items())
+
+
+def _games_by_state():
+    from process_handler import processes
+    result = {("active",): 0, ("idle",): 0}
+    for process in list(processes.values()):
+        state = "idle" if process.is_idle() else "active"
+        result[(state,)] += 1
+    return result
+
+
+def _queued_messages():
+    from ws_handler import sockets
+    return sum(len(s.message_queue) for s in list(sockets))
+
+
+def _outbound_backlog():
+    from ws_handler import sockets
+    return sum(s.outbound_backlog() for s in list(sockets))
+
+
+def _slow_consumers():
+    from ws_handler import sockets
+    return len([s for s in list(sockets) if s.dropping_game_output])
+
+
+def _timers():
+    from timers import timer_wheel
+    return dict(((kind,), n) for kind, n in timer_wheel.active.items())
+
+
+def _timer_lag():
+    from timers import timer_wheel
+    return timer_wheel.lag
+
+
+Gauge("webtiles_connections", "Open websocket connections by state.",
+      _connections_by_state, ("state",))
+Gauge("webtiles_games", "Running games by state.",
+      _games_by_state, ("state",))
+Gauge("webtiles_queued_messages",
+      "Messages waiting to be flushed to websockets.", _queued_messages)
+Gauge("webtiles_outbound_backlog_bytes",
+      "Bytes written to websockets that haven't reached the network yet.",
+      _outbound_backlog)
+Gauge("webtiles_slow_consumers",
+      "Spectators whose game output is paused because they fell behind.",
+      _slow_consumers)
+Gauge("webtiles_timers", "Pending timers on the shared timer wheel, by kind.",
+      _timers, ("kind",))
+Gauge("webtiles_timer_lag_seconds",
+      "How late the most recently fired timer ran.", _timer_lag)
+
+messages_received = Counter("webtiles_messages_received_total",
+                            "Messages received from websocket clients.")
+bytes_received = Counter("webtiles_bytes_received_total",
+                         "Bytes received from websocket clients.")
+messages_sent = Counter("webtiles_messages_sent_total",
+                        "Messages sent to websocket clients.")
+frames_sent = Counter("webtiles_frames_sent_total",
+                      "Websocket frames sent, by encoding.", ("encoding",))
+payload_bytes_sent = Counter("webtiles_payload_bytes_sent_total",
+                             "Uncompressed size of everything sent to "
+                             "websocket clients.")
+bytes_sent = Counter("webtiles_bytes_sent_total",
+                     "Bytes written to websocket clients, by encoding.",
+                     ("encoding",))
+frame_size = Histogram("webtiles_frame_bytes",
+                       "Uncompressed size of websocket frames.",
+                       (256, 1024, 4096, 16384, 65536, 262144, 1048576))
+process_spawns = Counter("webtiles_crawl_spawns_total",
+                         "Crawl processes started.")
+process_exits = Counter("webtiles_crawl_exits_total",
+                        "Crawl processes that ended, by exit reason.",
+                        ("reason",))
+lobby_flushes = Counter("webtiles_lobby_flushes_total",
+                        "Batched lobby updates sent out.")
+lobby_messages = Counter("webtiles_lobby_messages_total",
+                         "Lobby entries and removals sent to lobby clients.")
+input_dropped = Counter("webtiles_input_dropped_total",
+                        "Input messages dropped because crawl wasn't "
+                        "reading its input.")
+view_state_joins = Counter("webtiles_view_state_joins_total",
+                           "Spectators brought up to date, by whether the "
+                           "cached view state was used or crawl redrew.",
+                           ("source",))
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# Server-wide input latencies; every game also keeps its own samples
+input_latency = LatencySamples(Histogram(
+    "webtiles_input_latency_seconds",
+    "Time from a player's input to the next game frame written to their "
+    "websocket.", latency_buckets))
+crawl_response_latency = LatencySamples(Histogram(
+    "webtiles_crawl_response_seconds",
+    "Time from a player's input to the next output received from crawl.",
+    latency_buckets))
+
+
+def count_frame(messages, payload, sent, compressed):
+    # type: (int, int, int, bool) -> None
+    encoding = "deflate" if compressed else "raw"
+    messages_sent.inc(messages)
+    frames_sent.inc(1, (encoding,))
+    payload_bytes_sent.inc(payload)
+    bytes_sent.inc(sent, (encoding,))
+    frame_size.observe(payload)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        allowed = getattr(config, "metrics_allowed_ips", ("127.0.0.1", "::1"))
+        if allowed is not None and self.request.remote_ip not in allowed:
+            raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(render())
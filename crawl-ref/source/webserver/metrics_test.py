@@ -0,0 +1,68 @@
+import metrics
+
+
+class TestRender:
+
+    def setup_method(self):
+        self.saved_registry = list(metrics.registry)
+        del metrics.registry[:]
+
+    def teardown_method(self):
+        metrics.registry[:] = self.saved_registry
+
+    def test_counter_with_labels(self):
+        c = metrics.Counter("test_total", "Test counter.", ("kind",))
+        c.inc(2, ("a",))
+        c.inc(1, ("a",))
+        c.inc(5, ("b",))
+
+        lines = metrics.render().splitlines()
+
+        assert lines == [
+            "# HELP test_total Test counter.",
+            "# TYPE test_total counter",
+            'test_total{kind="a"} 3',
+            'test_total{kind="b"} 5',
+        ]
+
+    def test_gauge_is_computed_on_render(self):
+        values = [1]
+        metrics.Gauge("test_gauge", "Test gauge.", lambda: values[0])
+        values[0] = 7
+
+        assert "test_gauge 7" in metrics.render().splitlines()
+
+    def test_histogram_buckets_are_cumulative(self):
+        h = metrics.Histogram("test_seconds", "Test histogram.", (1, 10))
+        for value in (0.5, 2, 3, 100):
+            h.observe(value)
+
+        lines = metrics.render().splitlines()
+
+        assert 'test_seconds_bucket{le="1"} 1' in lines
+        assert 'test_seconds_bucket{le="10"} 3' in lines
+        assert 'test_seconds_bucket{le="+Inf"} 4' in lines
+        assert "test_seconds_sum 105.5" in lines
+        assert "test_seconds_count 4" in lines
+
+    def test_label_values_are_escaped(self):
+        c = metrics.Counter("test_total", "Test counter.", ("reason",))
+        c.inc(1, ('say "hi"',))
+
+        assert 'test_total{reason="say \\"hi\\""} 1' in metrics.render()
+
+
+class TestLatencySamples:
+
+    def test_percentiles_use_recent_samples(self):
+        samples = metrics.LatencySamples(size=100)
+        for i in range(200):
+            samples.add(i / 1000.0)
+
+        assert samples.count == 200
+        assert samples.percentile(0) == 0.1
+        assert samples.percentile(50) == 0.15
+        assert samples.percentile(100) == 0.199
+
+    def test_summary_without_samples(self):
+        assert metrics.LatencySamples().summary() == "no samples"
@@ -1,4 +1,5 @@
 import os, os.path, errno, fcntl
+import collections
 import subprocess
 import datetime, time
 import hashlib
@@ -6,27 +7,87 @@ import logging
 import re
 
 import config
+import metrics
+import reaper
 
 from tornado.escape import json_decode, json_encode, xhtml_escape, utf8, to_unicode
-from tornado.ioloop import PeriodicCallback, IOLoop
 
 from terminal import TerminalRecorder
 from connection import WebtilesSocketConnection
-from util import DynamicTemplateLoader, dgl_format_str, parse_where_data
+from util import DynamicTemplateLoader, Throttle, dgl_format_str, parse_where_data
 from game_data_handler import GameDataHandler
-from ws_handler import update_all_lobbys, remove_in_lobbys, CrawlWebSocket
+from broadcast import BroadcastStream, new_compressobj, compress_frame
+from view_state import REDRAW_START, ViewStateCache
+from ws_handler import update_all_lobbys, remove_in_lobbys, broadcast_message, CrawlWebSocket
 from inotify import DirectoryWatcher
+from timers import timer_wheel
 
 try:
-    from typing import Dict, Set, Tuple, Any
+    from typing import Dict, List, Set, Tuple, Any, Optional
 except:
     pass
 
 last_game_id = 0
 
+# Inputs that got no answer for this long (seconds) aren't waited for any
+# more, so that output that comes much later isn't taken for the answer
+max_input_latency = 10
+
 processes = dict() # type: Dict[str,CrawlProcessHandler]
+# Case-insensitive indexes over `processes`, by username and by character
+# (the name and start fields of the where info)
+processes_by_user = dict() # type: Dict[str, List[CrawlProcessHandler]]
+processes_by_char = dict() # type: Dict[Tuple[str, str], CrawlProcessHandler]
 unowned_process_logger = logging.LoggerAdapter(logging.getLogger(), {})
 
+class ClientPayload(object):
+    """A rendered game_client message, encoded and compressed once."""
+    def __init__(self, version, template_mtime, content):
+        self.version = version
+        self.template_mtime = template_mtime
+        self.checked_time = time.time()
+        msg = json_encode({"msg": "game_client",
+                           "version": version,
+                           "content": content})
+        self.binmsg = utf8("{\"msgs\":[" + msg + "]}")
+        self.compressed = compress_frame(new_compressobj(), self.binmsg)
+
+# Rendered game clients by (client path, crawl version)
+client_payloads = dict() # type: Dict[Tuple[str, Optional[str]], ClientPayload]
+# How often a cached game client checks whether game.html changed (seconds)
+client_template_check_interval = 1
+
+def add_process(path, process):
+    processes[path] = process
+    processes_by_user.setdefault(process.username.lower(), []).append(process)
+    reindex_process_char(process)
+
+def remove_process(path):
+    process = processes.pop(path)
+    user_key = process.username.lower()
+    user_processes = processes_by_user[user_key]
+    user_processes.remove(process)
+    if not user_processes:
+        del processes_by_user[user_key]
+    reindex_process_char(process)
+
+def find_user_processes(username):
+    # type: (str) -> List[CrawlProcessHandler]
+    return list(processes_by_user.get(username.lower(), ()))
+
+def reindex_process_char(process):
+    if (process.char_key is not None and
+        processes_by_char.get(process.char_key) is process):
+        del processes_by_char[process.char_key]
+    process.char_key = None
+
+    if process not in processes_by_user.get(process.username.lower(), ()):
+        return
+    name = process.where.get("name")
+    if name:
+        process.char_key = (name.lower(), process.where.get("start"))
+        processes_by_char[process.char_key] = process
+
 def find_game_info(socket_dir, socket_file):
     game_id = socket_file[socket_file.index(":")+1:-5]
     if (game_id in config.games and
@@ -57,7 +118,7 @@ def handle_new_socket(path, event):
         # Create process handler
         process = CrawlProcessHandler(game_info, username,
                                       unowned_process_logger)
-        processes[abspath] = process
+        add_process(abspath, process)
         process.connect(abspath)
         process.logger.info("Found a %s game.", game_info["id"])
 
@@ -71,7 +132,22 @@ def handle_new_socket(path, event):
         process.handle_process_end()
         process.logger.info("Game ended.")
         remove_in_lobbys(process)
-        del processes[abspath]
+        remove_process(abspath)
+
+# Watches the morgue directories of running games for where file changes
+where_watcher = None # type: Optional[DirectoryWatcher]
+
+def get_where_watcher(): # type: () -> DirectoryWatcher
+    global where_watcher
+    if where_watcher is None:
+        where_watcher = DirectoryWatcher()
+    return where_watcher
+
+def check_idle_games():
+    # Run for all games in one sweep, so that games turning idle show up in
+    # the same lobby update
+    for process in list(processes.values()):
+        process.check_idle()
 
 def watch_socket_dirs():
     watcher = DirectoryWatcher()
@@ -106,7 +182,9 @@ class CrawlProcessHandlerBase(object):
         self.client_path = self.config_path("client_path")
         self.crawl_version = None
         self.where = {}
+        self.char_key = None # type: Optional[Tuple[str, str]]
         self.wheretime = 0
+        self.where_dir = None # type: Optional[str]
         self.last_milestone = None
         self.kill_timeout = None
 
@@ -118,12 +196,41 @@ class CrawlProcessHandlerBase(object):
 
         self.end_callback = None
         self._receivers = set()
+        self._paused_watchers = set()
+
+        # The spectator list is kept up to date as receivers come and go;
+        # _roster holds what each receiver contributed to the counts below
+        self._roster = {} # type: Dict[Any, Tuple[Optional[str], Optional[str], bool, bool]]
+        self._roster_players = collections.Counter() # type: Dict[str, int]
+        self._roster_watchers = collections.Counter() # type: Dict[str, int]
+        self._watcher_count = 0
+        self._anon_count = 0
+        self._description = None # type: Optional[str]
+        if getattr(config, "broadcast_compression", False):
+            self.broadcast = BroadcastStream(
+                self.logger, getattr(config, "output_coalesce_window", 0))
+        else:
+            self.broadcast = None
         self.last_activity_time = time.time()
-        self.idle_checker = PeriodicCallback(self.check_idle, 10000)
-        self.idle_checker.start()
         self._was_idle = False
         self.last_watcher_join = 0
 
+        # Spectators joining or leaving within this window cause a single
+        # spectator list update. The first join asks crawl to redraw right
+        # away; only those that join after the redraw started cause a second
+        # request at the end of the window.
+        join_window = getattr(config, "spectator_join_window", 0.5)
+        self._description_throttle = Throttle(self.update_watcher_description,
+                                              join_window)
+        self._redraw_throttle = Throttle(self._send_redraw_request, join_window)
+
+        # Input latency: time of the oldest input that hasn't been answered
+        # by crawl / by a frame to the player yet
+        self._input_time = None
+        self._awaiting_response = False
+        self.input_latency = metrics.LatencySamples()
+        self.response_latency = metrics.LatencySamples()
+
         global last_game_id
         self.id = last_game_id + 1
         last_game_id = self.id
@@ -153,14 +260,23 @@ class CrawlProcessHandlerBase(object):
     def flush_messages_to_all(self):
         for receiver in self._receivers:
             receiver.flush_messages()
+        if self.broadcast:
+            self.broadcast.flush()
 
     def write_to_all(self, msg, send): # type: (str, bool) -> None
+        if self.broadcast:
+            # Paused watchers aren't on the stream, so give them a chance to
+            # catch up here
+            for receiver in list(self._paused_watchers):
+                receiver.accepts_game_output()
+            self.broadcast.append_message(msg, send)
+            return
         for receiver in self._receivers:
-            receiver.append_message(msg, send)
+            if receiver.accepts_game_output():
+                receiver.append_message(msg, send, True)
 
     def send_to_all(self, msg, **data): # type: (str, Any) -> None
-        for receiver in self._receivers:
-            receiver.send_message(msg, **data)
+        broadcast_message(self._receivers, msg, **data)
 
     def chat_help_message(self, source, command, desc):
         if len(command) == 0:
@@ -257,11 +373,20 @@ class CrawlProcessHandlerBase(object):
         self.handle_notification_raw(username, xhtml_escape(text))
 
     def handle_process_end(self):
-        if self.kill_timeout:
-            IOLoop.current().remove_timeout(self.kill_timeout)
-            self.kill_timeout = None
+        timer_wheel.cancel(self.kill_timeout)
+        self.kill_timeout = None
 
-        self.idle_checker.stop()
+        self._description_throttle.stop()
+        self.unwatch_where()
+        self._redraw_throttle.cancel()
+
+        if self.broadcast:
+            self.broadcast.close()
+
+        if self.input_latency.count:
+            self.logger.info("Input latency: %s; crawl response: %s",
+                             self.input_latency.summary(),
+                             self.response_latency.summary())
 
         for watcher in list(self._receivers):
             if watcher.watched_game == self:
@@ -301,7 +426,7 @@ class CrawlProcessHandlerBase(object):
         if param == "forever":
             receiver.send_message("super_hide_chat")
             receiver.chat_hidden = True # currently only for super hidden chat
-            self.update_watcher_description()
+            self.update_watcher(receiver)
         else:
             receiver.send_message("toggle_chat")
 
@@ -311,6 +436,7 @@ class CrawlProcessHandlerBase(object):
         if len(l) == 0:
             return
         self.muted = {u for u in l if u != source}
+        self._description = None
         self.handle_notification(source, "Restoring mute list.")
         self.show_mute_list(source)
         self.logger.info("Player '%s' restoring mutelist %s" %
@@ -341,7 +467,7 @@ class CrawlProcessHandlerBase(object):
                             "Spectator '%s' has now been muted." % target)
         self.muted |= {target}
         self.save_mutelist(source)
-        self.update_watcher_description()
+        self.schedule_watcher_description()
         return True
 
     def unmute(self, source, target):
@@ -361,7 +487,7 @@ class CrawlProcessHandlerBase(object):
             self.handle_notification(source, "You have cleared your mute list.")
             self.muted = set()
             self.save_mutelist(source)
-            self.update_watcher_description()
+            self.schedule_watcher_description()
             return True
 
         if not target in self.muted:
@@ -372,7 +498,7 @@ class CrawlProcessHandlerBase(object):
         self.handle_notification(source, "You have unmuted '%s'." % target)
         self.muted -= {target}
         self.save_mutelist(source)
-        self.update_watcher_description()
+        self.schedule_watcher_description()
         return True
 
     def show_mute_list(self, source):
@@ -387,10 +513,56 @@ class CrawlProcessHandlerBase(object):
                                                             ", ".join(names))
         return True
 
-    def get_anon(self):
-        return [w for w in self._receivers if not w.username]
+    def _roster_entry(self, watcher):
+        # type: (Any) -> Tuple[Optional[str], Optional[str], bool, bool]
+        chatting = watcher.username and not watcher.chat_hidden
+        if chatting and not watcher.watched_game:
+            return (watcher.username, None, False, False)
+        return (None,
+                watcher.username if chatting else None,
+                bool(watcher.watched_game) and not watcher.chat_hidden,
+                not watcher.username)
+
+    def _update_roster(self, entry, delta):
+        # type: (Tuple[Optional[str], Optional[str], bool, bool], int) -> None
+        player_name, watcher_name, counted, anon = entry
+        for names, name in ((self._roster_players, player_name),
+                            (self._roster_watchers, watcher_name)):
+            if name is None:
+                continue
+            names[name] += delta
+            if names[name] <= 0:
+                del names[name]
+        if counted:
+            self._watcher_count += delta
+        if anon:
+            self._anon_count += delta
+        self._description = None
+
+    def _add_to_roster(self, watcher):
+        entry = self._roster_entry(watcher)
+        self._roster[watcher] = entry
+        self._update_roster(entry, 1)
+
+    def _remove_from_roster(self, watcher):
+        entry = self._roster.pop(watcher, None)
+        if entry is not None:
+            self._update_roster(entry, -1)
+
+    def update_watcher(self, watcher):
+        """Call when a receiver's name or chat visibility changed."""
+        if watcher not in self._roster:
+            return
+        self._remove_from_roster(watcher)
+        self._add_to_roster(watcher)
+        self._description_throttle()
+
+    def schedule_watcher_description(self):
+        """Sends out the spectator list, at most once per join window."""
+        self._description = None
+        self._description_throttle()
 
-    def update_watcher_description(self):
+    def _describe_watchers(self): # type: () -> str
         try:
             player_url_template = config.player_url
         except:
@@ -409,22 +581,27 @@ class CrawlProcessHandlerBase(object):
             username = "<a href='{0}' target='_blank' class='{1}'>{2}</a>".format(player_url, class_type, n)
             return username
 
-        player_name, watchers = self.get_watchers(True)
-
         watcher_names = []
-        if player_name is not None:
+        for player_name in self._roster_players:
             watcher_names.append(wrap_name(player_name, True))
-        watcher_names += [wrap_name(w) for w in watchers]
+            break
+        for name in sorted(self._roster_watchers, key=lambda s:s.lower()):
+            watcher_names += [wrap_name(name)] * self._roster_watchers[name]
 
-        anon_count = len(self.get_anon())
+        anon_count = self._anon_count
         s = ", ".join(watcher_names)
         if len(watcher_names) > 0 and anon_count > 0:
             s = s + " and %i Anon" % anon_count
         elif anon_count > 0:
             s = "%i Anon" % anon_count
+        return s
+
+    def update_watcher_description(self):
+        if self._description is None:
+            self._description = self._describe_watchers()
         self.send_to_all("update_spectators",
-                         count = self.watcher_count(),
-                         names = s)
+                         count = self._watcher_count,
+                         names = self._description)
 
         if config.dgl_mode:
             update_all_lobbys(self)
@@ -436,14 +613,44 @@ class CrawlProcessHandlerBase(object):
             if watcher.watched_game == self:
                 watcher.send_json_options(self.game_params["id"], self.username)
         self._receivers.add(watcher)
-        self.update_watcher_description()
+        self._add_to_roster(watcher)
+        if self.broadcast:
+            self.broadcast.add(watcher)
+        self._description_throttle()
 
     def remove_watcher(self, watcher):
         self._receivers.remove(watcher)
-        self.update_watcher_description()
+        self._remove_from_roster(watcher)
+        self._paused_watchers.discard(watcher)
+        if self.broadcast:
+            self.broadcast.remove(watcher)
+        self._description_throttle()
+
+    def pause_watcher(self, watcher):
+        """Stops game output to a watcher that can't keep up."""
+        self._paused_watchers.add(watcher)
+        if self.broadcast:
+            self.broadcast.remove(watcher)
+
+    def resync_watcher(self, watcher):
+        """Resumes game output to a paused watcher."""
+        self._paused_watchers.discard(watcher)
+        self.send_view_state(watcher)
+        if self.broadcast:
+            self.broadcast.add(watcher)
+
+    def send_view_state(self, watcher):
+        """Brings a (re)joining watcher up to date with the game's view."""
+        self.request_redraw()
+
+    def request_redraw(self):
+        self._redraw_throttle()
+
+    def _send_redraw_request(self):
+        pass
 
     def watcher_count(self):
-        return len([w for w in self._receivers if w.watched_game and not w.chat_hidden])
+        return self._watcher_count
 
     def send_client_to_all(self):
         for receiver in self._receivers:
@@ -453,6 +660,26 @@ class CrawlProcessHandlerBase(object):
                                            self.username)
 
     def _send_client(self, watcher):
+        payload = self._client_payload()
+        watcher.write_precompressed(payload.binmsg, payload.compressed, 1)
+
+    def _client_payload(self): # type: () -> ClientPayload
+        key = (os.path.abspath(self.client_path), self.crawl_version)
+        payload = client_payloads.get(key)
+        now = time.time()
+        if (payload is not None and
+            now - payload.checked_time < client_template_check_interval):
+            return payload
+
+        templ_path = os.path.join(self.client_path, "templates")
+        try:
+            mtime = os.path.getmtime(os.path.join(templ_path, "game.html"))
+        except OSError:
+            mtime = None
+        if payload is not None and payload.template_mtime == mtime:
+            payload.checked_time = now
+            return payload
+
         h = hashlib.sha1(utf8(os.path.abspath(self.client_path)))
         if self.crawl_version:
             h.update(utf8(self.crawl_version))
@@ -460,17 +687,18 @@ class CrawlProcessHandlerBase(object):
         GameDataHandler.add_version(v,
                                     os.path.join(self.client_path, "static"))
 
-        templ_path = os.path.join(self.client_path, "templates")
         loader = DynamicTemplateLoader.get(templ_path)
         templ = loader.load("game.html")
         game_html = to_unicode(templ.generate(version = v))
-        watcher.send_message("game_client", version = v, content = game_html)
+        payload = ClientPayload(v, mtime, game_html)
+        client_payloads[key] = payload
+        return payload
 
     def stop(self):
         if self.process:
             self.process.send_signal(subprocess.signal.SIGHUP)
-            t = time.time() + config.kill_timeout
-            self.kill_timeout = IOLoop.current().add_timeout(t, self.kill)
+            self.kill_timeout = timer_wheel.call_later(config.kill_timeout,
+                                                       self.kill, "kill")
 
     def kill(self):
         if self.process:
@@ -485,6 +713,7 @@ class CrawlProcessHandlerBase(object):
             if self.where.get(key) != newwhere.get(key):
                 interesting = True
         self.where = newwhere
+        reindex_process_char(self)
         if interesting:
             update_all_lobbys(self)
 
@@ -493,24 +722,58 @@ class CrawlProcessHandlerBase(object):
         wherefile = os.path.join(morgue_path, self.username + ".where")
         try:
             if os.path.getmtime(wherefile) > self.wheretime:
-                self.wheretime = time.time()
-                with open(wherefile, "r") as f:
-                    wheredata = f.read()
+                self.read_where(wherefile)
+        except (OSError, IOError):
+            pass
 
-                if wheredata.strip() == "": return
+    def read_where(self, wherefile): # type: (str) -> None
+        self.wheretime = time.time()
+        with open(wherefile, "r") as f:
+            wheredata = f.read()
 
-                try:
-                    newwhere = parse_where_data(wheredata)
-                except:
-                    self.logger.warning("Exception while trying to parse where file!",
-                                        exc_info=True)
-                else:
-                    if (newwhere.get("status") == "active" or
-                        newwhere.get("status") == "saved"):
-                        self.set_where_info(newwhere)
+        if wheredata.strip() == "": return
+
+        try:
+            newwhere = parse_where_data(wheredata)
+        except:
+            self.logger.warning("Exception while trying to parse where file!",
+                                exc_info=True)
+        else:
+            if (newwhere.get("status") == "active" or
+                newwhere.get("status") == "saved"):
+                self.set_where_info(newwhere)
+
+    def watch_where(self):
+        """Re-reads the where file when crawl rewrites it. Without inotify,
+        it is checked for changes on every message from crawl instead."""
+        morgue_path = self.config_path("morgue_path")
+        if morgue_path is None or self.where_dir is not None:
+            return
+        path = os.path.abspath(morgue_path)
+        if get_where_watcher().watch(path, self._on_morgue_event,
+                                     DirectoryWatcher.CLOSE_WRITE |
+                                     DirectoryWatcher.MOVED_TO):
+            self.where_dir = path
+        self.check_where()
+
+    def unwatch_where(self):
+        if self.where_dir is None:
+            return
+        get_where_watcher().unwatch(self.where_dir, self._on_morgue_event)
+        self.where_dir = None
+
+    def _on_morgue_event(self, path, mask): # type: (str, int) -> None
+        if os.path.basename(path) != self.username + ".where":
+            return
+        try:
+            self.read_where(path)
         except (OSError, IOError):
             pass
 
+    def poll_where(self):
+        if self.where_dir is None:
+            self.check_where()
+
     def lobby_entry(self):
         entry = {
             "id": self.id,
@@ -535,6 +798,7 @@ class CrawlProcessHandlerBase(object):
     def log_milestone(self, milestone):
         # Use the updated where info in the milestone
         self.where = milestone
+        reindex_process_char(self)
 
         self.last_milestone = milestone
         update_all_lobbys(self)
@@ -567,6 +831,38 @@ class CrawlProcessHandlerBase(object):
     def handle_input(self, msg):
         raise NotImplementedError()
 
+    def _input_expired(self, now):  # type: (float) -> bool
+        """Forgets the pending input if it has waited too long, e.g. because
+        it didn't cause any output."""
+        if (self._input_time is not None and
+                now - self._input_time > max_input_latency):
+            self._input_time = None
+            self._awaiting_response = False
+        return self._input_time is None
+
+    def note_input(self):
+        now = time.time()
+        if self._input_expired(now):
+            self._input_time = now
+            self._awaiting_response = True
+
+    def note_crawl_output(self):
+        now = time.time()
+        if not self._input_expired(now) and self._awaiting_response:
+            self._awaiting_response = False
+            latency = now - self._input_time
+            self.response_latency.add(latency)
+            metrics.crawl_response_latency.add(latency)
+
+    def note_frame_sent(self):
+        now = time.time()
+        if self._input_expired(now) or self._awaiting_response:
+            return
+        latency = now - self._input_time
+        self._input_time = None
+        self.input_latency.add(latency)
+        metrics.input_latency.add(latency)
+
 class CrawlProcessHandler(CrawlProcessHandlerBase):
     def __init__(self, game_params, username, logger):
         super(CrawlProcessHandler, self).__init__(game_params, username, logger)
@@ -584,6 +880,11 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
         self._stale_lockfile = None
         self._purging_timer = None
         self._process_hup_timeout = None
+        # Input messages dropped since crawl stopped reading its input
+        self._input_dropped = 0
+
+        self.view_state = ViewStateCache(
+            getattr(config, "view_state_cache_size", 1024 * 1024))
 
     def start(self):
         self._purge_locks_and_start(True)
@@ -607,9 +908,8 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
                     hup_wait = 10
                     self.send_to_all("stale_processes",
                                      timeout=hup_wait, game=self.game_params["name"])
-                    to = IOLoop.current().add_timeout(time.time() + hup_wait,
-                                                      self._kill_stale_process)
-                    self._process_hup_timeout = to
+                    self._process_hup_timeout = timer_wheel.call_later(
+                        hup_wait, self._kill_stale_process, "kill")
                 else:
                     self._kill_stale_process()
             except Exception:
@@ -626,8 +926,11 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
             self._start_process()
 
     def _stop_purging_stale_processes(self):
-        if not self._process_hup_timeout: return
-        IOLoop.current().remove_timeout(self._process_hup_timeout)
+        if not self._process_hup_timeout and not self._purging_timer: return
+        timer_wheel.cancel(self._process_hup_timeout)
+        timer_wheel.cancel(self._purging_timer)
+        if self._stale_pid is not None:
+            reaper.unwatch_exit(self._stale_pid)
         self._stale_pid = None
         self._stale_lockfile = None
         self._purging_timer = None
@@ -671,23 +974,26 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
             if signal == subprocess.signal.SIGTERM:
                 self._purge_stale_lock()
             else:
-                if signal == subprocess.signal.SIGHUP:
-                    self._purging_timer = 10
-                else:
-                    self._purging_timer -= 1
-
-                if self._purging_timer > 0:
-                    IOLoop.current().add_timeout(time.time() + 1,
-                                                 self._check_stale_process)
-                else:
-                    self.logger.warning("Couldn't terminate pid %s gracefully.",
-                                        self._stale_pid)
-                    self.send_to_all("force_terminate?")
+                # Give it 10 seconds to save and exit
+                self._purging_timer = timer_wheel.call_later(
+                    10, self._stale_process_timeout, "kill")
+                reaper.watch_exit(self._stale_pid,
+                                  self._on_stale_process_exit)
                 return
         self.send_to_all("hide_dialog")
 
-    def _check_stale_process(self):
-        self._kill_stale_process(0)
+    def _on_stale_process_exit(self):
+        timer_wheel.cancel(self._purging_timer)
+        self._purging_timer = None
+        self._purge_stale_lock()
+        self.send_to_all("hide_dialog")
+
+    def _stale_process_timeout(self):
+        self._purging_timer = None
+        reaper.unwatch_exit(self._stale_pid)
+        self.logger.warning("Couldn't terminate pid %s gracefully.",
+                            self._stale_pid)
+        self.send_to_all("force_terminate?")
 
     def _do_force_terminate(self, answer):
         if answer:
@@ -720,8 +1026,10 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
         ttyrec_path = self.config_path("ttyrec_path")
         if ttyrec_path:
             self.ttyrec_filename = os.path.join(ttyrec_path, self.lock_basename)
+            if game.get("ttyrec_compression"):
+                self.ttyrec_filename += "." + game["ttyrec_compression"]
 
-        processes[os.path.abspath(self.socketpath)] = self
+        add_process(os.path.abspath(self.socketpath), self)
 
         if config.dgl_mode:
             self.logger.info("Starting %s.", game["id"])
@@ -732,7 +1040,9 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
             self.process = TerminalRecorder(call, self.ttyrec_filename,
                                             self._ttyrec_id_header(),
                                             self.logger,
-                                            config.recording_term_size)
+                                            config.recording_term_size,
+                                            game.get("ttyrec_compression"))
+            metrics.process_spawns.inc()
             self.process.end_callback = self._on_process_end
             self.process.output_callback = self._on_process_output
             self.process.activity_callback = self.note_activity
@@ -747,8 +1057,6 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
                              self.process.errpipe_read)
 
             self.last_activity_time = time.time()
-
-            self.check_where()
         except Exception:
             self.logger.warning("Error while starting the Crawl process!", exc_info=True)
             if self.process:
@@ -762,6 +1070,7 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
         self.conn.message_callback = self._on_socket_message
         self.conn.close_callback = self._on_socket_close
         self.conn.connect(primary)
+        self.watch_where()
 
     def gen_inprogress_lock(self):
         self.inprogress_lock = os.path.join(self.config_path("inprogress_path"),
@@ -798,11 +1107,12 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
 
     def _on_process_end(self):
         self.logger.info("Crawl terminated.")
+        metrics.process_exits.inc(1, (self.exit_reason or "unknown",))
 
         self.remove_inprogress_lock()
 
         try:
-            del processes[os.path.abspath(self.socketpath)]
+            remove_process(os.path.abspath(self.socketpath))
         except KeyError:
             self.logger.warning("Process entry already deleted: %s", self.socketpath)
 
@@ -824,14 +1134,35 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
 
 
     def add_watcher(self, watcher):
+        # Output that is still queued is part of the cached view state, so
+        # it must go out before the watcher is added as a receiver
+        self.flush_messages_to_all()
         super(CrawlProcessHandler, self).add_watcher(watcher)
+        self.send_view_state(watcher)
 
+    def send_view_state(self, watcher):
+        snapshot = self.view_state.snapshot()
+        if snapshot is None:
+            metrics.view_state_joins.inc(1, ("redraw",))
+            self.request_redraw()
+            return
+        metrics.view_state_joins.inc(1, ("cache",))
+        self.flush_messages_to_all()
+        for msg in snapshot:
+            watcher.append_message(msg, False)
+        watcher.flush_messages()
+
+    def _send_redraw_request(self):
+        # Makes crawl resend its complete state to all receivers
         if self.conn and self.conn.open:
             self.conn.send_message('{"msg":"spectator_joined"}')
 
     def handle_input(self, msg): # type: (str) -> None
         obj = json_decode(msg)
 
+        if obj["msg"] in ("input", "key"):
+            self.note_input()
+
         if obj["msg"] == "input" and self.process:
             self.last_action_time = time.time()
 
@@ -841,7 +1172,24 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
 
             data += obj.get("text", "")
 
-            self.process.write_input(utf8(data))
+            if not self.process.write_input(utf8(data)):
+                # Crawl isn't reading its input; don't let a flood of keys
+                # pile up. Logged and told to the player once per episode,
+                # the rest is counted.
+                metrics.input_dropped.inc()
+                if self._input_dropped == 0:
+                    self.logger.warning("Input queue full, dropping input.")
+                    self.handle_notification(self.username,
+                        "The game isn't responding; your input is being "
+                        "ignored until it catches up.")
+                self._input_dropped += 1
+            elif self._input_dropped:
+                self.logger.info("Input queue drained; %d input messages "
+                                 "were dropped.", self._input_dropped)
+                self.handle_notification(self.username,
+                    "The game is responding again; %d of your inputs were "
+                    "ignored." % self._input_dropped)
+                self._input_dropped = 0
 
         elif obj["msg"] == "force_terminate":
             self._do_force_terminate(obj["answer"])
@@ -869,7 +1217,8 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
                         }))
 
     def _on_process_output(self, line): # type: (str) -> None
-        self.check_where()
+        self.note_crawl_output()
+        self.poll_where()
 
         try:
             json_decode(line)
@@ -880,7 +1229,7 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
         # send messages from wrapper scripts only to the player
         for receiver in self._receivers:
             if not receiver.watched_game:
-                receiver.append_message(line, True)
+                receiver.append_message(line, True, True)
 
     def _on_process_error(self, line): # type: (str) -> None
         if line.startswith("ERROR"):
@@ -944,7 +1293,8 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
                 self.logger.warning("Unknown message from the crawl process: %s",
                                     msgobj["msg"])
         else:
-            self.check_where()
+            self.note_crawl_output()
+            self.poll_where()
             if time.time() > self.last_watcher_join + 2:
                 # Treat socket messages as activity, since it's otherwise
                 # hard to determine activity for games found via
@@ -954,6 +1304,10 @@ class CrawlProcessHandler(CrawlProcessHandlerBase):
                 self.note_activity()
 
             self.write_to_all(msg, not self.queue_messages)
+            if msg.startswith(REDRAW_START):
+                # Everyone that asked for a redraw is a receiver by now
+                self._redraw_throttle.satisfied()
+            self.view_state.add(msg)
 
 
 
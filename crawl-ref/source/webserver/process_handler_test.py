@@ -0,0 +1,224 @@
+import logging
+
+import pytest
+
+import process_handler
+
+
+class FakeWatcher(object):
+    def __init__(self, username, watched_game=None):
+        self.username = username
+        self.watched_game = watched_game
+        self.chat_hidden = False
+        self.messages = []
+
+    def send_message(self, msg, **data):
+        self.messages.append((msg, data))
+
+
+class TestSpectatorRoster:
+
+    def setup_method(self):
+        self.game = process_handler.CrawlProcessHandlerBase(
+            {"id": "test"}, "player", logging.getLogger())
+        self.game._description_throttle.window = 0
+        self.sent = []
+        self.game.send_to_all = lambda msg, **data: self.sent.append(data)
+
+    def test_counts_follow_joins_and_leaves(self):
+        player = FakeWatcher("player")
+        self.game.add_watcher(player)
+        watchers = [FakeWatcher(name, self.game)
+                    for name in ("bob", "Alice", None, "bob")]
+        for w in watchers:
+            self.game.add_watcher(w)
+
+        assert self.sent[-1]["count"] == 4
+        assert self.sent[-1]["names"] == (
+            "<span class='player'>player</span>, "
+            "<span class='watcher'>Alice</span>, "
+            "<span class='watcher'>bob</span>, "
+            "<span class='watcher'>bob</span> and 1 Anon")
+
+        self.game.remove_watcher(watchers[0])
+        self.game.remove_watcher(watchers[2])
+
+        assert self.sent[-1]["count"] == 2
+        assert self.sent[-1]["names"] == (
+            "<span class='player'>player</span>, "
+            "<span class='watcher'>Alice</span>, "
+            "<span class='watcher'>bob</span>")
+
+    def test_hidden_chat_removes_name_and_count(self):
+        w = FakeWatcher("bob", self.game)
+        self.game.add_watcher(w)
+
+        self.game.hide_chat(w, "forever")
+
+        assert self.game.watcher_count() == 0
+        assert self.sent[-1]["names"] == ""
+
+
+class FakeProcess(object):
+    def __init__(self):
+        self.accepting = True
+        self.written = []
+
+    def write_input(self, data):
+        if self.accepting:
+            self.written.append(data)
+        return self.accepting
+
+
+class TestInput:
+
+    def setup_method(self):
+        self.game = process_handler.CrawlProcessHandler(
+            {"id": "test"}, "player", logging.getLogger())
+        self.game.process = FakeProcess()
+
+    def test_dropped_input_is_logged_once(self, caplog):
+        self.game.process.accepting = False
+        with caplog.at_level(logging.INFO):
+            for i in range(100):
+                self.game.handle_input('{"msg": "input", "text": "x"}')
+            self.game.process.accepting = True
+            self.game.handle_input('{"msg": "input", "text": "y"}')
+
+        messages = [r.getMessage() for r in caplog.records]
+        assert len(messages) == 2
+        assert messages[0].endswith("Input queue full, dropping input.")
+        assert messages[1].endswith("100 input messages were dropped.")
+        assert self.game.process.written == [b"y"]
+
+    def test_player_is_told_about_dropped_input(self):
+        player = FakeWatcher("player")
+        self.game._receivers.add(player)
+        self.game.process.accepting = False
+        for i in range(3):
+            self.game.handle_input('{"msg": "input", "text": "x"}')
+        assert len(player.messages) == 1
+        assert "ignored until it catches up" in player.messages[0][1]["content"]
+
+        self.game.process.accepting = True
+        self.game.handle_input('{"msg": "input", "text": "y"}')
+        self.game.handle_input('{"msg": "input", "text": "z"}')
+        assert len(player.messages) == 2
+        assert "3 of your inputs were ignored" in player.messages[1][1]["content"]
+
+
+class TestInputLatency:
+
+    def setup_method(self):
+        self.game = process_handler.CrawlProcessHandlerBase(
+            {"id": "test"}, "player", logging.getLogger())
+
+    def at(self, t, monkeypatch):
+        monkeypatch.setattr(process_handler.time, "time", lambda: t)
+
+    def test_latency_is_measured_to_the_frame(self, monkeypatch):
+        self.at(1000.0, monkeypatch)
+        self.game.note_input()
+        self.at(1000.1, monkeypatch)
+        self.game.note_crawl_output()
+        self.at(1000.25, monkeypatch)
+        self.game.note_frame_sent()
+
+        assert [round(s, 3) for s in self.game.response_latency.samples] \
+            == [0.1]
+        assert [round(s, 3) for s in self.game.input_latency.samples] \
+            == [0.25]
+
+    def test_unanswered_input_is_forgotten(self, monkeypatch):
+        self.at(1000.0, monkeypatch)
+        self.game.note_input()
+        # Output that comes minutes later isn't the answer
+        self.at(1300.0, monkeypatch)
+        self.game.note_crawl_output()
+        self.game.note_frame_sent()
+        assert self.game.input_latency.count == 0
+        assert self.game.response_latency.count == 0
+
+        self.game.note_input()
+        self.at(1300.5, monkeypatch)
+        self.game.note_crawl_output()
+        self.game.note_frame_sent()
+        assert list(self.game.input_latency.samples) == [0.5]
+
+
+class TestProcessIndexes:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        monkeypatch.setattr(process_handler, "processes", {})
+        monkeypatch.setattr(process_handler, "processes_by_user", {})
+        monkeypatch.setattr(process_handler, "processes_by_char", {})
+
+    def make_process(self, username, name=None, start="1"):
+        process = process_handler.CrawlProcessHandlerBase(
+            {"id": "test"}, username, logging.getLogger())
+        if name:
+            process.where = {"name": name, "start": start}
+        return process
+
+    def check_consistent(self):
+        by_user = {}
+        by_char = {}
+        for process in process_handler.processes.values():
+            by_user.setdefault(process.username.lower(), []).append(process)
+            name = process.where.get("name")
+            if name:
+                by_char[(name.lower(), process.where.get("start"))] = process
+        assert ({k: sorted(v, key=id) for k, v in by_user.items()} ==
+                {k: sorted(v, key=id) for k, v
+                 in process_handler.processes_by_user.items()})
+        assert by_char == process_handler.processes_by_char
+
+    def test_add_and_remove(self):
+        bob1 = self.make_process("Bob", "Bobby")
+        bob2 = self.make_process("bob")
+        alice = self.make_process("alice", "Ali", "2")
+        process_handler.add_process("/bob1", bob1)
+        process_handler.add_process("/bob2", bob2)
+        process_handler.add_process("/alice", alice)
+        self.check_consistent()
+        assert process_handler.find_user_processes("BOB") == [bob1, bob2]
+        assert process_handler.processes_by_char[("bobby", "1")] is bob1
+
+        process_handler.remove_process("/bob1")
+        self.check_consistent()
+        assert bob1.char_key is None
+        process_handler.remove_process("/bob2")
+        self.check_consistent()
+        assert "bob" not in process_handler.processes_by_user
+        process_handler.remove_process("/alice")
+        assert process_handler.processes_by_char == {}
+
+    def test_reindex_after_character_change(self):
+        process = self.make_process("bob")
+        process_handler.add_process("/bob", process)
+        assert process_handler.processes_by_char == {}
+
+        process.where = {"name": "Bobby", "start": "1"}
+        process_handler.reindex_process_char(process)
+        self.check_consistent()
+
+        process.where = {"name": "Robert", "start": "5"}
+        process_handler.reindex_process_char(process)
+        self.check_consistent()
+        assert list(process_handler.processes_by_char) == [("robert", "5")]
+
+    def test_removed_process_doesnt_unindex_its_replacement(self):
+        old = self.make_process("bob", "Bobby")
+        process_handler.add_process("/old", old)
+        new = self.make_process("bob", "Bobby")
+        process_handler.add_process("/new", new)
+        assert process_handler.processes_by_char[("bobby", "1")] is new
+
+        process_handler.remove_process("/old")
+        assert process_handler.processes_by_char[("bobby", "1")] is new
+
+        # Processes that aren't registered are never indexed
+        process_handler.reindex_process_char(old)
+        assert old.char_key is None
+        assert process_handler.processes_by_char[("bobby", "1")] is new
@@ -0,0 +1,126 @@
+"""Event-driven waiting for processes to exit.
+
+Uses pidfds where the kernel and Python support them (Linux 5.3, Python
+3.9), and otherwise SIGCHLD for our own children and polling for other
+processes.
+"""
+import errno
+import os
+import signal
+
+import tornado.process
+from tornado.ioloop import IOLoop
+
+from timers import timer_wheel
+
+try:
+    from typing import Any, Callable, Dict, Optional
+except ImportError:
+    pass
+
+_children = {}  # type: Dict[int, Callable[[Optional[int]], Any]]
+_watched = {}  # type: Dict[int, Callable[[], Any]]
+_pidfds = {}  # type: Dict[int, int]
+_sigchld_installed = False
+
+
+def _open_pidfd(pid, callback):  # type: (int, Callable[[], Any]) -> bool
+    if not hasattr(os, "pidfd_open"):
+        return False
+    try:
+        fd = os.pidfd_open(pid)
+    except OSError:
+        return False
+    _pidfds[pid] = fd
+    IOLoop.current().add_handler(fd, lambda fd, events: callback(),
+                                 IOLoop.READ)
+    return True
+
+
+def _close_pidfd(pid):  # type: (int) -> None
+    fd = _pidfds.pop(pid, None)
+    if fd is not None:
+        IOLoop.current().remove_handler(fd)
+        os.close(fd)
+
+
+def watch_child(pid, callback):
+    # type: (int, Callable[[Optional[int]], Any]) -> None
+    """Reaps the child process pid once it exits and calls callback with its
+    waitpid status (None if someone else reaped it)."""
+    _children[pid] = callback
+    if not _open_pidfd(pid, lambda: _reap(pid)):
+        _install_sigchld()
+    # It may have exited before we started watching
+    IOLoop.current().add_callback(_reap, pid)
+
+
+def _reap(pid):  # type: (int) -> None
+    callback = _children.get(pid)
+    if callback is None:
+        return
+    try:
+        reaped, status = os.waitpid(pid, os.WNOHANG)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        reaped, status = pid, None
+    if reaped == 0:
+        return
+    del _children[pid]
+    _close_pidfd(pid)
+    callback(status)
+
+
+def _reap_all():  # type: () -> None
+    for pid in list(_children):
+        _reap(pid)
+
+
+def _install_sigchld():  # type: () -> None
+    global _sigchld_installed
+    if _sigchld_installed:
+        return
+    _sigchld_installed = True
+    # tornado.process.Subprocess sets its own SIGCHLD handler when it's first
+    # used; make it do that now, and call its handler from ours
+    tornado.process.Subprocess.initialize()
+    previous = signal.getsignal(signal.SIGCHLD)
+
+    def handle_sigchld(signum, frame):
+        IOLoop.current().add_callback_from_signal(_reap_all)
+        if callable(previous):
+            previous(signum, frame)
+    signal.signal(signal.SIGCHLD, handle_sigchld)
+
+
+def watch_exit(pid, callback):  # type: (int, Callable[[], Any]) -> None
+    """Calls callback once the process pid is gone. For processes that
+    aren't our children, e.g. crawl processes left over from an earlier
+    webserver."""
+    def gone():
+        if _watched.pop(pid, None) is None:
+            return
+        _close_pidfd(pid)
+        callback()
+    _watched[pid] = gone
+    if not _open_pidfd(pid, gone):
+        _poll_exit(pid)
+
+
+def _poll_exit(pid):  # type: (int) -> None
+    gone = _watched.get(pid)
+    if gone is None:
+        return
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            gone()
+            return
+    timer_wheel.call_later(1, lambda: _poll_exit(pid), "reap")
+
+
+def unwatch_exit(pid):  # type: (int) -> None
+    if _watched.pop(pid, None) is not None:
+        _close_pidfd(pid)
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import time
+
+import pytest
+from tornado.ioloop import IOLoop
+
+import reaper
+
+
+def run_until(done, timeout=5):
+    io_loop = IOLoop.current()
+    deadline = io_loop.add_timeout(time.time() + timeout, io_loop.stop)
+
+    def check():
+        if done():
+            io_loop.stop()
+        else:
+            io_loop.add_timeout(time.time() + 0.01, check)
+    io_loop.add_callback(check)
+    io_loop.start()
+    io_loop.remove_timeout(deadline)
+
+
+class TestReaper:
+
+    def test_child_exit_status_is_reported(self):
+        statuses = []
+        p = subprocess.Popen(["sh", "-c", "exit 3"])
+        reaper.watch_child(p.pid, statuses.append)
+
+        run_until(lambda: statuses)
+
+        assert len(statuses) == 1
+        assert os.WEXITSTATUS(statuses[0]) == 3
+        assert p.pid not in reaper._children
+
+    def test_child_exit_without_pidfd(self, monkeypatch):
+        monkeypatch.delattr(reaper.os, "pidfd_open", raising=False)
+        statuses = []
+        p = subprocess.Popen(["sh", "-c", "sleep 0.1; exit 4"])
+        reaper.watch_child(p.pid, statuses.append)
+
+        run_until(lambda: statuses)
+
+        assert [os.WEXITSTATUS(s) for s in statuses] == [4]
+
+    @pytest.mark.skipif(not hasattr(os, "pidfd_open"), reason="needs pidfd")
+    def test_watch_exit(self):
+        gone = []
+        p = subprocess.Popen(["sh", "-c", "sleep 0.1"])
+        reaper.watch_exit(p.pid, lambda: gone.append(True))
+
+        run_until(lambda: gone)
+        p.wait()
+
+        assert gone == [True]
+        assert not reaper._pidfds
@@ -0,0 +1,284 @@
+import logging
+import os.path
+import re
+import time
+
+import tornado.websocket
+from tornado.escape import json_decode
+from tornado.escape import json_encode
+from tornado.escape import to_unicode
+from tornado.ioloop import IOLoop
+
+import config
+from ttyrec import TtyrecReader
+from util import dgl_format_str
+from util import write_buffer_size
+
+try:
+    from typing import Any
+    from typing import Callable
+    from typing import Dict
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+except ImportError:
+    pass
+
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None  # type: ignore
+
+# Most terminal data sent in one websocket message
+MAX_CHUNK = 64 * 1024
+# Playback waits while more than this is queued for the client
+MAX_BUFFERED = 4 * MAX_CHUNK
+# How often to check whether the client has caught up, in seconds
+BUFFER_WAIT = 0.05
+
+
+def replay_path(game_id, username, filename):
+    # type: (str, str, str) -> Optional[str]
+    """The path of a recorded ttyrec, or None if the request doesn't name
+    one."""
+    game = config.games.get(game_id)
+    if not game or not game.get("ttyrec_path"):
+        return None
+    if not re.match(config.nick_regex, username):
+        return None
+    if (os.path.basename(filename) != filename or
+            not filename.endswith(".ttyrec")):
+        return None
+    return os.path.join(dgl_format_str(game["ttyrec_path"], username, game),
+                        filename)
+
+
+# Recordings are opened on a few shared threads, since one without an index
+# is read in full to find its keyframes
+_executor = None  # type: Any
+# Keyframe indexes of recently opened recordings, by (path, size, mtime)
+_index_cache = dict()  # type: Dict[Tuple[str, int, float], List[Tuple[int, float, int]]]
+max_index_cache_size = 100
+# Callbacks waiting for a recording that is being opened
+_pending = dict()  # type: Dict[Tuple[str, int, float], List[Callable[..., None]]]
+
+
+def _get_executor():  # type: () -> Any
+    global _executor
+    if _executor is None and concurrent is not None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+                            getattr(config, "replay_threads", 2))
+    return _executor
+
+
+def _open(path, entries=None):
+    # type: (str, Optional[List[Tuple[int, float, int]]]) -> Optional[TtyrecReader]
+    try:
+        return TtyrecReader(path, entries)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def open_reader(path, callback):
+    # type: (str, Callable[[Optional[TtyrecReader]], None]) -> None
+    """Opens a TtyrecReader on the replay threads. The callback gets the
+    reader, or None if it couldn't be opened, on the IOLoop.
+
+    A recording is only indexed once while it doesn't change; viewers that
+    open it at the same time wait for the same thread, and later ones reuse
+    its index."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        IOLoop.current().add_callback(callback, None)
+        return
+    key = (path, st.st_size, st.st_mtime)
+    entries = _index_cache.get(key)
+    if entries is not None:
+        IOLoop.current().add_callback(callback, _open(path, entries))
+        return
+    if key in _pending:
+        _pending[key].append(callback)
+        return
+    _pending[key] = [callback]
+
+    def done(reader):  # type: (Optional[TtyrecReader]) -> None
+        waiting = _pending.pop(key)
+        if reader is not None:
+            if len(_index_cache) >= max_index_cache_size:
+                _index_cache.clear()
+            _index_cache[key] = reader.entries
+        for i, waiting_callback in enumerate(waiting):
+            if i > 0 and reader is not None:
+                reader = _open(path, reader.entries)
+            try:
+                waiting_callback(reader)
+            except Exception:
+                logging.error("Error in replay open callback.", exc_info=True)
+
+    executor = _get_executor()
+    if executor is None:
+        done(_open(path))
+        return
+    IOLoop.current().add_future(executor.submit(_open, path),
+                                lambda future: done(future.result()))
+
+
+class ReplayHandler(tornado.websocket.WebSocketHandler):
+    """Plays a recorded game over a websocket.
+
+    Terminal output is sent as binary messages, everything else as JSON. The
+    client can send {"msg": "speed", "speed": 2}, {"msg": "seek", "time": t}
+    (in seconds since the start of the recording), {"msg": "pause"} and
+    {"msg": "resume"}. After a seek, playback continues from the keyframe
+    before t, fast-forwarded up to t. Nothing more is sent while the
+    client's connection has MAX_BUFFERED bytes waiting to go out.
+    """
+    def initialize(self):
+        self.reader = None  # type: Optional[TtyrecReader]
+        self.offset = 0
+        self.speed = 1.0
+        self.paused = False
+        self.timeout = None  # type: Any
+        self.closed = False
+        # Recording time being fast-forwarded to after a seek
+        self.seek_target = None  # type: Optional[float]
+        # Recording time at which playback was (re)started, and when
+        self.anchor_time = 0.0
+        self.anchor_wall = 0.0
+        self.max_delay = getattr(config, "replay_max_delay", 5)
+
+    def open(self, game_id, username, filename):
+        # Older tornados pass the url groups as bytes
+        path = replay_path(to_unicode(game_id), to_unicode(username),
+                           to_unicode(filename))
+        if path is None:
+            self.send_json(msg="error", text="No such recording.")
+            self.close()
+            return
+        open_reader(path, self._opened)
+
+    def _opened(self, reader):  # type: (Optional[TtyrecReader]) -> None
+        if self.closed:
+            if reader is not None:
+                reader.close()
+            return
+        if reader is None:
+            self.send_json(msg="error", text="No such recording.")
+            self.close()
+            return
+        self.reader = reader
+        self.send_json(msg="replay_info",
+                       duration=self.reader.end_time - self.reader.start_time,
+                       keyframes=len(self.reader.keyframe_times))
+        self._anchor(self.reader.start_time)
+        self._play()
+
+    def send_json(self, **data):
+        self.write_message(json_encode(data))
+
+    def on_message(self, message):
+        if self.reader is None:
+            return
+        try:
+            obj = json_decode(message)
+            msg = obj["msg"]
+            if msg == "speed":
+                self._anchor(self._now())
+                self.speed = min(max(float(obj["speed"]), 0.1), 100.0)
+            elif msg == "seek":
+                self._seek(self.reader.start_time + float(obj["time"]))
+            elif msg == "pause":
+                self._anchor(self._now())
+                self.paused = True
+            elif msg == "resume":
+                self._anchor(self.anchor_time)
+                self.paused = False
+            else:
+                return
+        except (ValueError, KeyError, TypeError):
+            self.close()
+            return
+        self._play()
+
+    def on_close(self):
+        self.closed = True
+        self._cancel()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def _now(self):  # type: () -> float
+        """The recording time that playback has reached."""
+        if self.paused:
+            return self.anchor_time
+        return (self.anchor_time +
+                (time.time() - self.anchor_wall) * self.speed)
+
+    def _anchor(self, t):  # type: (float) -> None
+        self.anchor_time = t
+        self.anchor_wall = time.time()
+
+    def _cancel(self):  # type: () -> None
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _buffered(self):  # type: () -> int
+        if not self.ws_connection or not self.ws_connection.stream:
+            return 0
+        return write_buffer_size(self.ws_connection.stream)
+
+    def _seek(self, t):  # type: (float) -> None
+        # _play sends everything from the keyframe up to t
+        self.offset = self.reader.seek(t)
+        self.seek_target = t
+        self._anchor(t)
+
+    def _play(self):  # type: () -> None
+        self._cancel()
+        if self.reader is None:
+            return
+        seeking = self.seek_target is not None
+        if self.paused and not seeking:
+            return
+        if self._buffered() > MAX_BUFFERED:
+            # Wait for the client to catch up
+            self.timeout = IOLoop.current().add_timeout(
+                                time.time() + BUFFER_WAIT, self._play)
+            return
+        now = self.seek_target if seeking else self._now()
+        chunks = []
+        size = 0
+        while size < MAX_CHUNK:
+            frame = self.reader.frame(self.offset)
+            if frame is None:
+                break
+            t, data, next_offset = frame
+            if t > now:
+                break
+            chunks.append(data)
+            size += len(data)
+            self.offset = next_offset
+        if chunks:
+            self.write_message(b"".join(chunks), binary=True)
+        if size >= MAX_CHUNK:
+            # More is due already; let other connections go first
+            self.timeout = IOLoop.current().add_timeout(time.time(),
+                                                        self._play)
+            return
+        if seeking:
+            self.seek_target = None
+            self.send_json(msg="seeked", time=now - self.reader.start_time)
+            self._anchor(now)
+        if frame is None:
+            self.send_json(msg="replay_end")
+            return
+        if self.paused:
+            return
+        if self.max_delay and t - now > self.max_delay:
+            # Skip long idle stretches
+            self._anchor(t - self.max_delay)
+            now = t - self.max_delay
+        self.timeout = IOLoop.current().add_timeout(
+                            time.time() + (t - now) / self.speed, self._play)
@@ -0,0 +1,227 @@
+import collections
+import os.path
+import threading
+import time
+
+import pytest
+import tornado.websocket
+from tornado.ioloop import IOLoop
+
+import config
+import replay
+import ttyrec
+
+
+class TestReplayPath:
+
+    def setup_method(self, method):
+        self.games = config.games
+        config.games = {"trunk": dict(ttyrec_path="./rcs/ttyrecs/%n")}
+
+    def teardown_method(self, method):
+        config.games = self.games
+
+    def test_path_is_in_the_players_ttyrec_dir(self):
+        path = replay.replay_path("trunk", "player", "2020-01-01.ttyrec")
+        assert path == os.path.join("./rcs/ttyrecs/player",
+                                    "2020-01-01.ttyrec")
+
+    def test_other_files_are_refused(self):
+        assert replay.replay_path("nogame", "player", "a.ttyrec") is None
+        assert replay.replay_path("trunk", "../x", "a.ttyrec") is None
+        assert replay.replay_path("trunk", "player", "../a.ttyrec") is None
+        assert replay.replay_path("trunk", "player", "rc.txt") is None
+
+
+class FakeStream(object):
+    def __init__(self):
+        self._write_buffer = collections.deque()
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.stream = FakeStream()
+        self.sent = []
+
+    def write_message(self, message, binary=False):
+        self.sent.append(message)
+        self.stream._write_buffer.append(message)
+
+    def close(self):
+        pass
+
+
+def make_handler(path):
+    """A ReplayHandler playing path, without a tornado application."""
+    handler_init = tornado.websocket.WebSocketHandler.__init__
+    tornado.websocket.WebSocketHandler.__init__ = (
+        lambda self, *args, **kwargs: None)
+    try:
+        handler = replay.ReplayHandler(None, None)
+    finally:
+        tornado.websocket.WebSocketHandler.__init__ = handler_init
+    handler.initialize()
+    handler.ws_connection = FakeConnection()
+    handler.reader = ttyrec.TtyrecReader(path)
+    return handler
+
+
+class TestPlayback:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir, monkeypatch):
+        self.path = str(tmpdir.join("game.ttyrec"))
+        writer = ttyrec.TtyrecWriter(self.path, flush_interval=0, index=True)
+        writer.write_frame(b"\x1b[H\x1b[Jfirst", 1000)
+        writer.write_frame(b"a", 1001)
+        writer.write_frame(b"\x1b[H\x1b[Jsecond", 1010)
+        writer.write_frame(b"b", 1011)
+        writer.write_frame(b"c", 1012)
+        writer.write_frame(b"d", 1030)
+        writer.close()
+
+        self.now = 5000.0
+        monkeypatch.setattr(replay.time, "time", lambda: self.now)
+        self.handler = make_handler(self.path)
+        self.sent = self.handler.ws_connection.sent
+        self.buffer = self.handler.ws_connection.stream._write_buffer
+        yield
+        self.handler.on_close()
+
+    def start(self):
+        self.handler._anchor(self.handler.reader.start_time)
+        self.handler._play()
+
+    def test_frames_are_sent_when_due(self):
+        self.start()
+        assert self.sent == [b"\x1b[H\x1b[Jfirst"]
+        assert self.handler.timeout is not None
+
+        self.now += 1
+        self.handler._play()
+        assert self.sent[-1] == b"a"
+
+        self.now += 11
+        self.handler._play()
+        assert self.sent[-1] == b"\x1b[H\x1b[Jsecondbc"
+
+    def test_long_idle_stretches_are_shortened(self):
+        self.start()
+        self.now += 12
+        self.handler._play()
+        # d is due 18 seconds after c; only max_delay of that is waited
+        self.now += self.handler.max_delay
+        self.handler._play()
+        assert self.sent[-2:] == [b"d", '{"msg": "replay_end"}']
+
+    def test_seek_fast_forwards_from_keyframe(self):
+        self.handler._seek(1011.5)
+        self.handler._play()
+        assert self.sent == [b"\x1b[H\x1b[Jsecondb",
+                             '{"msg": "seeked", "time": 11.5}']
+        assert self.handler.seek_target is None
+
+        self.now += 0.5
+        self.handler._play()
+        assert self.sent[-1] == b"c"
+
+    def test_seek_while_paused(self):
+        self.handler.paused = True
+        self.handler._seek(1001)
+        self.handler._play()
+        assert self.sent == [b"\x1b[H\x1b[Jfirsta",
+                             '{"msg": "seeked", "time": 1.0}']
+        assert self.handler.timeout is None
+
+    def test_seek_is_sent_in_chunks(self, monkeypatch):
+        monkeypatch.setattr(replay, "MAX_CHUNK", 8)
+        self.handler._seek(1012)
+        self.handler._play()
+        assert self.sent == [b"\x1b[H\x1b[Jsecond"]
+        self.handler._play()
+        assert self.sent[1:] == [b"bc", '{"msg": "seeked", "time": 12.0}']
+
+    def test_nothing_is_sent_while_client_is_behind(self, monkeypatch):
+        monkeypatch.setattr(replay, "MAX_BUFFERED", 10)
+        self.buffer.append(b"x" * 11)
+        self.handler._seek(1012)
+        self.handler._play()
+        assert self.sent == []
+        assert self.handler.timeout is not None
+
+        # Time spent waiting doesn't skip any of the recording
+        self.now += 5
+        self.buffer.clear()
+        self.handler._play()
+        assert self.sent == [b"\x1b[H\x1b[Jsecondbc",
+                             '{"msg": "seeked", "time": 12.0}']
+
+
+def open_readers(paths):
+    """Opens each path with open_reader and waits for all the callbacks."""
+    io_loop = IOLoop()
+    io_loop.make_current()
+    results = []
+
+    def opened(reader):
+        results.append((reader, threading.current_thread()))
+        if len(results) == len(paths):
+            io_loop.stop()
+    try:
+        for path in paths:
+            replay.open_reader(path, opened)
+        io_loop.add_timeout(time.time() + 5, io_loop.stop)
+        io_loop.start()
+    finally:
+        io_loop.clear_current()
+        io_loop.close()
+    assert all(thread is threading.current_thread() for r, thread in results)
+    return [reader for reader, thread in results]
+
+
+class TestOpenReader:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir, monkeypatch):
+        self.path = str(tmpdir.join("game.ttyrec"))
+        writer = ttyrec.TtyrecWriter(self.path, flush_interval=0)
+        writer.write_frame(b"\x1b[H\x1b[Jscreen", 1000)
+        writer.close()
+
+        self.scans = []
+        scan = ttyrec.TtyrecReader._scan
+
+        def counting_scan(reader):
+            self.scans.append(reader)
+            return scan(reader)
+        monkeypatch.setattr(ttyrec.TtyrecReader, "_scan", counting_scan)
+        monkeypatch.setattr(replay, "_index_cache", {})
+
+    def test_reader_is_passed_back_on_the_ioloop(self):
+        readers = open_readers([self.path, self.path + ".missing"])
+
+        readers.sort(key=bool)
+        assert readers[0] is None
+        assert readers[1].keyframe_offsets == [0]
+        readers[1].close()
+
+    def test_recording_is_indexed_once(self):
+        readers = open_readers([self.path] * 3)
+        readers += open_readers([self.path])
+
+        assert len(self.scans) == 1
+        assert len(set(readers)) == 4
+        for reader in readers:
+            assert reader.keyframe_offsets == [0]
+            reader.close()
+        assert replay._pending == {}
+
+    def test_changed_recording_is_indexed_again(self):
+        open_readers([self.path])[0].close()
+        with open(self.path, "ab") as f:
+            f.write(ttyrec.frame_header(1001, 1) + b"x")
+
+        reader = open_readers([self.path])[0]
+        assert len(self.scans) == 2
+        assert reader.end_time == 1001
+        reader.close()
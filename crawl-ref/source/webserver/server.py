@@ -14,7 +14,12 @@ from config import *
 from util import *
 from ws_handler import *
 from game_data_handler import GameDataHandler
+from metrics import MetricsHandler
+from replay import ReplayHandler
+from timers import timer_wheel
 import process_handler
+import spawn
+import ttyrec
 import userdb
 import auth
 
@@ -147,11 +152,18 @@ def bind_server():
     if hasattr(config, "no_cache") and config.no_cache:
         settings["static_handler_class"] = NoCacheHandler
 
-    application = tornado.web.Application([
+    handlers = [
             (r"/", MainHandler),
             (r"/socket", CrawlWebSocket),
             (r"/gamedata/([0-9a-f]*\/.*)", GameDataHandler)
-            ], gzip=getattr(config,"use_gzip",True), **settings)
+            ]
+    if getattr(config, "metrics_enabled", False):
+        handlers.append((r"/metrics", MetricsHandler))
+    if getattr(config, "replay_enabled", False):
+        handlers.append((r"/replay/([^/]+)/([^/]+)/([^/]+)", ReplayHandler))
+
+    application = tornado.web.Application(handlers,
+            gzip=getattr(config,"use_gzip",True), **settings)
 
     kwargs = {}
     if http_connection_timeout is not None:
@@ -246,6 +258,12 @@ def check_config():
             logging.warning("Client data path %s doesn't exist!", game_data["client_path"])
             success = False
 
+        compression = game_data.get("ttyrec_compression")
+        if compression and compression not in ttyrec.compressors:
+            logging.warning("Unsupported ttyrec compression %s for %s!",
+                            compression, game_id)
+            success = False
+
     if getattr(config, "allow_password_reset", False) and not config.lobby_url:
         logging.warning("Lobby URL needs to be defined!")
         success = False
@@ -296,6 +314,14 @@ if __name__ == "__main__":
         userdb.ensure_user_db_exists()
         userdb.upgrade_user_db()
     userdb.ensure_settings_db_exists()
+    if getattr(config, "spawn_helper", False):
+        spawn.start_launcher(logging.getLogger(),
+                             getattr(config, "spawn_helper_timeout", 0.25))
+    userdb_workers = getattr(config, "userdb_workers", 0)
+    if userdb_workers and not getattr(config, "spawn_helper", False):
+        logging.warning("userdb_workers is set without spawn_helper; games "
+                        "will be forked from a threaded server.")
+    userdb.start_executor(userdb_workers)
     try:
         IOLoop.current().set_blocking_log_threshold(0.5) # type: ignore
         logging.info("Blocking call timeout: 500ms.")
@@ -303,6 +329,8 @@ if __name__ == "__main__":
         # this is the new normal; still not sure of a way to deal with this.
         logging.info("Webserver running without a blocking call timeout.")
 
+    timer_wheel.every(10, process_handler.check_idle_games, "idle")
+
     if dgl_mode:
         status_file_timeout()
         auth.purge_login_tokens_timeout()
@@ -317,4 +345,9 @@ if __name__ == "__main__":
     IOLoop.current().start()
 
     logging.info("Bye!")
+    userdb.stop_executor()
+    spawn.stop_launcher()
+    # Games that are still running haven't written everything yet
+    ttyrec.close_writers()
+    ttyrec.stop_writer_thread()
     remove_pidfile()
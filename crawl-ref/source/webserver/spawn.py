@@ -0,0 +1,306 @@
+"""Starting crawl processes on a pty.
+
+fork_pty forks the calling process directly. Launcher instead asks a small
+helper process to do it: the helper is started once, runs only this module
+(no tornado, no game state), and passes the pty back over a unix socket, so
+spawning a game doesn't have to fork the whole webserver.
+"""
+import array
+import errno
+import fcntl
+import json
+import os
+import pty
+import resource
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import termios
+
+try:
+    from typing import Any, Callable, Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+
+def close_fds():  # type: () -> None
+    """Closes every file descriptor above stderr."""
+    max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if sys.version_info >= (3, 10):
+        # Uses the close_range syscall where available
+        os.closerange(3, max_fd)
+        return
+    try:
+        # Only close what is actually open, instead of every possible fd up
+        # to the limit
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except (OSError, ValueError):
+        os.closerange(3, max_fd)
+        return
+    for fd in fds:
+        if fd > 2:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _exec_child(command, termsize, errpipe_write):
+    # type: (List[str], Tuple[int, int], int) -> None
+    def handle_signal(signal, f):
+        sys.exit(0)
+    signal.signal(1, handle_signal)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # Set window size
+    cols, lines = termsize
+    s = struct.pack("HHHH", lines, cols, 0, 0)
+    fcntl.ioctl(pty.STDOUT_FILENO, termios.TIOCSWINSZ, s)
+
+    os.dup2(errpipe_write, 2)
+
+    # Make sure not to retain any files from the parent
+    close_fds()
+
+    # And exec
+    env = dict(os.environ)
+    env["COLUMNS"] = str(cols)
+    env["LINES"] = str(lines)
+    env["TERM"] = "linux"
+    try:
+        os.execvpe(command[0], command, env)
+    except OSError:
+        sys.exit(1)
+
+
+def fork_pty(command, termsize):
+    # type: (List[str], Tuple[int, int]) -> Tuple[int, int, int]
+    """Runs command on a new pty, with stderr going to a pipe.
+
+    Returns the pid, the pty's master fd and the pipe's read end."""
+    errpipe_read, errpipe_write = os.pipe()
+
+    pid, child_fd = pty.fork()
+
+    if pid == 0:
+        # We're the child
+        try:
+            _exec_child(command, termsize, errpipe_write)
+        finally:
+            os._exit(1)
+
+    # We're the parent
+    os.close(errpipe_write)
+    return pid, child_fd, errpipe_read
+
+
+def returncode(status):  # type: (Optional[int]) -> int
+    """Converts a waitpid status like subprocess does."""
+    if status is None:
+        # The exit status got lost, e.g. because the launcher died
+        return -1
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    elif os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    else:
+        # Should never happen
+        raise RuntimeError("Unknown child exit status!")
+
+
+class Launcher(object):
+    """Spawns processes through a separate helper process.
+
+    Processes started this way are children of the helper, which reports
+    their exit status back; register for it with watch_exit.
+
+    Spawning waits for the helper's reply on the IOLoop, for at most
+    timeout seconds; a helper that doesn't answer in time isn't asked again.
+    """
+    def __init__(self, logger, timeout=0.25):
+        # Imported here, so that the helper doesn't load tornado
+        from tornado.ioloop import IOLoop
+
+        self.logger = logger
+        self.requests, helper_requests = socket.socketpair(
+                                    socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.events, helper_events = socket.socketpair(
+                                    socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        fds = (helper_requests.fileno(), helper_events.fileno())
+        self.helper = subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__)] +
+                        [str(fd) for fd in fds],
+                        pass_fds=fds)
+        helper_requests.close()
+        helper_events.close()
+
+        self.requests.settimeout(timeout)
+        self.events.setblocking(False)
+        self.alive = True
+        self.exit_callbacks = {}  # type: Dict[int, Callable[[Optional[int]], Any]]
+        IOLoop.current().add_handler(self.events.fileno(),
+                                     self._handle_events,
+                                     IOLoop.READ | IOLoop.ERROR)
+        self.logger.info("Started spawn helper (pid %s).", self.helper.pid)
+
+    def usable(self):  # type: () -> bool
+        return self.alive and self.requests is not None
+
+    def spawn(self, command, termsize):
+        # type: (List[str], Tuple[int, int]) -> Tuple[int, int, int]
+        """Like fork_pty, but done by the helper."""
+        if not self.usable():
+            raise OSError(errno.ESRCH, "Spawn helper isn't running")
+        request = {"command": command, "termsize": list(termsize)}
+        fd_size = struct.calcsize("i")
+        try:
+            self.requests.send(json.dumps(request).encode("utf-8"))
+            msg, ancdata, flags, addr = self.requests.recvmsg(
+                                        4096, socket.CMSG_SPACE(2 * fd_size))
+        except socket.timeout:
+            # A late reply would be taken for the answer to the next request,
+            # so stop using the helper; it still reports exits of its games
+            self.logger.error("The spawn helper didn't answer; starting "
+                              "games directly.")
+            self.requests.close()
+            self.requests = None
+            raise
+        fds = array.array("i")
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fd_size)])
+        for fd in fds:
+            os.set_inheritable(fd, False)
+        if not msg:
+            self._died()
+            raise OSError(errno.ESRCH, "Spawn helper isn't running")
+        reply = json.loads(msg.decode("utf-8"))
+        if "error" in reply:
+            raise OSError(reply["errno"], reply["error"])
+        return reply["pid"], fds[0], fds[1]
+
+    def watch_exit(self, pid, callback):
+        # type: (int, Callable[[Optional[int]], Any]) -> None
+        self.exit_callbacks[pid] = callback
+
+    def _handle_events(self, fd, events):
+        while True:
+            try:
+                data = self.events.recv(4096)
+            except socket.error as e:
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            if not data:
+                self._died()
+                return
+            event = json.loads(data.decode("utf-8"))
+            callback = self.exit_callbacks.pop(event["pid"], None)
+            if callback:
+                callback(event["status"])
+
+    def _died(self):
+        if not self.alive:
+            return
+        from tornado.ioloop import IOLoop
+        self.alive = False
+        IOLoop.current().remove_handler(self.events.fileno())
+        self.helper.poll()
+        self.logger.error("The spawn helper died; starting games directly.")
+        # The exit status of its children can't be known anymore, so end
+        # their games
+        callbacks = list(self.exit_callbacks.values())
+        self.exit_callbacks = {}
+        for callback in callbacks:
+            callback(None)
+
+    def stop(self):
+        if self.requests is not None:
+            self.requests.close()
+            self.requests = None
+        if self.alive:
+            self.helper.wait()
+
+
+launcher = None  # type: Optional[Launcher]
+
+
+def start_launcher(logger, timeout=0.25):
+    global launcher
+    if not hasattr(socket.socket, "recvmsg"):
+        logger.warning("The spawn helper needs Python 3; starting games "
+                       "directly.")
+        return
+    launcher = Launcher(logger, timeout)
+
+
+def stop_launcher():
+    global launcher
+    if launcher:
+        launcher.stop()
+        launcher = None
+
+
+def _serve(requests, events):  # type: (socket.socket, socket.socket) -> None
+    # The webserver handles shutdown; the helper exits once the webserver
+    # closes its end of the socket.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    wakeup_read, wakeup_write = os.pipe()
+    fcntl.fcntl(wakeup_write, fcntl.F_SETFL, os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    while True:
+        try:
+            readable = select.select([requests, wakeup_read], [], [])[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if wakeup_read in readable:
+            os.read(wakeup_read, 512)
+            _reap(events)
+
+        if requests in readable:
+            data = requests.recv(65536)
+            if not data:
+                return
+            request = json.loads(data.decode("utf-8"))
+            try:
+                pid, child_fd, errpipe_read = fork_pty(request["command"],
+                                                       request["termsize"])
+            except OSError as e:
+                reply = {"error": e.strerror, "errno": e.errno}
+                requests.send(json.dumps(reply).encode("utf-8"))
+                continue
+            fds = array.array("i", [child_fd, errpipe_read])
+            requests.sendmsg([json.dumps({"pid": pid}).encode("utf-8")],
+                             [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               fds.tobytes())])
+            os.close(child_fd)
+            os.close(errpipe_read)
+
+
+def _reap(events):  # type: (socket.socket) -> None
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+        event = {"pid": pid, "status": status}
+        events.send(json.dumps(event).encode("utf-8"))
+
+
+if __name__ == "__main__":
+    _serve(socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET,
+                         fileno=int(sys.argv[1])),
+           socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET,
+                         fileno=int(sys.argv[2])))
@@ -0,0 +1,75 @@
+import logging
+import os
+import signal
+import time
+
+import pytest
+from tornado.ioloop import IOLoop
+
+import spawn
+
+
+def read_all(fd):
+    data = b""
+    while True:
+        try:
+            chunk = os.read(fd, 1024)
+        except OSError:
+            break
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class TestSpawn:
+
+    def test_fork_pty_closes_inherited_fds(self):
+        pid, child_fd, errpipe_read = spawn.fork_pty(
+                            ["sh", "-c", "ls /proc/$$/fd; echo err >&2"],
+                            (80, 24))
+        _, status = os.waitpid(pid, 0)
+
+        assert spawn.returncode(status) == 0
+        assert read_all(child_fd).split() == [b"0", b"1", b"2"]
+        assert read_all(errpipe_read) == b"err\n"
+        os.close(child_fd)
+        os.close(errpipe_read)
+
+    @pytest.mark.skipif(not hasattr(spawn.socket.socket, "recvmsg"),
+                        reason="needs Python 3")
+    def test_launcher_reports_exit_status(self):
+        launcher = spawn.Launcher(logging.getLogger())
+        statuses = []
+        try:
+            pid, child_fd, errpipe_read = launcher.spawn(
+                                    ["sh", "-c", "echo hi; exit 3"], (80, 24))
+            launcher.watch_exit(pid, statuses.append)
+            deadline = time.time() + 5
+            while not statuses and time.time() < deadline:
+                launcher._handle_events(None, IOLoop.READ)
+                time.sleep(0.01)
+
+            assert [spawn.returncode(s) for s in statuses] == [3]
+            assert read_all(child_fd).strip() == b"hi"
+            os.close(child_fd)
+            os.close(errpipe_read)
+        finally:
+            IOLoop.current().remove_handler(launcher.events.fileno())
+            launcher.stop()
+
+    @pytest.mark.skipif(not hasattr(spawn.socket.socket, "recvmsg"),
+                        reason="needs Python 3")
+    def test_stuck_helper_is_given_up_on_quickly(self):
+        launcher = spawn.Launcher(logging.getLogger(), timeout=0.1)
+        os.kill(launcher.helper.pid, signal.SIGSTOP)
+        try:
+            start = time.time()
+            with pytest.raises(OSError):
+                launcher.spawn(["true"], (80, 24))
+            assert time.time() - start < 1
+            assert not launcher.usable()
+        finally:
+            os.kill(launcher.helper.pid, signal.SIGCONT)
+            IOLoop.current().remove_handler(launcher.events.fileno())
+            launcher.stop()
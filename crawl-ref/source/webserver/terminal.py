@@ -1,32 +1,125 @@
-import pty
-import termios
-import os
+import collections
+import errno
 import fcntl
-import struct
-import resource
-import signal
-import sys
+import os
 import time
 import tornado.ioloop
 from tornado.ioloop import IOLoop
 from tornado.escape import to_unicode
 
-BUFSIZ = 2048
+import config
+import reaper
+import spawn
+from ttyrec import TtyrecWriter
+
+try:
+    from typing import Deque, List, Tuple
+except ImportError:
+    pass
+
+BUFSIZ = 65536
+# A readable fd is read until it would block, but at most this many bytes or
+# seconds at a time, so that one busy game can't hold up the others
+READ_BUDGET = 256 * 1024
+READ_TIME_BUDGET = 0.005
+
+def set_nonblocking(fd):  # type: (int) -> None
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def read_available(fd):  # type: (int) -> Tuple[bytes, bool]
+    """Reads what is available from the non-blocking fd, within the read
+    budget. Returns the data, and whether the other end was closed."""
+    chunks = []
+    size = 0
+    deadline = time.time() + READ_TIME_BUDGET
+    while size < READ_BUDGET:
+        try:
+            buf = os.read(fd, BUFSIZ)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            # Linux reports a hung up pty like this
+            if e.errno == errno.EIO:
+                return b"".join(chunks), True
+            raise
+        if not buf:
+            return b"".join(chunks), True
+        chunks.append(buf)
+        size += len(buf)
+        if time.time() >= deadline:
+            break
+    return b"".join(chunks), False
+
+def read_remaining(fd):  # type: (int) -> bytes
+    """Reads everything that is left in the non-blocking fd."""
+    chunks = []
+    while True:
+        buf, closed = read_available(fd)
+        chunks.append(buf)
+        if closed or not buf:
+            return b"".join(chunks)
+
+class LineBuffer(object):
+    """Splits a byte stream into lines.
+
+    Lines are found from a cursor instead of slicing them off the front of
+    the buffer, which is only compacted once most of it has been consumed,
+    so a burst of n bytes is split in O(n) however many lines it holds."""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def feed(self, data):  # type: (bytes) -> None
+        self.buffer += data
+
+    def lines(self):  # type: () -> List[bytes]
+        """Returns the complete, non-empty lines fed so far, without their
+        line endings."""
+        buf = self.buffer
+        lines = []
+        end = buf.find(b"\n", self.pos)
+        while end >= 0:
+            if end > self.pos:
+                if buf[end - 1] == 13:  # \r
+                    lines.append(bytes(buf[self.pos:end - 1]))
+                else:
+                    lines.append(bytes(buf[self.pos:end]))
+            self.pos = end + 1
+            end = buf.find(b"\n", self.pos)
+        if self.pos * 2 >= len(buf):
+            del buf[:self.pos]
+            self.pos = 0
+        return lines
+
+    def __len__(self):
+        return len(self.buffer) - self.pos
 
 class TerminalRecorder(object):
-    def __init__(self, command, filename, id_header, logger, termsize):
+    def __init__(self, command, filename, id_header, logger, termsize,
+                 compression=None):
         self.command = command
         if filename:
-            self.ttyrec = open(filename, "wb", 0)
+            self.ttyrec = TtyrecWriter(
+                filename,
+                getattr(config, "ttyrec_buffer_size", 65536),
+                getattr(config, "ttyrec_flush_interval", 1),
+                getattr(config, "ttyrec_writer_thread", False),
+                logger, compression,
+                getattr(config, "ttyrec_sync_interval", 10),
+                getattr(config, "ttyrec_index", False))
         else:
             self.ttyrec = None
         self.id = id
         self.returncode = None
-        self.output_buffer = b""
+        self.output_buffer = LineBuffer()
         self.termsize = termsize
 
         self.pid = None
         self.child_fd = None
+        # Whether the process was started by the spawn helper, which then
+        # reports its exit instead of the reaper
+        self.launched = False
 
         self.end_callback = None
         self.output_callback = None
@@ -34,7 +127,14 @@ class TerminalRecorder(object):
         self.error_callback = None
 
         self.errpipe_read = None
-        self.error_buffer = b""
+        self.error_buffer = LineBuffer()
+
+        # Input that the pty didn't take yet; written once it is writable
+        self.input_queue = collections.deque() # type: Deque[bytes]
+        self.input_queued = 0
+        self.max_input_queued = getattr(config, "pty_input_queue_size",
+                                        16 * 1024)
+        self.pty_open = False
 
         self.logger = logger
 
@@ -44,158 +144,180 @@ class TerminalRecorder(object):
         self._spawn()
 
     def _spawn(self):
-        self.errpipe_read, errpipe_write = os.pipe()
-
-        self.pid, self.child_fd = pty.fork()
-
-        if self.pid == 0:
-            # We're the child
-            def handle_signal(signal, f):
-                sys.exit(0)
-            signal.signal(1, handle_signal)
-
-            # Set window size
-            cols, lines = self.get_terminal_size()
-            s = struct.pack("HHHH", lines, cols, 0, 0)
-            fcntl.ioctl(sys.stdout.fileno(), termios.TIOCSWINSZ, s)
-
-            os.close(self.errpipe_read)
-            os.dup2(errpipe_write, 2)
-
-            # Make sure not to retain any files from the parent
-            max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-            for i in range(3, max_fd):
-                try:
-                    os.close(i)
-                except OSError:
-                    pass
-
-            # And exec
-            env            = dict(os.environ)
-            env["COLUMNS"] = str(cols)
-            env["LINES"]   = str(lines)
-            env["TERM"]    = "linux"
+        launcher = spawn.launcher
+        if launcher and launcher.usable():
             try:
-                os.execvpe(self.command[0], self.command, env)
-            except OSError:
-                sys.exit(1)
-
-        # We're the parent
-        os.close(errpipe_write)
+                self.pid, self.child_fd, self.errpipe_read = launcher.spawn(
+                                            self.command, self.termsize)
+            except (OSError, ValueError):
+                self.logger.warning("Spawn helper failed, starting the "
+                                    "process directly.", exc_info=True)
+            else:
+                self.launched = True
+                launcher.watch_exit(self.pid, self._handle_exit)
+        if not self.launched:
+            self.pid, self.child_fd, self.errpipe_read = spawn.fork_pty(
+                                            self.command, self.termsize)
+            reaper.watch_child(self.pid, self._handle_exit)
+
+        set_nonblocking(self.child_fd)
+        set_nonblocking(self.errpipe_read)
 
         IOLoop.current().add_handler(self.child_fd,
                                      self._handle_read,
                                      IOLoop.ERROR | IOLoop.READ)
+        self.pty_open = True
 
         IOLoop.current().add_handler(self.errpipe_read,
                                      self._handle_err_read,
                                      IOLoop.READ)
 
     def _handle_read(self, fd, events):
+        if events & IOLoop.WRITE:
+            self._write_queued_input()
+            if not self.pty_open:
+                return
+
+        hung_up = bool(events & IOLoop.ERROR)
         if events & IOLoop.READ:
-            buf = os.read(fd, BUFSIZ)
+            buf, closed = read_available(fd)
 
             if len(buf) > 0:
-                self.write_ttyrec_chunk(buf)
+                # Read what's left before acting on a hangup
+                hung_up = closed
+                self._handle_output(buf)
+            elif closed:
+                hung_up = True
 
-                if self.activity_callback:
-                    self.activity_callback()
+        if hung_up:
+            # Stop watching the pty until the exit is reported
+            self._close_pty()
 
-                self.output_buffer += buf
-                self._do_output_callback()
+    def _handle_output(self, buf):  # type: (bytes) -> None
+        self.write_ttyrec_chunk(buf)
 
-            self.poll()
+        if self.activity_callback:
+            self.activity_callback()
 
-        if events & IOLoop.ERROR:
-            self.poll()
+        self.output_buffer.feed(buf)
+        self._do_output_callback()
+
+    def _close_pty(self):
+        if not self.pty_open:
+            return
+        self.pty_open = False
+        IOLoop.current().remove_handler(self.child_fd)
+        self.input_queue.clear()
+        self.input_queued = 0
 
     def _handle_err_read(self, fd, events):
         if events & IOLoop.READ:
-            buf = os.read(fd, BUFSIZ)
+            buf, closed = read_available(fd)
 
             if len(buf) > 0:
-                self.error_buffer += buf
+                self.error_buffer.feed(buf)
                 self._log_error_output()
-
-            self.poll()
-
-    def write_ttyrec_header(self, sec, usec, l):
-        if self.ttyrec is None: return
-        s = struct.pack("<iii", sec, usec, l)
-        self.ttyrec.write(s)
+            if closed:
+                IOLoop.current().remove_handler(self.errpipe_read)
 
     def write_ttyrec_chunk(self, data):
         if self.ttyrec is None: return
-        t = time.time()
-        self.write_ttyrec_header(int(t), int((t % 1) * 1000000), len(data))
-        self.ttyrec.write(data)
+        self.ttyrec.write_frame(data)
 
     def _do_output_callback(self):
-        pos = self.output_buffer.find(b"\n")
-        while pos >= 0:
-            line = self.output_buffer[:pos]
-            self.output_buffer = self.output_buffer[pos + 1:]
-
-            if len(line) > 0:
-                if line[-1] == b"\r": line = line[:-1]
-
-                if self.output_callback:
-                    self.output_callback(to_unicode(line))
-
-            pos = self.output_buffer.find(b"\n")
+        for line in self.output_buffer.lines():
+            if self.output_callback:
+                self.output_callback(to_unicode(line))
 
     def _log_error_output(self):
-        pos = self.error_buffer.find(b"\n")
-        while pos >= 0:
-            line = self.error_buffer[:pos]
-            self.error_buffer = self.error_buffer[pos + 1:]
-
-            if len(line) > 0:
-                if line[-1] == b"\r": line = line[:-1]
-
-                self.logger.info("ERR: %s", to_unicode(line))
-                if self.error_callback:
-                    self.error_callback(to_unicode(line))
-
-            pos = self.error_buffer.find(b"\n")
+        for line in self.error_buffer.lines():
+            self.logger.info("ERR: %s", to_unicode(line))
+            if self.error_callback:
+                self.error_callback(to_unicode(line))
 
 
     def send_signal(self, signal):
         os.kill(self.pid, signal)
 
     def poll(self):
-        if self.returncode is None:
-            pid, status = os.waitpid(self.pid, os.WNOHANG)
-            if pid == self.pid:
-                if os.WIFSIGNALED(status):
-                    self.returncode = -os.WTERMSIG(status)
-                elif os.WIFEXITED(status):
-                    self.returncode = os.WEXITSTATUS(status)
-                else:
-                    # Should never happen
-                    raise RuntimeError("Unknown child exit status!")
+        return self.returncode
 
-            if self.returncode is not None:
-                IOLoop.current().remove_handler(self.child_fd)
-                IOLoop.current().remove_handler(self.errpipe_read)
+    def _handle_exit(self, status):
+        if self.returncode is not None:
+            return
+        self.returncode = spawn.returncode(status)
 
-                os.close(self.child_fd)
-                os.close(self.errpipe_read)
+        self._close_pty()
+        IOLoop.current().remove_handler(self.errpipe_read)
 
-                if self.ttyrec:
-                    self.ttyrec.close()
+        # The exit can be reported before the IOLoop got to the last output;
+        # the error output in particular tells why the game ended
+        buf = read_remaining(self.child_fd)
+        if buf:
+            self._handle_output(buf)
+        buf = read_remaining(self.errpipe_read)
+        if buf:
+            self.error_buffer.feed(buf)
+            self._log_error_output()
 
-                if self.end_callback:
-                    self.end_callback()
+        os.close(self.child_fd)
+        os.close(self.errpipe_read)
 
-        return self.returncode
+        if self.ttyrec:
+            self.ttyrec.close()
+
+        if self.end_callback:
+            self.end_callback()
 
     def get_terminal_size(self):
         return self.termsize
 
-    def write_input(self, data):
-        if self.poll() is not None: return
-
-        while len(data) > 0:
-            written = os.write(self.child_fd, data)
-            data = data[written:]
+    def write_input(self, data):  # type: (bytes) -> bool
+        """Sends data to the process without blocking. What the pty doesn't
+        take right away is queued; returns False if the data was dropped
+        because the queue is full, i.e. the process isn't reading its input.
+        """
+        if self.poll() is not None or not self.pty_open: return True
+
+        if self.input_queue:
+            if self.input_queued + len(data) > self.max_input_queued:
+                return False
+            self.input_queue.append(data)
+            self.input_queued += len(data)
+            return True
+
+        written = self._write_pty(data)
+        if written < len(data):
+            # Always keep the rest, so that no input is cut in half
+            self.input_queue.append(data[written:])
+            self.input_queued += len(data) - written
+            IOLoop.current().update_handler(
+                self.child_fd, IOLoop.ERROR | IOLoop.READ | IOLoop.WRITE)
+        return True
+
+    def _write_pty(self, data):  # type: (bytes) -> int
+        """Writes what the pty takes without blocking; returns how much."""
+        try:
+            return os.write(self.child_fd, data)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            if e.errno == errno.EIO:
+                # Hung up; the exit will be reported soon
+                self._close_pty()
+                return len(data)
+            raise
+
+    def _write_queued_input(self):
+        while self.input_queue:
+            data = self.input_queue[0]
+            written = self._write_pty(data)
+            if not self.pty_open:
+                return
+            self.input_queued -= written
+            if written < len(data):
+                self.input_queue[0] = data[written:]
+                return
+            self.input_queue.popleft()
+        IOLoop.current().update_handler(self.child_fd,
+                                        IOLoop.ERROR | IOLoop.READ)
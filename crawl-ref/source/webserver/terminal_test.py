@@ -0,0 +1,146 @@
+import collections
+import logging
+import os
+import time
+
+from tornado.ioloop import IOLoop
+
+import terminal
+from terminal import LineBuffer
+from terminal import read_available
+from terminal import set_nonblocking
+
+
+def split_burst(size):
+    line = b"x" * 79 + b"\n"
+    burst = line * (size // len(line))
+    buf = LineBuffer()
+    start = time.time()
+    buf.feed(burst)
+    lines = buf.lines()
+    assert len(lines) == size // len(line)
+    return time.time() - start
+
+
+class TestLineBuffer:
+
+    def test_lines_are_split(self):
+        buf = LineBuffer()
+        buf.feed(b"one\r\ntw")
+        assert buf.lines() == [b"one"]
+        buf.feed(b"o\n\nthree")
+        assert buf.lines() == [b"two"]
+        assert len(buf) == len(b"three")
+        buf.feed(b"\r\n")
+        assert buf.lines() == [b"three"]
+        assert len(buf) == 0
+
+    def test_large_bursts_are_split_in_linear_time(self):
+        # Slicing each line off the front of the buffer takes quadratic
+        # time, i.e. 16 times longer for 4 times more data
+        small = min(split_burst(2 * 1024 * 1024) for i in range(3))
+        large = min(split_burst(8 * 1024 * 1024) for i in range(3))
+        assert large < small * 10
+
+
+class TestReadAvailable:
+
+    def test_reads_until_it_would_block(self):
+        r, w = os.pipe()
+        set_nonblocking(r)
+        os.write(w, b"a" * 50000)
+        assert read_available(r) == (b"a" * 50000, False)
+        assert read_available(r) == (b"", False)
+        os.write(w, b"end")
+        os.close(w)
+        assert read_available(r) == (b"end", True)
+        os.close(r)
+
+    def test_reads_are_limited_by_the_budget(self, monkeypatch):
+        monkeypatch.setattr(terminal, "READ_BUDGET", 10)
+        monkeypatch.setattr(terminal, "BUFSIZ", 4)
+        r, w = os.pipe()
+        set_nonblocking(r)
+        os.write(w, b"a" * 20)
+        assert read_available(r) == (b"a" * 12, False)
+        assert read_available(r) == (b"a" * 8, False)
+        os.close(r)
+        os.close(w)
+
+
+class TestInputQueue:
+
+    def make_recorder(self, fd, max_queued):
+        recorder = terminal.TerminalRecorder.__new__(terminal.TerminalRecorder)
+        recorder.returncode = None
+        recorder.child_fd = fd
+        recorder.input_queue = collections.deque()
+        recorder.input_queued = 0
+        recorder.max_input_queued = max_queued
+        recorder.pty_open = True
+        IOLoop.current().add_handler(fd, lambda fd, events: None,
+                                     IOLoop.READ)
+        return recorder
+
+    def test_input_is_queued_and_capped(self):
+        r, w = os.pipe()
+        set_nonblocking(r)
+        set_nonblocking(w)
+        recorder = self.make_recorder(w, 10)
+        # Fill the pipe, as if crawl stopped reading
+        while not recorder.input_queue:
+            assert recorder.write_input(b"x" * 3)
+
+        assert recorder.write_input(b"12345")
+        assert not recorder.write_input(b"x" * 10)
+
+        while read_available(r)[0]:
+            pass
+        recorder._write_queued_input()
+        assert not recorder.input_queue
+        assert recorder.input_queued == 0
+        assert read_available(r)[0].endswith(b"x12345")
+
+        IOLoop.current().remove_handler(w)
+        os.close(r)
+        os.close(w)
+
+
+class TestExit:
+
+    def test_remaining_output_is_read_at_exit(self):
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        for fd in (out_r, err_r):
+            set_nonblocking(fd)
+            IOLoop.current().add_handler(fd, lambda fd, events: None,
+                                         IOLoop.READ)
+        recorder = terminal.TerminalRecorder.__new__(terminal.TerminalRecorder)
+        recorder.returncode = None
+        recorder.child_fd = out_r
+        recorder.errpipe_read = err_r
+        recorder.pty_open = True
+        recorder.input_queue = collections.deque()
+        recorder.ttyrec = None
+        recorder.output_buffer = LineBuffer()
+        recorder.error_buffer = LineBuffer()
+        recorder.logger = logging.getLogger()
+        recorder.activity_callback = None
+        output = []
+        errors = []
+        recorder.output_callback = output.append
+        recorder.error_callback = errors.append
+        ended = []
+        recorder.end_callback = lambda: ended.append(errors[:])
+
+        # The process wrote its last words and exited before the IOLoop
+        # got to them
+        os.write(out_w, b"bye\n")
+        os.write(err_w, b"ERROR: We crashed!\n")
+        os.close(out_w)
+        os.close(err_w)
+        recorder._handle_exit(1 << 8)
+
+        assert recorder.returncode == 1
+        assert output == ["bye"]
+        assert ended == [["ERROR: We crashed!"]]
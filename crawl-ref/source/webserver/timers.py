@@ -0,0 +1,110 @@
+import collections
+import logging
+import math
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+try:
+    from typing import Any, Callable, DefaultDict, Dict, List, Optional
+except ImportError:
+    pass
+
+
+class Timer(object):
+    __slots__ = ("deadline", "callback", "kind")
+
+    def __init__(self, deadline, callback, kind):
+        # type: (float, Optional[Callable[[], Any]], str) -> None
+        self.deadline = deadline
+        self.callback = callback
+        self.kind = kind
+
+
+class TimerWheel(object):
+    """Runs coarse timeouts from a single periodic IOLoop callback.
+
+    Timers are put into buckets of `resolution` seconds, and each tick only
+    looks at the buckets that have become due, so scheduling and cancelling
+    are O(1) no matter how many timers there are. Timers fire up to one
+    resolution late, but never early. Meant for timeouts measured in seconds
+    (pings, idle checks, kill timeouts); use IOLoop.add_timeout for anything
+    that must be precise.
+    """
+    def __init__(self, resolution=1.0):  # type: (float) -> None
+        self.resolution = resolution
+        self.buckets = {}  # type: Dict[int, List[Timer]]
+        self.last_tick = int(time.time() / resolution)
+        self.periodic = None  # type: Optional[PeriodicCallback]
+        self.active = collections.defaultdict(int)  # type: DefaultDict[str, int]
+        self.fired = 0
+        self.sweeps = 0
+        self.lag = 0.0
+
+    def call_later(self, delay, callback, kind="other"):
+        # type: (float, Callable[[], Any], str) -> Timer
+        deadline = time.time() + delay
+        timer = Timer(deadline, callback, kind)
+        tick = max(int(math.ceil(deadline / self.resolution)),
+                   self.last_tick + 1)
+        self.buckets.setdefault(tick, []).append(timer)
+        self.active[kind] += 1
+        if self.periodic is None:
+            self.periodic = PeriodicCallback(self.sweep,
+                                             self.resolution * 1000)
+            self.periodic.start()
+        return timer
+
+    def cancel(self, timer):  # type: (Optional[Timer]) -> None
+        if timer is None or timer.callback is None:
+            return
+        # The timer stays in its bucket until the bucket comes due
+        timer.callback = None
+        self.active[timer.kind] -= 1
+
+    def every(self, interval, callback, kind="other"):
+        # type: (float, Callable[[], Any], str) -> None
+        """Runs callback every interval seconds, as part of the sweeps."""
+        def run():
+            self.call_later(interval, run, kind)
+            callback()
+        self.call_later(interval, run, kind)
+
+    def sweep(self):  # type: () -> None
+        now = time.time()
+        now_tick = int(now / self.resolution)
+        if now_tick - self.last_tick > len(self.buckets):
+            # After a long stall it's cheaper to look at the buckets that
+            # exist than at every tick that was missed
+            due = sorted(t for t in self.buckets if t <= now_tick)
+        else:
+            due = range(self.last_tick + 1, now_tick + 1)
+        self.last_tick = max(self.last_tick, now_tick)
+        self.sweeps += 1
+
+        for tick in due:
+            for timer in self.buckets.pop(tick, ()):
+                callback = timer.callback
+                if callback is None:
+                    continue
+                timer.callback = None
+                self.active[timer.kind] -= 1
+                self.fired += 1
+                self.lag = max(0.0, now - timer.deadline)
+                try:
+                    callback()
+                except Exception:
+                    logging.error("Exception in %s timer", timer.kind,
+                                  exc_info=True)
+
+    def stats(self):  # type: () -> Dict[str, Any]
+        return {
+            "active": dict(self.active),
+            "buckets": len(self.buckets),
+            "fired": self.fired,
+            "sweeps": self.sweeps,
+            "lag": self.lag,
+        }
+
+
+timer_wheel = TimerWheel()
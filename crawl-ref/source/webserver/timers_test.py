@@ -0,0 +1,64 @@
+import timers
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestTimerWheel:
+
+    def setup_method(self):
+        self.clock = FakeClock()
+        self.saved_time = timers.time
+        timers.time = self.clock
+        self.wheel = timers.TimerWheel()
+        self.fired = []
+
+    def teardown_method(self):
+        if self.wheel.periodic:
+            self.wheel.periodic.stop()
+        timers.time = self.saved_time
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.wheel.sweep()
+
+    def test_timers_fire_at_deadline_not_before(self):
+        self.wheel.call_later(2.5, lambda: self.fired.append("a"), "ping")
+
+        self.advance(2)
+        assert self.fired == []
+        assert self.wheel.active["ping"] == 1
+
+        self.advance(1)
+        assert self.fired == ["a"]
+        assert self.wheel.active["ping"] == 0
+
+    def test_cancelled_timers_dont_fire(self):
+        timer = self.wheel.call_later(1, lambda: self.fired.append("a"))
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+
+        self.advance(5)
+        assert self.fired == []
+        assert self.wheel.active["other"] == 0
+
+    def test_every_repeats(self):
+        self.wheel.every(10, lambda: self.fired.append("idle"), "idle")
+
+        for _ in range(3):
+            self.advance(10)
+        assert self.fired == ["idle"] * 3
+        assert self.wheel.active["idle"] == 1
+
+    def test_catches_up_after_stall(self):
+        self.wheel.call_later(1, lambda: self.fired.append("a"))
+        self.wheel.call_later(100, lambda: self.fired.append("b"))
+
+        self.advance(10000)
+        assert self.fired == ["a", "b"]
+        assert not self.wheel.buckets
@@ -0,0 +1,417 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None  # type: ignore
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # type: ignore
+
+from timers import timer_wheel
+
+try:
+    from typing import Any, List, Optional, Set, Tuple
+except ImportError:
+    pass
+
+# Linux's IOV_MAX
+MAX_IOVECS = 1024
+
+HEADER = struct.Struct("<iii")
+
+# The seek index is a sidecar file (the ttyrec's name plus .idx) of fixed
+# size entries: the offset of a frame, its time, and flags. Entries are
+# written for every keyframe, and otherwise every INDEX_INTERVAL seconds.
+INDEX_MAGIC = b"TTYIDX1\n"
+INDEX_ENTRY = struct.Struct("<QiiI")
+INDEX_INTERVAL = 10
+KEYFRAME = 1
+# Frames that clear the screen can be played without what came before them
+# (TERM=linux clears with ESC [ H ESC [ J)
+CLEAR_SCREEN = (b"\x1b[H\x1b[J", b"\x1b[2J")
+
+
+def frame_header(t, length):  # type: (float, int) -> bytes
+    return HEADER.pack(int(t), int((t % 1) * 1000000), length)
+
+
+def is_keyframe(data):  # type: (bytes) -> bool
+    return any(clear in data for clear in CLEAR_SCREEN)
+
+
+def index_entry(offset, t, flags):  # type: (int, float, int) -> bytes
+    return INDEX_ENTRY.pack(offset, int(t), int((t % 1) * 1000000), flags)
+
+
+def write_chunks(fd, chunks):  # type: (int, List[bytes]) -> None
+    """Writes all chunks to fd, with as few syscalls as possible."""
+    if not hasattr(os, "writev"):
+        data = b"".join(chunks)
+        while data:
+            data = data[os.write(fd, data):]
+        return
+    while chunks:
+        batch = chunks[:MAX_IOVECS]
+        written = os.writev(fd, batch)
+        # Skip over what was written, splitting a partially written chunk
+        i = 0
+        while i < len(batch) and written >= len(batch[i]):
+            written -= len(batch[i])
+            i += 1
+        chunks = chunks[i:]
+        if written:
+            chunks[0] = chunks[0][written:]
+
+
+class _GzipCompressor(object):
+    def __init__(self):  # type: () -> None
+        self.z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):  # type: (bytes) -> bytes
+        return self.z.compress(data)
+
+    def sync(self):  # type: () -> bytes
+        return self.z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):  # type: () -> bytes
+        return self.z.flush()
+
+
+class _XzCompressor(object):
+    # Higher presets use a lot more memory for every running game
+    preset = 1
+
+    def __init__(self):  # type: () -> None
+        self.c = lzma.LZMACompressor(preset=self.preset)
+
+    def compress(self, data):  # type: (bytes) -> bytes
+        return self.c.compress(data)
+
+    def sync(self):  # type: () -> bytes
+        # xz can't flush in the middle of a stream, so end it and start a
+        # new one; xz reads concatenated streams as one file.
+        data = self.c.flush()
+        self.c = lzma.LZMACompressor(preset=self.preset)
+        return data
+
+    def finish(self):  # type: () -> bytes
+        return self.c.flush()
+
+
+compressors = {"gz": _GzipCompressor}
+if lzma is not None:
+    compressors["xz"] = _XzCompressor
+
+
+class _WriterThread(threading.Thread):
+    """Does the disk writes for threaded TtyrecWriters, so that a slow disk
+    doesn't stall the IOLoop."""
+    def __init__(self, max_queued):  # type: (int) -> None
+        super(_WriterThread, self).__init__(name="ttyrec-writer")
+        self.daemon = True
+        self.queue = queue.Queue(max_queued)  # type: Any
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            writer, chunks, index_chunks, close, sync = task
+            try:
+                writer._write(chunks, close, sync, index_chunks)
+            except Exception:
+                # The thread must keep going: if it died, the IOLoop would
+                # block forever once the queue is full
+                writer.failed = True
+                writer.logger.error("Couldn't write ttyrec %s.",
+                                    writer.filename, exc_info=True)
+                if close:
+                    writer._close_fds()
+
+
+_writer_thread = None  # type: Optional[_WriterThread]
+
+
+def _get_writer_thread():  # type: () -> _WriterThread
+    global _writer_thread
+    if _writer_thread is None:
+        _writer_thread = _WriterThread(256)
+        _writer_thread.start()
+    return _writer_thread
+
+
+# Writers that haven't been closed yet
+_open_writers = set()  # type: Set[TtyrecWriter]
+
+
+def close_writers():  # type: () -> None
+    """Writes out and closes the ttyrecs of all games, e.g. at shutdown."""
+    for writer in list(_open_writers):
+        writer.close()
+
+
+def stop_writer_thread():  # type: () -> None
+    """Waits until everything queued has been written."""
+    global _writer_thread
+    if _writer_thread is not None:
+        _writer_thread.queue.put(None)
+        _writer_thread.join()
+        _writer_thread = None
+
+
+class TtyrecWriter(object):
+    """Writes a ttyrec, batching frames in memory.
+
+    Frames are timestamped when they are added, and written once
+    buffer_size bytes have piled up, flush_interval seconds after the first
+    unwritten frame, or when the writer is closed. With threaded, the writes
+    happen on a shared writer thread; the number of batches waiting for it
+    is bounded, so a disk that can't keep up eventually slows down the
+    server instead of filling its memory.
+
+    With compression ("gz" or "xz"), the file is compressed as it is
+    written. The compressed stream is synced at least every sync_interval
+    seconds, so that what has been written so far can be decompressed while
+    the game is still running.
+
+    With index, a seek index is written next to uncompressed ttyrecs.
+    """
+    def __init__(self, filename, buffer_size=65536, flush_interval=1.0,
+                 threaded=False, logger=None, compression=None,
+                 sync_interval=10.0, index=False):
+        # type: (str, int, float, bool, Any, Optional[str], float, bool) -> None
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0o666)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.threaded = threaded
+        self.logger = logger or logging.getLogger()
+        self.pending = []  # type: List[bytes]
+        self.pending_bytes = 0
+        self.flush_timer = None  # type: Any
+        self.closed = False
+        self.failed = False
+        self.compressor = None  # type: Any
+        if compression:
+            self.compressor = compressors[compression]()
+        self.sync_interval = sync_interval
+        self.sync_timer = None  # type: Any
+        # Offsets in a compressed file would be useless for seeking
+        self.index_fd = None  # type: Optional[int]
+        self.pending_index = []  # type: List[bytes]
+        self.offset = 0
+        self.last_index_time = None  # type: Optional[float]
+        if index and not compression:
+            try:
+                self.index_fd = os.open(filename + ".idx",
+                                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                        0o666)
+                self.pending_index.append(INDEX_MAGIC)
+            except OSError:
+                self.logger.warning("Couldn't create ttyrec index for %s.",
+                                    filename, exc_info=True)
+        _open_writers.add(self)
+
+    def write_frame(self, data, t=None):  # type: (bytes, Optional[float]) -> None
+        if self.closed:
+            return
+        if t is None:
+            t = time.time()
+        if self.index_fd is not None:
+            self._index_frame(data, t)
+        self.pending.append(frame_header(t, len(data)))
+        self.pending.append(data)
+        self.pending_bytes += 12 + len(data)
+        if self.pending_bytes >= self.buffer_size:
+            self.flush()
+        elif self.flush_timer is None and self.flush_interval:
+            self.flush_timer = timer_wheel.call_later(self.flush_interval,
+                                                      self._flush_timeout,
+                                                      "ttyrec")
+
+    def _index_frame(self, data, t):  # type: (bytes, float) -> None
+        flags = KEYFRAME if self.offset == 0 or is_keyframe(data) else 0
+        if (flags or self.last_index_time is None
+                or t - self.last_index_time >= INDEX_INTERVAL):
+            self.pending_index.append(index_entry(self.offset, t, flags))
+            self.last_index_time = t
+        self.offset += HEADER.size + len(data)
+
+    def _flush_timeout(self):  # type: () -> None
+        self.flush_timer = None
+        self.flush()
+
+    def _sync_timeout(self):  # type: () -> None
+        self.sync_timer = None
+        self.flush(sync=True)
+
+    def flush(self, close=False, sync=False):  # type: (bool, bool) -> None
+        timer_wheel.cancel(self.flush_timer)
+        self.flush_timer = None
+        chunks = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        index_chunks = self.pending_index
+        self.pending_index = []
+        if not chunks and not close and not sync:
+            return
+        if self.compressor:
+            if close or sync:
+                timer_wheel.cancel(self.sync_timer)
+                self.sync_timer = None
+            elif self.sync_timer is None:
+                self.sync_timer = timer_wheel.call_later(self.sync_interval,
+                                                         self._sync_timeout,
+                                                         "ttyrec")
+        if self.threaded:
+            _get_writer_thread().queue.put((self, chunks, index_chunks, close,
+                                            sync))
+        else:
+            self._write(chunks, close, sync, index_chunks)
+
+    def _write(self, chunks, close, sync=False, index_chunks=None):
+        # type: (List[bytes], bool, bool, Optional[List[bytes]]) -> None
+        if self.compressor and not self.failed:
+            data = self.compressor.compress(b"".join(chunks))
+            if close:
+                data += self.compressor.finish()
+            elif sync:
+                data += self.compressor.sync()
+            chunks = [data] if data else []
+        if not self.failed and chunks:
+            try:
+                write_chunks(self.fd, chunks)
+            except (OSError, IOError):
+                # Keep the game running, but stop recording it
+                self.failed = True
+                self.logger.error("Couldn't write ttyrec %s.", self.filename,
+                                  exc_info=True)
+        if self.index_fd is not None and not self.failed and index_chunks:
+            # Written after the frames, so that an entry never points past
+            # the end of the ttyrec
+            try:
+                write_chunks(self.index_fd, index_chunks)
+            except (OSError, IOError):
+                self.logger.warning("Couldn't write ttyrec index for %s.",
+                                    self.filename, exc_info=True)
+                os.close(self.index_fd)
+                self.index_fd = None
+        if close:
+            self._close_fds()
+
+    def _close_fds(self):  # type: () -> None
+        for fd in (self.fd, self.index_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.index_fd = None
+
+    def close(self):  # type: () -> None
+        if self.closed:
+            return
+        self.flush(close=True)
+        self.closed = True
+        _open_writers.discard(self)
+
+
+def read_index(filename):  # type: (str) -> Optional[List[Tuple[int, float, int]]]
+    """Reads a seek index as (offset, time, flags) entries; None if there is
+    no usable index."""
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    if not data.startswith(INDEX_MAGIC):
+        return None
+    entries = []
+    end = len(data) - (len(data) - len(INDEX_MAGIC)) % INDEX_ENTRY.size
+    for pos in range(len(INDEX_MAGIC), end, INDEX_ENTRY.size):
+        offset, sec, usec, flags = INDEX_ENTRY.unpack_from(data, pos)
+        entries.append((offset, sec + usec / 1000000.0, flags))
+    return entries
+
+
+class TtyrecReader(object):
+    """Random access to an uncompressed ttyrec.
+
+    The file is memory-mapped, so any number of readers of the same
+    recording share one copy of it in the page cache. Seeking uses the .idx
+    sidecar when there is one, and otherwise indexes the file once when it
+    is opened; entries from another reader of the file can be passed in
+    instead. Recordings that are still being written are read as far as
+    they went when they were opened.
+    """
+    def __init__(self, filename, entries=None):
+        # type: (str, Optional[List[Tuple[int, float, int]]]) -> None
+        with open(filename, "rb") as f:
+            # Raises ValueError for empty files
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        if entries is None:
+            entries = read_index(filename + ".idx")
+        if entries is None:
+            entries = self._scan()
+        # Can be passed to other readers of the same file
+        self.entries = entries
+        keyframes = [(t, offset) for offset, t, flags in entries
+                     if flags & KEYFRAME and offset < self.size]
+        self.keyframe_times = [t for t, offset in keyframes]
+        self.keyframe_offsets = [offset for t, offset in keyframes]
+
+        first = self.frame(0)
+        self.start_time = first[0] if first else 0.0
+        self.end_time = self.start_time
+        # The last entry is near the end; find the last frame from there
+        offset = entries[-1][0] if entries else 0
+        while True:
+            frame = self.frame(offset)
+            if frame is None:
+                break
+            self.end_time, data, offset = frame
+
+    def _scan(self):  # type: () -> List[Tuple[int, float, int]]
+        entries = []
+        offset = 0
+        while True:
+            frame = self.frame(offset)
+            if frame is None:
+                return entries
+            t, data, next_offset = frame
+            if offset == 0 or is_keyframe(data):
+                entries.append((offset, t, KEYFRAME))
+            offset = next_offset
+
+    def frame(self, offset):
+        # type: (int) -> Optional[Tuple[float, bytes, int]]
+        """Returns the time and data of the frame at offset, and the offset
+        of the next frame; None at the end of the recording."""
+        start = offset + HEADER.size
+        if start > self.size:
+            return None
+        sec, usec, length = HEADER.unpack_from(self.map, offset)
+        if length < 0 or start + length > self.size:
+            return None
+        return (sec + usec / 1000000.0, self.map[start:start + length],
+                start + length)
+
+    def seek(self, t):  # type: (float) -> int
+        """Returns the offset of the last keyframe at or before time t."""
+        i = bisect.bisect_right(self.keyframe_times, t)
+        return self.keyframe_offsets[i - 1] if i else 0
+
+    def close(self):  # type: () -> None
+        self.map.close()
@@ -0,0 +1,199 @@
+import gzip
+import struct
+import zlib
+
+import pytest
+
+import ttyrec
+
+
+def read_frames(path, decompress=None):
+    with open(path, "rb") as f:
+        data = f.read()
+    if decompress:
+        data = decompress(data)
+    frames = []
+    while data:
+        sec, usec, length = struct.unpack("<iii", data[:12])
+        frames.append((sec, usec, data[12:12 + length]))
+        data = data[12 + length:]
+    return frames
+
+
+class TestWriteChunks:
+
+    def test_partial_writes_are_resumed(self, monkeypatch):
+        written = []
+
+        def writev(fd, chunks):
+            # Write at most 3 bytes at a time
+            data = b"".join(chunks)[:3]
+            written.append(data)
+            return len(data)
+        monkeypatch.setattr(ttyrec.os, "writev", writev)
+
+        ttyrec.write_chunks(0, [b"ab", b"cdef", b"g"])
+
+        assert b"".join(written) == b"abcdefg"
+
+
+class TestTtyrecWriter:
+
+    def test_frames_are_buffered_until_flush(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec"))
+        writer = ttyrec.TtyrecWriter(path, flush_interval=0)
+        writer.write_frame(b"hello", 1000.25)
+        writer.write_frame(b"world", 1001.5)
+        assert read_frames(path) == []
+
+        writer.close()
+        assert read_frames(path) == [(1000, 250000, b"hello"),
+                                     (1001, 500000, b"world")]
+
+    def test_full_buffer_is_written(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec"))
+        writer = ttyrec.TtyrecWriter(path, buffer_size=20, flush_interval=0)
+        writer.write_frame(b"x" * 10, 1000)
+
+        assert len(read_frames(path)) == 1
+        writer.close()
+
+    def test_threaded_writes(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec"))
+        writer = ttyrec.TtyrecWriter(path, threaded=True, flush_interval=0)
+        for i in range(100):
+            writer.write_frame(b"%d" % i, 1000 + i)
+        writer.close()
+        ttyrec.stop_writer_thread()
+
+        frames = read_frames(path)
+        assert [f[2] for f in frames] == [b"%d" % i for i in range(100)]
+
+
+class TestCompression:
+
+    def test_gzip_file_is_complete_after_close(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec.gz"))
+        writer = ttyrec.TtyrecWriter(path, flush_interval=0,
+                                     compression="gz")
+        writer.write_frame(b"hello", 1000)
+        writer.write_frame(b"world", 1001)
+        writer.close()
+
+        assert read_frames(path, gzip.decompress) == [(1000, 0, b"hello"),
+                                                      (1001, 0, b"world")]
+
+    def test_synced_gzip_is_readable_in_progress(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec.gz"))
+        writer = ttyrec.TtyrecWriter(path, flush_interval=0,
+                                     compression="gz")
+        writer.write_frame(b"hello", 1000)
+        writer.flush(sync=True)
+
+        def decompress_partial(data):
+            return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+        assert read_frames(path, decompress_partial) == [(1000, 0, b"hello")]
+        writer.close()
+
+    def test_synced_xz_is_readable(self, tmpdir):
+        lzma = pytest.importorskip("lzma")
+        path = str(tmpdir.join("game.ttyrec.xz"))
+        writer = ttyrec.TtyrecWriter(path, flush_interval=0,
+                                     compression="xz")
+        writer.write_frame(b"hello", 1000)
+        writer.flush(sync=True)
+        assert read_frames(path, lzma.decompress) == [(1000, 0, b"hello")]
+
+        writer.write_frame(b"world", 1001)
+        writer.close()
+        assert read_frames(path, lzma.decompress) == [(1000, 0, b"hello"),
+                                                      (1001, 0, b"world")]
+
+
+class TestIndex:
+
+    def write_game(self, path):
+        writer = ttyrec.TtyrecWriter(path, flush_interval=0, index=True)
+        writer.write_frame(b"header", 1000)
+        writer.write_frame(b"a", 1001)
+        writer.write_frame(b"\x1b[H\x1b[Jscreen", 1050)
+        writer.write_frame(b"b", 1060)
+        writer.write_frame(b"c", 1075)
+        writer.close()
+
+    def test_index_has_keyframes_and_periodic_entries(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec"))
+        self.write_game(path)
+
+        entries = ttyrec.read_index(path + ".idx")
+        assert entries == [(0, 1000, ttyrec.KEYFRAME),
+                           (31, 1050, ttyrec.KEYFRAME),
+                           (55, 1060, 0),
+                           (68, 1075, 0)]
+
+    def test_reader_seeks_to_keyframes(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec"))
+        self.write_game(path)
+
+        reader = ttyrec.TtyrecReader(path)
+        assert (reader.start_time, reader.end_time) == (1000, 1075)
+        assert reader.seek(1049) == 0
+        assert reader.frame(reader.seek(1070))[1] == b"\x1b[H\x1b[Jscreen"
+        reader.close()
+
+    def test_reader_without_index(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec"))
+        self.write_game(path)
+        tmpdir.join("game.ttyrec.idx").remove()
+
+        reader = ttyrec.TtyrecReader(path)
+        assert reader.keyframe_offsets == [0, 31]
+        assert reader.end_time == 1075
+        reader.close()
+
+    def test_no_index_for_compressed_ttyrecs(self, tmpdir):
+        path = str(tmpdir.join("game.ttyrec.gz"))
+        writer = ttyrec.TtyrecWriter(path, compression="gz", index=True)
+        writer.close()
+        assert not tmpdir.join("game.ttyrec.gz.idx").exists()
+
+
+class TestShutdown:
+
+    def test_open_writers_are_closed(self, tmpdir):
+        plain = str(tmpdir.join("plain.ttyrec"))
+        compressed = str(tmpdir.join("game.ttyrec.gz"))
+        writers = [ttyrec.TtyrecWriter(plain, flush_interval=0),
+                   ttyrec.TtyrecWriter(compressed, flush_interval=0,
+                                       compression="gz", threaded=True)]
+        for writer in writers:
+            writer.write_frame(b"hello", 1000)
+
+        ttyrec.close_writers()
+        ttyrec.stop_writer_thread()
+
+        assert all(writer.closed for writer in writers)
+        assert read_frames(plain) == [(1000, 0, b"hello")]
+        # gzip.decompress fails on a stream that wasn't finished
+        assert read_frames(compressed, gzip.decompress) == [(1000, 0,
+                                                             b"hello")]
+        assert not ttyrec._open_writers
+
+    def test_writer_thread_survives_errors(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join("game.ttyrec"))
+        broken = ttyrec.TtyrecWriter(str(tmpdir.join("broken.ttyrec")),
+                                     threaded=True, flush_interval=0)
+
+        def fail(*args, **kwargs):
+            raise ValueError("disk on fire")
+        monkeypatch.setattr(broken, "_write", fail)
+        broken.write_frame(b"lost", 1000)
+        broken.close()
+
+        writer = ttyrec.TtyrecWriter(path, threaded=True, flush_interval=0)
+        writer.write_frame(b"hello", 1000)
+        writer.close()
+        ttyrec.stop_writer_thread()
+
+        assert broken.failed
+        assert read_frames(path) == [(1000, 0, b"hello")]
@@ -1,14 +1,18 @@
 import crypt
 import hashlib
 import logging
+import multiprocessing
 import os.path
 import random
 import re
+import signal
 import sqlite3
+import sys
 from base64 import urlsafe_b64encode
 
 from tornado.escape import to_unicode
 from tornado.escape import utf8
+from tornado.ioloop import IOLoop
 
 import config
 from config import crypt_algorithm
@@ -20,10 +24,110 @@ from util import send_email
 from util import validate_email_address
 
 try:
-    from typing import Any, Optional, Tuple, Union
+    from typing import Any, Callable, Optional, Tuple, Union
 except ImportError:
     pass
 
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None  # type: ignore
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    class BrokenProcessPool(Exception):  # type: ignore
+        pass
+
+
+# Password hashing and database access can take long enough to stall every
+# game, so the *_async functions below run them in worker processes. These
+# are processes rather than threads because crypt() holds the GIL.
+_executor = None  # type: Any
+_workers = 0
+
+# What the *_async functions report when the worker call failed
+SERVER_ERROR = "Server error, please try again later."
+
+
+def _init_worker():  # type: () -> None
+    # Leave shutdown signals to the webserver itself
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+
+
+def start_executor(workers):  # type: (int) -> None
+    """Starts the userdb worker pool; without it, calls run synchronously."""
+    global _executor, _workers
+    if workers <= 0 or concurrent is None:
+        return
+    _workers = workers
+    if sys.version_info >= (3, 7):
+        # Workers are started on first use, when the server has sockets,
+        # ptys and threads; forking it then would leak all of those into
+        # the workers (and can deadlock), so they come from a clean process
+        methods = multiprocessing.get_all_start_methods()
+        method = "forkserver" if "forkserver" in methods else "spawn"
+        _executor = concurrent.futures.ProcessPoolExecutor(
+                            max_workers=workers,
+                            mp_context=multiprocessing.get_context(method),
+                            initializer=_init_worker)
+    else:
+        _executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+
+def stop_executor():  # type: () -> None
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def _restart_executor():  # type: () -> None
+    logging.warning("User database worker pool is broken; restarting it.")
+    stop_executor()
+    start_executor(_workers)
+
+
+def _submit(func, *args):  # type: (Callable[..., Any], Any) -> Any
+    try:
+        return _executor.submit(func, *args)
+    except BrokenProcessPool:
+        _restart_executor()
+        return _executor.submit(func, *args)
+
+
+def _call_async(callback, error_result, func, *args):
+    # type: (Callable[[Any], None], Any, Callable[..., Any], Any) -> None
+    """Runs func(*args) in a worker and calls callback with the result, or
+    with error_result if the call failed."""
+    if _executor is None:
+        callback(func(*args))
+        return
+
+    def done(future):  # type: (Any) -> None
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error("Error in user database call %s.", func.__name__,
+                          exc_info=True)
+            if isinstance(e, BrokenProcessPool) and _executor is pool:
+                _restart_executor()
+            callback(error_result)
+            return
+        callback(result)
+
+    try:
+        future = _submit(func, *args)
+    except Exception:
+        # Not even a fresh pool works; don't keep the client waiting
+        logging.error("Couldn't start user database call %s; running it "
+                      "directly.", func.__name__, exc_info=True)
+        callback(func(*args))
+        return
+    pool = _executor
+    IOLoop.current().add_future(future, done)
+
 
 class crawl_db(object):
     # TODO: based on userdb; why doesn't this just keep the database open?
@@ -152,6 +256,16 @@ def user_passwd_match(username, passwd):  # type: (str, str) -> Optional[str]
         return None
 
 
+def user_passwd_match_async(username, passwd, callback):
+    # type: (str, str, Callable[[Optional[str]], None]) -> None
+    _call_async(callback, None, user_passwd_match, username, passwd)
+
+
+def get_user_info_async(username, callback):
+    # type: (str, Callable[[Optional[Tuple[int, str, int]]], None]) -> None
+    _call_async(callback, None, get_user_info, username)
+
+
 def ensure_user_db_exists():  # type: () -> None
     if os.path.exists(password_db):
         return
@@ -240,6 +354,12 @@ def register_user(username, passwd, email):  # type: (str, str, str) -> Optional
     return None
 
 
+def register_user_async(username, passwd, email, callback):
+    # type: (str, str, str, Callable[[Optional[str]], None]) -> None
+    _call_async(callback, SERVER_ERROR, register_user, username, passwd,
+                email)
+
+
 def change_email(user_id, email):  # type: (str, str) -> Optional[str]
     """Returns an error message or None on success."""
     result = validate_email_address(email)
@@ -253,6 +373,11 @@ def change_email(user_id, email):  # type: (str, str) -> Optional[str]
     return None
 
 
+def change_email_async(user_id, email, callback):
+    # type: (str, str, Callable[[Optional[str]], None]) -> None
+    _call_async(callback, SERVER_ERROR, change_email, user_id, email)
+
+
 def find_recovery_token(token):
     # type: (str) -> Union[Tuple[None, None, str], Tuple[int, str, Optional[str]]]
     """Returns tuple (userid, username, error)"""
@@ -313,6 +438,12 @@ def update_user_password_from_token(token, passwd):
     return username, token_error
 
 
+def update_user_password_from_token_async(token, passwd, callback):
+    # type: (str, str, Callable[[Tuple[Optional[str], Optional[str]]], None]) -> None
+    _call_async(callback, (None, SERVER_ERROR),
+                update_user_password_from_token, token, passwd)
+
+
 def send_forgot_password(email):  # type: (str) -> Tuple[bool, Optional[str]]
     """
     Returns:
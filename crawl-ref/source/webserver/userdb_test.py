@@ -0,0 +1,58 @@
+import os
+import time
+
+from tornado.ioloop import IOLoop
+
+import userdb
+
+
+def double(x):
+    return 2 * x
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+def die(x):
+    os._exit(1)
+
+
+def call(func, arg, error_result="failed"):
+    results = []
+    io_loop = IOLoop.current()
+
+    def callback(result):
+        results.append(result)
+        io_loop.stop()
+    userdb._call_async(callback, error_result, func, arg)
+    if not results:
+        timeout = io_loop.add_timeout(time.time() + 30, io_loop.stop)
+        io_loop.start()
+        io_loop.remove_timeout(timeout)
+    return results
+
+
+class TestWorkerPool:
+
+    def setup_method(self):
+        userdb.start_executor(1)
+
+    def teardown_method(self):
+        userdb.stop_executor()
+
+    def test_calls_run_in_the_pool(self):
+        assert call(double, 21) == [42]
+
+    def test_errors_are_reported_to_the_callback(self):
+        assert call(fail, 1) == ["failed"]
+
+    def test_broken_pool_is_restarted(self):
+        pool = userdb._executor
+        assert call(die, 1) == ["failed"]
+        assert userdb._executor is not pool
+        assert call(double, 2) == [4]
+
+
+def test_calls_run_directly_without_a_pool():
+    assert call(double, 1) == [2]
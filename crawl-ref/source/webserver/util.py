@@ -1,4 +1,5 @@
 import re
+import collections
 import logging
 import tornado.template
 import tornado.ioloop
@@ -10,7 +11,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 try:
-    from typing import Dict, Optional
+    from typing import Any, Dict, Optional
 except ImportError:
     pass
 
@@ -80,6 +81,63 @@ class FileTailer(object):
     def stop(self):
         self.scheduler.stop()
 
+class Throttle(object):
+    """Calls func at most once per window seconds.
+
+    The first call goes through immediately; any calls made during the
+    window are collapsed into a single call when it ends, unless satisfied()
+    is called before that."""
+    def __init__(self, func, window):
+        self.func = func
+        self.window = window
+        self.timeout = None
+        self.pending = False
+
+    def __call__(self):
+        if self.timeout is not None:
+            self.pending = True
+            return
+        self.func()
+        if self.window:
+            self.timeout = tornado.ioloop.IOLoop.current().add_timeout(
+                                time.time() + self.window, self._window_end)
+
+    def _window_end(self):
+        self.timeout = None
+        if self.pending:
+            self.pending = False
+            self()
+
+    def satisfied(self):
+        """Drops a pending call because what it asked for has happened; the
+        window stays in effect."""
+        self.pending = False
+
+    def cancel(self):
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+        self.pending = False
+
+    def stop(self):
+        """Drops a pending call; later calls go through immediately."""
+        self.cancel()
+        self.window = 0
+
+def write_buffer_size(stream):  # type: (Any) -> int
+    """Bytes written to a tornado IOStream that haven't reached the socket."""
+    buf = stream._write_buffer
+    if not buf:
+        return 0
+    # Tornado < 4.5 queues the chunks in a deque; later versions keep a
+    # running total, or a buffer object whose len() is its size
+    if isinstance(buf, collections.deque):
+        return sum(len(chunk) for chunk in buf)
+    size = getattr(stream, "_write_buffer_size", None)
+    if size is not None:
+        return size
+    return len(buf)
+
 def dgl_format_str(s, username, game_params):
     s = s.replace("%n", username)
 
@@ -0,0 +1,58 @@
+import util
+
+
+class TestThrottle:
+
+    def setup_method(self):
+        self.calls = 0
+
+    def call(self):
+        self.calls += 1
+
+    def test_calls_within_window_are_collapsed(self):
+        throttle = util.Throttle(self.call, 10)
+
+        throttle()
+        throttle()
+        throttle()
+        assert self.calls == 1
+
+        throttle._window_end()
+        assert self.calls == 2
+        throttle.cancel()
+
+    def test_window_without_calls_does_nothing(self):
+        throttle = util.Throttle(self.call, 10)
+
+        throttle()
+        throttle._window_end()
+        assert self.calls == 1
+
+    def test_stop_drops_pending_call(self):
+        throttle = util.Throttle(self.call, 10)
+        throttle()
+        throttle()
+
+        throttle.stop()
+        assert throttle.timeout is None
+        assert self.calls == 1
+
+        throttle()
+        throttle()
+        assert self.calls == 3
+
+    def test_satisfied_drops_pending_call(self):
+        throttle = util.Throttle(self.call, 10)
+        throttle()
+        throttle()
+        throttle.satisfied()
+        # The window still applies to later calls
+        throttle()
+        assert self.calls == 1
+        throttle._window_end()
+        assert self.calls == 2
+
+        throttle()
+        throttle.satisfied()
+        throttle._window_end()
+        assert self.calls == 2
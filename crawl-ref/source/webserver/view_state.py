@@ -0,0 +1,132 @@
+import collections
+import re
+
+from tornado.escape import json_decode
+from tornado.escape import json_encode
+
+try:
+    from typing import Dict
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+except ImportError:
+    pass
+
+# Crawl starts every full redraw (at startup and on spectator_joined) by
+# sending its version, followed by options, layout, player, map, menus and
+# so on.
+REDRAW_START = '{"msg":"version"'
+
+# Messages that restate a whole piece of the view; only the latest one per
+# type (and id, for text regions and cursors) is kept
+LATEST = frozenset(["version", "options", "layout", "game_client",
+                    "input_mode", "mouse_mode", "ui_state", "txt", "cursor",
+                    "text_cursor", "flash"])
+# Menus and other popups form a stack. Everything sent from a push until
+# the matching pop is dropped with the pop
+PUSH = frozenset(["menu", "ui-push"])
+POP = frozenset(["close_menu", "ui-pop"])
+CLEAR_MENUS = "close_all_menus"
+# Sent on redraws; its items are the pushes (and updates) of every open menu
+UI_STACK = "ui-stack"
+
+# Crawl writes "msg" first, and ids near the start
+_type_re = re.compile(r'\{"msg":"([^"]*)"')
+_id_re = re.compile(r'"id":("[^"]*"|-?\d+)')
+_map_clear = '"clear":true'
+
+
+class ViewStateCache(object):
+    """Keeps the state of the view crawl drew since its last full redraw.
+
+    Replaying it on a freshly loaded game client yields the same view as the
+    one the player and the other spectators have, so a new spectator can be
+    caught up without asking crawl to redraw for everyone.
+
+    Rather than every message, the cache keeps the latest one per key (see
+    LATEST) and the messages of the menus that are still open, starting from
+    the ui-stack of the last redraw, so its size follows what is on screen.
+    Incremental updates (map, player, message log) are kept in full; a map
+    message that clears the map starts that over. Once the cache exceeds
+    max_size bytes, it is dropped until the next full redraw. A max_size of
+    0 disables the cache.
+    """
+    def __init__(self, max_size):  # type: (int) -> None
+        self.max_size = max_size
+        self.entries = (
+            collections.OrderedDict())  # type: Dict[Tuple[str, Optional[str]], List[str]]
+        # One list of messages per open menu, innermost last
+        self.stack = []  # type: List[List[str]]
+        self.size = 0
+        self.valid = False
+
+    def add(self, msg):  # type: (str) -> None
+        if msg.startswith(REDRAW_START):
+            self.invalidate()
+            self.valid = self.max_size > 0
+        if not self.valid:
+            return
+        match = _type_re.match(msg)
+        msg_type = match.group(1) if match else ""
+        if msg_type == UI_STACK:
+            self._set_stack(msg)
+            return
+        elif msg_type in PUSH:
+            self.stack.append([msg])
+        elif msg_type in POP:
+            if self.stack:
+                self.size -= sum(len(m) for m in self.stack.pop())
+            return
+        elif msg_type == CLEAR_MENUS:
+            for group in self.stack:
+                self.size -= sum(len(m) for m in group)
+            self.stack = []
+            return
+        elif self.stack and msg_type.startswith(("menu", "update_menu", "ui-")):
+            self.stack[-1].append(msg)
+        elif msg_type in LATEST or (msg_type == "map" and
+                                    _map_clear in msg[:100]):
+            key = (msg_type, None)  # type: Tuple[str, Optional[str]]
+            if msg_type != "map":
+                id_match = _id_re.search(msg, 0, 100)
+                key = (msg_type, id_match.group(1) if id_match else None)
+            # Replaced in place: options and layout must stay ahead of the
+            # map and player
+            old = self.entries.get(key, [])
+            self.size -= sum(len(m) for m in old)
+            self.entries[key] = [msg]
+        else:
+            self.entries.setdefault((msg_type, None), []).append(msg)
+        self.size += len(msg)
+        if self.size > self.max_size:
+            self.invalidate()
+
+    def _set_stack(self, msg):  # type: (str) -> None
+        for group in self.stack:
+            self.size -= sum(len(m) for m in group)
+        self.stack = []
+        for item in json_decode(msg).get("items", []):
+            encoded = json_encode(item)
+            if item.get("msg") in PUSH or not self.stack:
+                self.stack.append([encoded])
+            else:
+                self.stack[-1].append(encoded)
+            self.size += len(encoded)
+        if self.size > self.max_size:
+            self.invalidate()
+
+    def invalidate(self):  # type: () -> None
+        self.entries = collections.OrderedDict()
+        self.stack = []
+        self.size = 0
+        self.valid = False
+
+    def snapshot(self):  # type: () -> Optional[List[str]]
+        if not self.valid:
+            return None
+        messages = []  # type: List[str]
+        for group in self.entries.values():
+            messages.extend(group)
+        for group in self.stack:
+            messages.extend(group)
+        return messages
@@ -0,0 +1,160 @@
+from tornado.escape import json_decode
+
+import view_state
+
+
+class TestViewStateCache:
+
+    def test_no_snapshot_before_first_redraw(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"map"}')
+
+        assert cache.snapshot() is None
+
+    def test_snapshot_starts_at_last_redraw(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"map","n":1}')
+        cache.add('{"msg":"version","text":"b"}')
+        cache.add('{"msg":"map","n":2}')
+
+        assert cache.snapshot() == ['{"msg":"version","text":"b"}',
+                                    '{"msg":"map","n":2}']
+
+    def test_dropped_when_too_large_until_next_redraw(self):
+        cache = view_state.ViewStateCache(60)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"map","cells":"' + "x" * 40 + '"}')
+        assert cache.snapshot() is None
+
+        cache.add('{"msg":"map","n":1}')
+        assert cache.snapshot() is None
+
+        cache.add('{"msg":"version","text":"a"}')
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}']
+
+    def test_disabled_with_zero_size(self):
+        cache = view_state.ViewStateCache(0)
+        cache.add('{"msg":"version","text":"a"}')
+
+        assert cache.snapshot() is None
+
+    def test_only_latest_message_per_key_is_kept(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"txt","id":"crt","lines":1}')
+        cache.add('{"msg":"txt","id":"stats","lines":2}')
+        cache.add('{"msg":"input_mode","mode":1}')
+        cache.add('{"msg":"txt","id":"crt","lines":3}')
+        cache.add('{"msg":"input_mode","mode":0}')
+
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}',
+                                    '{"msg":"txt","id":"crt","lines":3}',
+                                    '{"msg":"txt","id":"stats","lines":2}',
+                                    '{"msg":"input_mode","mode":0}']
+
+    def test_closed_menus_are_dropped(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"menu","tag":"inventory"}')
+        cache.add('{"msg":"update_menu_items","items":1}')
+        cache.add('{"msg":"ui-push","type":"describe-item"}')
+        cache.add('{"msg":"map","cells":1}')
+        cache.add('{"msg":"ui-state","scroll":2}')
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}',
+                                    '{"msg":"map","cells":1}',
+                                    '{"msg":"menu","tag":"inventory"}',
+                                    '{"msg":"update_menu_items","items":1}',
+                                    '{"msg":"ui-push","type":"describe-item"}',
+                                    '{"msg":"ui-state","scroll":2}']
+
+        cache.add('{"msg":"ui-pop"}')
+        assert cache.snapshot()[-1] == '{"msg":"update_menu_items","items":1}'
+
+        cache.add('{"msg":"menu","tag":"spells"}')
+        cache.add('{"msg":"close_all_menus"}')
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}',
+                                    '{"msg":"map","cells":1}']
+        assert cache.size == sum(len(m) for m in cache.snapshot())
+
+    def test_map_clear_starts_map_over(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"player","hp":10}')
+        cache.add('{"msg":"map","cells":1}')
+        cache.add('{"msg":"map","cells":2}')
+        cache.add('{"msg":"player","hp":9}')
+        cache.add('{"msg":"map","clear":true,"cells":3}')
+        cache.add('{"msg":"map","cells":4}')
+
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}',
+                                    '{"msg":"player","hp":10}',
+                                    '{"msg":"player","hp":9}',
+                                    '{"msg":"map","clear":true,"cells":3}',
+                                    '{"msg":"map","cells":4}']
+
+    def test_replaced_messages_keep_their_place(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"layout","w":1}')
+        cache.add('{"msg":"map","cells":1}')
+        cache.add('{"msg":"layout","w":2}')
+
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}',
+                                    '{"msg":"layout","w":2}',
+                                    '{"msg":"map","cells":1}']
+
+    def test_redraw_ui_stack_is_the_menu_stack(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"ui-stack","items":[{"msg":"menu","tag":"inv"},'
+                  '{"msg":"ui-push","type":"x"},{"msg":"ui-state","n":1}]}')
+        assert [json_decode(m) for m in cache.snapshot()[1:]] == [
+            {"msg": "menu", "tag": "inv"},
+            {"msg": "ui-push", "type": "x"},
+            {"msg": "ui-state", "n": 1}]
+        assert cache.size == sum(len(m) for m in cache.snapshot())
+
+        cache.add('{"msg":"ui-pop"}')
+        assert [json_decode(m) for m in cache.snapshot()[1:]] == [
+            {"msg": "menu", "tag": "inv"}]
+
+        cache.add('{"msg":"close_menu"}')
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}']
+
+    def test_closed_redraw_menus_stay_closed(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"ui-stack","items":[{"msg":"menu","tag":"inv"}]}')
+        cache.add('{"msg":"close_all_menus"}')
+        cache.add('{"msg":"ui-stack","items":[]}')
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}']
+        assert cache.size == len('{"msg":"version","text":"a"}')
+
+    def test_repeated_updates_stay_within_size(self):
+        cache = view_state.ViewStateCache(200)
+        cache.add('{"msg":"version","text":"a"}')
+        for i in range(1000):
+            cache.add('{"msg":"menu","tag":"inventory"}')
+            cache.add('{"msg":"txt","id":"crt","lines":%d}' % i)
+            cache.add('{"msg":"close_menu"}')
+        assert cache.snapshot() == ['{"msg":"version","text":"a"}',
+                                    '{"msg":"txt","id":"crt","lines":999}']
+
+        # Incremental updates still overflow
+        for i in range(10):
+            cache.add('{"msg":"map","cells":%d}' % i)
+        assert cache.snapshot() is None
+        assert cache.size == 0
+
+    def test_invalidated_until_next_redraw(self):
+        cache = view_state.ViewStateCache(1000)
+        cache.add('{"msg":"version","text":"a"}')
+        cache.add('{"msg":"menu","tag":"inventory"}')
+        cache.invalidate()
+        cache.add('{"msg":"txt","id":"crt","lines":1}')
+        assert cache.snapshot() is None
+
+        cache.add('{"msg":"version","text":"b"}')
+        cache.add('{"msg":"close_menu"}')
+        assert cache.snapshot() == ['{"msg":"version","text":"b"}']
@@ -1,4 +1,4 @@
-from tornado.escape import json_encode, json_decode, utf8, to_unicode
+from tornado.escape import json_encode, json_decode, utf8, to_unicode, xhtml_escape
 import tornado.websocket
 import tornado.ioloop
 from tornado.ioloop import IOLoop
@@ -11,20 +11,31 @@ import signal
 import time, datetime
 import codecs
 import random
-import zlib
 
 import auth
 import config
 import checkoutput
+import metrics
 import userdb
+from broadcast import new_compressobj, compress_frame
+from timers import timer_wheel
 from util import *
 
 try:
-    from typing import Dict, Set, Tuple, Any, Union, Optional
+    from typing import Dict, Iterable, List, Set, Tuple, Any, Union, Optional
 except:
     pass
 
 sockets = set() # type: Set[CrawlWebSocket]
+# Indexes over the sockets in `sockets`, kept up to date by reindex_socket
+# whenever a socket is added or removed, or changes state or username.
+sockets_by_state = {
+    "lobby": set(),
+    "playing": set(),
+    "watching": set(),
+    } # type: Dict[str, Set[CrawlWebSocket]]
+lobby_sockets = sockets_by_state["lobby"]
+sockets_by_user = dict() # type: Dict[str, Set[CrawlWebSocket]]
 current_id = 0
 shutting_down = False
 rand = random.SystemRandom()
@@ -35,28 +46,108 @@ def shutdown():
     for socket in list(sockets):
         socket.shutdown()
 
+def add_socket(socket):
+    sockets.add(socket)
+    reindex_socket(socket)
+
+def remove_socket(socket):
+    sockets.remove(socket)
+    reindex_socket(socket)
+
+def reindex_socket(socket):
+    old_state, old_user = socket.index_key
+    if old_state is not None:
+        sockets_by_state[old_state].discard(socket)
+    if old_user is not None:
+        user_sockets = sockets_by_user[old_user]
+        user_sockets.discard(socket)
+        if not user_sockets:
+            del sockets_by_user[old_user]
+
+    if socket in sockets:
+        state = socket.state()
+        user = socket.username.lower() if socket.username else None
+        sockets_by_state[state].add(socket)
+        if user is not None:
+            sockets_by_user.setdefault(user, set()).add(socket)
+        socket.index_key = (state, user)
+    else:
+        socket.index_key = (None, None)
+
 def update_global_status():
     write_dgl_status_file()
 
+# Lobby updates are collected per game and sent out in one batch per lobby
+# client every lobby_update_rate seconds, instead of one message per event.
+lobby_updates = dict() # type: Dict[int, Any]
+lobby_removals = set() # type: Set[int]
+lobby_flush_timeout = None
+
 def update_all_lobbys(game):
-    lobby_entry = game.lobby_entry()
-    for socket in list(sockets):
-        if socket.is_in_lobby():
-            socket.send_message("lobby_entry", **lobby_entry)
+    lobby_updates[game.id] = game
+    schedule_lobby_flush()
+
 def remove_in_lobbys(process):
-    for socket in list(sockets):
-        if socket.is_in_lobby():
-            socket.send_message("lobby_remove", id=process.id)
+    lobby_updates.pop(process.id, None)
+    lobby_removals.add(process.id)
+    schedule_lobby_flush()
+
+def schedule_lobby_flush():
+    global lobby_flush_timeout
+    if lobby_flush_timeout is not None:
+        return
+    rate = getattr(config, "lobby_update_rate", 1)
+    if rate <= 0:
+        flush_lobby_updates()
+        return
+    # Not pushed back by further updates, so a busy server still refreshes
+    # the lobby at least once per interval.
+    lobby_flush_timeout = IOLoop.current().add_timeout(time.time() + rate,
+                                                       flush_lobby_updates)
+
+def flush_lobby_updates():
+    global lobby_flush_timeout
+    lobby_flush_timeout = None
+    if not lobby_updates and not lobby_removals:
+        return
+    # Entries are built at flush time, so they carry the latest state
+    messages = [encode_message("lobby_entry", **game.lobby_entry())
+                for game in lobby_updates.values()]
+    messages += [encode_message("lobby_remove", id=game_id)
+                 for game_id in lobby_removals]
+    lobby_updates.clear()
+    lobby_removals.clear()
+
+    metrics.lobby_flushes.inc()
+    metrics.lobby_messages.inc(len(messages) * len(lobby_sockets))
+
+    for socket in list(lobby_sockets):
+        for msg in messages:
+            socket.append_message(msg, False)
+        socket.flush_messages()
 
 def global_announce(text):
-    for socket in list(sockets):
-        socket.send_announcement(text)
+    encoded = encode_message("server_announcement", text=text)
+    for socket in list(sockets_by_state["playing"] |
+                       sockets_by_state["watching"]):
+        socket.send_announcement(text, encoded)
+
+def encode_message(msg, **data): # type: (str, Any) -> str
+    data["msg"] = msg
+    return json_encode(data)
+
+def broadcast_message(receivers, msg, **data):
+    # type: (Iterable[CrawlWebSocket], str, Any) -> None
+    """Sends the same message to many sockets, encoding it only once."""
+    encoded = encode_message(msg, **data)
+    for socket in receivers:
+        socket.append_message(encoded, True)
 
 def write_dgl_status_file():
     f = None
     try:
         f = open(config.dgl_status_file, "w")
-        for socket in list(sockets):
+        for socket in list(sockets_by_state["playing"]):
             if socket.username and socket.is_running():
                 f.write("%s#%s#%s#0x0#%s#%s#\n" %
                         (socket.username, socket.game_id,
@@ -74,17 +165,73 @@ def status_file_timeout():
                                  status_file_timeout)
 
 def find_user_sockets(username):
-    for socket in list(sockets):
-        if socket.username and socket.username.lower() == username.lower():
-            yield socket
+    for socket in list(sockets_by_user.get(username.lower(), ())):
+        yield socket
 
 def find_running_game(charname, start):
-    from process_handler import processes
-    for process in list(processes.values()):
-        if (process.where.get("name") == charname and
-            process.where.get("start") == start):
-            return process
-    return None
+    from process_handler import processes_by_char
+    return processes_by_char.get((charname.lower(), start))
+
+# Results of -print-webtiles-options, keyed by game id, player and the rc
+# file used (the spectator's). Entries are only valid for the rc file and
+# crawl binary mtimes they were generated with.
+json_options_cache = dict() # type: Dict[Tuple[str, str, str], Tuple[Any, str, int]]
+# Callbacks waiting for a crawl -print-webtiles-options run that is in flight
+json_options_pending = dict() # type: Dict[Tuple[Any, ...], List[Any]]
+max_json_options_cache_size = 1000
+# How often (in seconds) a spectator's outbound backlog is measured
+backlog_check_interval = 0.1
+
+def get_json_options(game_id, player_name, rcfile, callback):
+    game = config.games[game_id]
+    key = (game_id, player_name, rcfile)
+    try:
+        stamp = (os.path.getmtime(rcfile),
+                 os.path.getmtime(game["crawl_binary"]))
+    except OSError:
+        stamp = None
+
+    cached = json_options_cache.get(key)
+    if stamp is not None and cached is not None and cached[0] == stamp:
+        callback(cached[1], cached[2])
+        return
+
+    pending_key = key + (stamp,)
+    if pending_key in json_options_pending:
+        json_options_pending[pending_key].append(callback)
+        return
+    json_options_pending[pending_key] = [callback]
+
+    def done(data, returncode):
+        # returncode 1 means an old crawl without the option, which won't
+        # change either
+        if stamp is not None and returncode in (0, 1):
+            if len(json_options_cache) >= max_json_options_cache_size:
+                json_options_cache.clear()
+            json_options_cache[key] = (stamp, data, returncode)
+        for waiting in json_options_pending.pop(pending_key):
+            try:
+                waiting(data, returncode)
+            except Exception:
+                logging.warning("Error in json options callback.",
+                                exc_info=True)
+
+    call = [game["crawl_binary"]]
+
+    if "pre_options" in game:
+        call += game["pre_options"]
+
+    call += ["-name", player_name,
+             "-rc", rcfile]
+    if "options" in game:
+        call += game["options"]
+    call.append("-print-webtiles-options")
+
+    try:
+        checkoutput.check_output(call, done)
+    except Exception:
+        del json_options_pending[pending_key]
+        raise
 
 milestone_file_tailers = []
 def start_reading_milestones():
@@ -117,12 +264,13 @@ def admin_required(f):
 class CrawlWebSocket(tornado.websocket.WebSocketHandler):
     def __init__(self, app, req, **kwargs):
         tornado.websocket.WebSocketHandler.__init__(self, app, req, **kwargs)
-        self.username = None
+        self._username = None
         self.user_id = None
         self.user_email = None
         self.timeout = None
-        self.watched_game = None
-        self.process = None
+        self._watched_game = None
+        self._process = None
+        self.index_key = (None, None) # type: Tuple[Optional[str], Optional[str]]
         self.game_id = None
         self.received_pong = None
 
@@ -133,13 +281,19 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
         current_id += 1
 
         self.deflate = True
-        self._compressobj = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                                             zlib.DEFLATED,
-                                             -zlib.MAX_WBITS)
+        self._compressobj = new_compressobj()
+        self.broadcast = None
         self.total_message_bytes = 0
         self.compressed_bytes_sent = 0
         self.uncompressed_bytes_sent = 0
         self.message_queue = []  # type: List[str]
+        self.game_output_queued = False
+        self.flush_timeout = None
+        self.dropping_game_output = False
+        # Bytes written since the write buffer was last measured, plus what
+        # it held then; an upper bound of the backlog
+        self.bytes_in_flight = 0
+        self.backlog_checked = 0.0
 
         self.subprotocol = None
 
@@ -177,6 +331,22 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
 
     client_closed = property(lambda self: (not self.ws_connection) or self.ws_connection.client_terminated)
 
+    # Setting any of these moves the socket between the lobby/user indexes
+    def _set_username(self, username):
+        self._username = username
+        reindex_socket(self)
+    username = property(lambda self: self._username, _set_username)
+
+    def _set_process(self, process):
+        self._process = process
+        reindex_socket(self)
+    process = property(lambda self: self._process, _set_process)
+
+    def _set_watched_game(self, game):
+        self._watched_game = game
+        reindex_socket(self)
+    watched_game = property(lambda self: self._watched_game, _set_watched_game)
+
     def _process_log_msg(self, msg, kwargs):
         return "#%-5s %s" % (self.id, msg), kwargs
 
@@ -213,7 +383,7 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
                          self.request.remote_ip,
                          self.ws_connection.stream.socket.fileno(),
                          compression)
-        sockets.add(self)
+        add_socket(self)
 
         self.reset_timeout()
 
@@ -243,6 +413,13 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
     def is_in_lobby(self):
         return not self.is_running() and self.watched_game is None
 
+    def state(self):
+        if self.is_running():
+            return "playing"
+        elif self.watched_game is not None:
+            return "watching"
+        return "lobby"
+
     def send_lobby(self):
         self.queue_message("lobby_clear")
         from process_handler import processes
@@ -250,11 +427,13 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
             self.queue_message("lobby_entry", **process.lobby_entry())
         self.send_message("lobby_complete")
 
-    def send_announcement(self, text):
+    def send_announcement(self, text, encoded=None):
         # TODO: something in lobby?
         if not self.is_in_lobby():
             # show in chat window
-            self.send_message("server_announcement", text=text)
+            if encoded is None:
+                encoded = encode_message("server_announcement", text=text)
+            self.append_message(encoded, True)
             # show in player message window
             if self.is_running():
                 self.process.handle_announcement(text)
@@ -269,14 +448,12 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
         self.send_message("set_game_links", content = play_html)
 
     def reset_timeout(self):
-        if self.timeout:
-            IOLoop.current().remove_timeout(self.timeout)
+        timer_wheel.cancel(self.timeout)
 
         self.received_pong = False
         self.send_message("ping")
-        self.timeout = IOLoop.current().add_timeout(
-                                        time.time() + config.connection_timeout,
-                                        self.check_connection)
+        self.timeout = timer_wheel.call_later(config.connection_timeout,
+                                              self.check_connection, "ping")
 
     def check_connection(self):
         self.timeout = None
@@ -356,7 +533,7 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
         self.process = None
 
         if self.client_closed:
-            sockets.remove(self)
+            remove_socket(self)
         else:
             if shutting_down:
                 self.close()
@@ -406,6 +583,7 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
                                     self.watched_game.username)
             self.watched_game.remove_watcher(self)
             self.watched_game = None
+            self.dropping_game_output = False
 
     def shutdown(self):
         if not self.client_closed:
@@ -417,9 +595,17 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
             self.process.stop()
 
     def do_login(self, username):
-        self.username = username
-        self.user_id, self.user_email, self.user_flags = userdb.get_user_info(username)
-        self.logger.extra["username"] = username
+        def user_info_callback(user_info):
+            if self.client_closed:
+                return
+            if user_info is None:
+                self.logger.warning("Couldn't load user info for %s.", username)
+                self.send_message("login_fail")
+                return
+            self.username = username
+            self.user_id, self.user_email, self.user_flags = user_info
+            self.logger.extra["username"] = username
+            self.init_user(login_callback)
 
         def login_callback(result):
             success = result == 0
@@ -437,21 +623,25 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
             self.queue_message("login_success", username=username,
                                admin=self.is_admin())
             if self.watched_game:
-                self.watched_game.update_watcher_description()
+                self.watched_game.update_watcher(self)
             else:
                 self.send_game_links()
 
-        self.init_user(login_callback)
+        userdb.get_user_info_async(username, user_info_callback)
 
     def login(self, username, password):
-        real_username = userdb.user_passwd_match(username, password)
-        if real_username:
-            self.logger.info("User %s logging in from %s.",
-                                        real_username, self.request.remote_ip)
-            self.do_login(real_username)
-        else:
-            self.logger.warning("Failed login for user %s.", username)
-            self.send_message("login_fail")
+        def login_callback(real_username):
+            if self.client_closed:
+                return
+            if real_username:
+                self.logger.info("User %s logging in from %s.",
+                                 real_username, self.request.remote_ip)
+                self.do_login(real_username)
+            else:
+                self.logger.warning("Failed login for user %s.", username)
+                self.send_message("login_fail")
+
+        userdb.user_passwd_match_async(username, password, login_callback)
 
     def token_login(self, cookie):
         username, ok = auth.check_login_cookie(cookie)
@@ -527,26 +717,15 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
         if not "send_json_options" in game or not game["send_json_options"]:
             return
 
-        call = [game["crawl_binary"]]
-
-        if "pre_options" in game:
-            call += game["pre_options"]
-
-        call += ["-name", player_name,
-                 "-rc", self.rcfile_path(game_id)]
-        if "options" in game:
-            call += game["options"]
-        call.append("-print-webtiles-options")
-
-        checkoutput.check_output(call, do_send)
+        get_json_options(game_id, player_name, self.rcfile_path(game_id),
+                         do_send)
 
     def watch(self, username):
         if self.is_running():
             self.process.stop()
 
-        from process_handler import processes
-        procs = [process for process in list(processes.values())
-                 if process.username.lower() == username.lower()]
+        from process_handler import find_user_processes
+        procs = find_user_processes(username)
         if len(procs) >= 1:
             process = procs[0]
             if self.watched_game:
@@ -582,14 +761,19 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
                 receiver.handle_chat_message(self.username, text)
 
     def register(self, username, password, email):
-        error = userdb.register_user(username, password, email)
-        if error is None:
-            self.logger.info("Registered user %s.", username)
-            self.do_login(username)
-        else:
-            self.logger.info("Registration attempt failed for username %s: %s",
-                             username, error)
-            self.send_message("register_fail", reason = error)
+        def register_callback(error):
+            if self.client_closed:
+                return
+            if error is None:
+                self.logger.info("Registered user %s.", username)
+                self.do_login(username)
+            else:
+                self.logger.info("Registration attempt failed for username %s: %s",
+                                 username, error)
+                self.send_message("register_fail", reason = error)
+
+        userdb.register_user_async(username, password, email,
+                                   register_callback)
 
     def start_change_email(self):
         self.send_message("start_change_email", email = self.user_email)
@@ -598,14 +782,28 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
         if self.username is None:
             self.send_message("change_email_fail", reason = "You need to log in to change your email")
             return
-        error = userdb.change_email(self.user_id, email)
-        if error is None:
-            self.user_id, self.user_email, self.user_flags = userdb.get_user_info(self.username)
+
+        def user_info_callback(user_info):
+            if self.client_closed or self.username is None:
+                return
+            if user_info is None:
+                self.send_message("change_email_fail",
+                                  reason = userdb.SERVER_ERROR)
+                return
+            self.user_id, self.user_email, self.user_flags = user_info
             self.logger.info("User %s changed email to %s.", self.username, email if email else "null")
             self.send_message("change_email_done", email = email)
-        else:
-            self.logger.info("Failed to change username for %s: %s", self.username, error)
-            self.send_message("change_email_fail", reason = error)
+
+        def change_email_callback(error):
+            if self.client_closed or self.username is None:
+                return
+            if error is None:
+                userdb.get_user_info_async(self.username, user_info_callback)
+            else:
+                self.logger.info("Failed to change username for %s: %s", self.username, error)
+                self.send_message("change_email_fail", reason = error)
+
+        userdb.change_email_async(self.user_id, email, change_email_callback)
 
     def forgot_password(self, email):
         if not getattr(config, "allow_password_reset", False):
@@ -626,20 +824,26 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
     def reset_password(self, token, password):
         if not getattr(config, "allow_password_reset", False):
             return
-        username, error = userdb.update_user_password_from_token(token,
-                                                                 password)
-        if error is None:
-            self.logger.info("User %s has completed their password reset.",
-                             username)
-            self.send_message("reload_url")
-        else:
-            if username is None:
-                self.logger.info("Failed to update password for token %s: %s",
-                                 token, error)
+
+        def reset_callback(result):
+            username, error = result
+            if error is None:
+                self.logger.info("User %s has completed their password reset.",
+                                 username)
+                if not self.client_closed:
+                    self.send_message("reload_url")
             else:
-                self.logger.info("Failed to update password for user %s: %s",
-                                 username, error)
-            self.send_message("reset_password_fail", reason = error)
+                if username is None:
+                    self.logger.info("Failed to update password for token %s: %s",
+                                     token, error)
+                else:
+                    self.logger.info("Failed to update password for user %s: %s",
+                                     username, error)
+                if not self.client_closed:
+                    self.send_message("reset_password_fail", reason = error)
+
+        userdb.update_user_password_from_token_async(token, password,
+                                                     reset_callback)
 
     def go_lobby(self):
         if not config.dgl_mode: return
@@ -655,6 +859,22 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
     def go_admin(self):
         self.go_lobby()
         self.send_message("go_admin")
+        if self.is_admin():
+            self.send_latency_report()
+
+    def send_latency_report(self):
+        from process_handler import processes
+        self.queue_message("admin_log", text="Input latency, all games: " +
+                           metrics.input_latency.summary())
+        self.queue_message("admin_log", text="Crawl response, all games: " +
+                           metrics.crawl_response_latency.summary())
+        for process in list(processes.values()):
+            if process.input_latency.count == 0:
+                continue
+            self.queue_message("admin_log", text="Input latency, %s (P%s): %s"
+                               % (xhtml_escape(process.username), process.id,
+                                  process.input_latency.summary()))
+        self.flush_messages()
 
     def get_rc(self, game_id):
         if game_id not in config.games: return
@@ -671,6 +891,8 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
             f.write(utf8(contents))
 
     def on_message(self, message): # type: (Union[str, bytes]) -> None
+        metrics.messages_received.inc()
+        metrics.bytes_received.inc(len(utf8(message)))
         try:
             obj = json_decode(message) # type: Dict[str, Any]
             if obj["msg"] in self.message_handlers:
@@ -689,63 +911,205 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
 
     def flush_messages(self):
         # type: () -> Optional[tornado.concurrent.Future[None]]
+        if self.flush_timeout is not None:
+            IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
         if self.client_closed or len(self.message_queue) == 0:
             return None
         msg = ("{\"msgs\":["
                 + ",".join(self.message_queue)
                 + "]}")
+        message_count = len(self.message_queue)
         self.message_queue = []
+        game_output = self.game_output_queued
+        self.game_output_queued = False
 
         try:
             binmsg = utf8(msg)
             self.total_message_bytes += len(binmsg)
-            if self.deflate:
-                # Compress like in deflate-frame extension:
-                # Apply deflate, flush, then remove the 00 00 FF FF
-                # at the end
-                compressed = self._compressobj.compress(binmsg)
-                compressed += self._compressobj.flush(zlib.Z_SYNC_FLUSH)
-                compressed = compressed[:-4]
+            # While we take part in a shared game stream, the client's
+            # inflater belongs to that stream, so private messages go out
+            # uncompressed.
+            if self.deflate and self.broadcast is None:
+                compressed = compress_frame(self._compressobj, binmsg)
+                self.compressed_bytes_sent += len(compressed)
+                metrics.count_frame(message_count, len(binmsg),
+                                    len(compressed), True)
+                result = self._write_frame(compressed, True)
+            else:
+                self.uncompressed_bytes_sent += len(binmsg)
+                metrics.count_frame(message_count, len(binmsg),
+                                    len(binmsg), False)
+                result = self._write_frame(binmsg, False)
+            if game_output and self.process is not None:
+                self.process.note_frame_sent()
+            return result
+        except:
+            self.logger.warning("Exception trying to send message.", exc_info = True)
+            if self.ws_connection is not None:
+                self.ws_connection._abort()
+        return None
+
+    def join_broadcast(self, stream):
+        self.broadcast = stream
+
+    def leave_broadcast(self):
+        self.broadcast = None
+        # The client has inflated the shared stream since our compressor
+        # last ran, so its history can't be referred back to any more.
+        self._compressobj = new_compressobj()
+
+    def write_broadcast_frame(self, binmsg, compressed, message_count):
+        # type: (bytes, bytes, int) -> Optional[tornado.concurrent.Future[None]]
+        """Sends a frame that was compressed once for a whole game."""
+        if self.client_closed or not self.accepts_game_output():
+            return None
+        # Keep ordering with anything we queued privately before this frame
+        self.flush_messages()
+
+        result = self._write_encoded(binmsg, compressed, message_count)
+        if self.process is not None:
+            self.process.note_frame_sent()
+        return result
+
+    def write_precompressed(self, binmsg, compressed, message_count):
+        # type: (bytes, bytes, int) -> Optional[tornado.concurrent.Future[None]]
+        """Sends a frame compressed on its own by a fresh compressor, e.g.
+        one that is cached and sent to many clients."""
+        if self.client_closed:
+            return None
+        self.flush_messages()
+
+        if self.broadcast is not None:
+            # The client's inflater belongs to the shared stream
+            compressed = None
+        result = self._write_encoded(binmsg, compressed, message_count)
+        if compressed is not None:
+            # Our own history doesn't match the client's any more
+            self._compressobj = new_compressobj()
+        return result
+
+    def _write_encoded(self, binmsg, compressed, message_count):
+        # type: (bytes, Optional[bytes], int) -> Optional[tornado.concurrent.Future[None]]
+        try:
+            self.total_message_bytes += len(binmsg)
+            if self.deflate and compressed is not None:
                 self.compressed_bytes_sent += len(compressed)
-                return self.write_message(compressed, binary=True)
+                metrics.count_frame(message_count, len(binmsg),
+                                    len(compressed), True)
+                return self._write_frame(compressed, True)
             else:
                 self.uncompressed_bytes_sent += len(binmsg)
-                return self.write_message(binmsg)
+                metrics.count_frame(message_count, len(binmsg),
+                                    len(binmsg), False)
+                return self._write_frame(binmsg, False)
         except:
             self.logger.warning("Exception trying to send message.", exc_info = True)
             if self.ws_connection is not None:
                 self.ws_connection._abort()
         return None
 
+    def _write_frame(self, data, binary):
+        # type: (bytes, bool) -> Optional[tornado.concurrent.Future[None]]
+        self.bytes_in_flight += len(data)
+        return self.write_message(data, binary=binary)
+
+    def outbound_backlog(self): # type: () -> int
+        """Bytes handed to tornado that haven't reached the socket yet."""
+        if self.client_closed:
+            self.bytes_in_flight = 0
+        else:
+            self.bytes_in_flight = write_buffer_size(self.ws_connection.stream)
+        self.backlog_checked = time.time()
+        return self.bytes_in_flight
+
+    def _estimated_backlog(self): # type: () -> int
+        # Measuring walks the whole write buffer on older tornados, so only
+        # do it every backlog_check_interval seconds
+        if time.time() - self.backlog_checked >= backlog_check_interval:
+            return self.outbound_backlog()
+        return self.bytes_in_flight
+
+    def accepts_game_output(self): # type: () -> bool
+        """Applies the slow consumer policy to a spectator.
+
+        Returns False if game output should not be sent to this socket right
+        now. Players and lobby sockets are never throttled."""
+        limit = getattr(config, "max_outbound_backlog", 4 * 1024 * 1024)
+        if not limit or self.watched_game is None:
+            return True
+
+        backlog = self._estimated_backlog()
+        if self.dropping_game_output:
+            if backlog > limit // 2:
+                return False
+            self.dropping_game_output = False
+            self.logger.info("Slow connection caught up, resyncing.")
+            self.watched_game.resync_watcher(self)
+            return True
+
+        if backlog <= limit:
+            return True
+        # The estimate counts everything sent since the last measurement as
+        # still queued; check before acting on it
+        backlog = self.outbound_backlog()
+        if backlog <= limit:
+            return True
+
+        if getattr(config, "slow_consumer_policy", "drop") == "disconnect":
+            self.logger.warning("Closing slow connection (%d bytes queued).",
+                                backlog)
+            self.ws_connection._abort()
+        else:
+            self.logger.info("Slow connection (%d bytes queued), dropping "
+                             "game output.", backlog)
+            self.dropping_game_output = True
+            self.watched_game.pause_watcher(self)
+        return False
+
     # n.b. this looks a lot like superclass write_message, but has a static
     # type signature that is not compatible with it, so we do not override
     # that function.
     def append_message(self,
-                       msg,      # type: str
-                       send=True # type: bool
+                       msg,              # type: str
+                       send=True,        # type: bool
+                       game_output=False # type: bool
                        ):
         # type: (...) -> Optional[tornado.concurrent.Future[None]]
         if self.client_closed:
             return None
         self.message_queue.append(msg)
+        if game_output:
+            self.game_output_queued = True
         if send:
-            return self.flush_messages()
+            window = getattr(config, "output_coalesce_window", 0)
+            if not window:
+                return self.flush_messages()
+            # Send everything that arrives within the window as one frame
+            if self.flush_timeout is None:
+                self.flush_timeout = IOLoop.current().add_timeout(
+                                        time.time() + window,
+                                        self.flush_messages)
         return None
 
     def send_message(self, msg, **data):
         # type: (str, Any) -> Optional[tornado.concurrent.Future[None]]
         """Sends a JSON message to the client."""
-        data["msg"] = msg
-        return self.append_message(json_encode(data), True)
+        return self.append_message(encode_message(msg, **data), True)
 
     def queue_message(self, msg, **data):
         # type: (str, Any) -> Optional[tornado.concurrent.Future[None]]
-        data["msg"] = msg
-        return self.append_message(json_encode(data), False)
+        return self.append_message(encode_message(msg, **data), False)
+
+    def close(self, *args, **kwargs):
+        # Don't lose messages that are still waiting for the coalescing
+        # window, e.g. the close reason
+        self.flush_messages()
+        super(CrawlWebSocket, self).close(*args, **kwargs)
 
     def on_close(self):
         if self.process is None and self in sockets:
-            sockets.remove(self)
+            remove_socket(self)
             if shutting_down and len(sockets) == 0:
                 # The last socket has been closed, now we can go
                 IOLoop.current().stop()
@@ -755,8 +1119,12 @@ class CrawlWebSocket(tornado.websocket.WebSocketHandler):
         if self.watched_game:
             self.watched_game.remove_watcher(self)
 
-        if self.timeout:
-            IOLoop.current().remove_timeout(self.timeout)
+        timer_wheel.cancel(self.timeout)
+        self.timeout = None
+
+        if self.flush_timeout is not None:
+            IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
 
         if self.total_message_bytes == 0:
             comp_ratio = "N/A"
@@ -0,0 +1,479 @@
+import collections
+import os
+import zlib
+
+import pytest
+import tornado.escape
+import tornado.websocket
+from tornado.escape import json_decode
+from tornado.escape import utf8
+from tornado.ioloop import IOLoop
+
+import config
+import ws_handler
+from broadcast import compress_frame
+from broadcast import new_compressobj
+
+
+class FakeStream(object):
+    def __init__(self):
+        self._write_buffer = collections.deque()
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.stream = FakeStream()
+        self.client_terminated = False
+        self.aborted = False
+        self.frames = []
+        # Like a client, inflate every frame with the same context
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def write_message(self, message, binary=False):
+        self.stream._write_buffer.append(message)
+        self.frames.append((message, binary))
+
+    def received(self):
+        """The messages of all frames sent so far, decoded."""
+        messages = []
+        for message, binary in self.frames:
+            if binary:
+                message = self.inflater.decompress(message +
+                                                   b"\x00\x00\xff\xff")
+            messages.extend(json_decode(message)["msgs"])
+        self.frames = []
+        return messages
+
+    def _abort(self):
+        self.aborted = True
+        self.client_terminated = True
+
+
+class FakeGame(object):
+    def __init__(self):
+        self.paused = []
+        self.resynced = []
+
+    def pause_watcher(self, socket):
+        self.paused.append(socket)
+
+    def resync_watcher(self, socket):
+        self.resynced.append(socket)
+
+
+def make_socket():
+    """A CrawlWebSocket without a tornado application or request."""
+    handler_init = tornado.websocket.WebSocketHandler.__init__
+    tornado.websocket.WebSocketHandler.__init__ = (
+        lambda self, *args, **kwargs: None)
+    try:
+        socket = ws_handler.CrawlWebSocket(None, None)
+    finally:
+        tornado.websocket.WebSocketHandler.__init__ = handler_init
+    socket.ws_connection = FakeConnection()
+    return socket
+
+
+class TestSlowConsumers:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        monkeypatch.setattr(config, "max_outbound_backlog", 100,
+                            raising=False)
+        monkeypatch.setattr(ws_handler, "backlog_check_interval", 0)
+        self.socket = make_socket()
+        self.game = FakeGame()
+        self.socket._watched_game = self.game
+        self.buffer = self.socket.ws_connection.stream._write_buffer
+
+    def test_backlog_is_the_stream_write_buffer(self):
+        assert self.socket.outbound_backlog() == 0
+        self.socket.ws_connection.write_message(b"x" * 30)
+        self.socket.ws_connection.write_message(b"y" * 12)
+        assert self.socket.outbound_backlog() == 42
+
+        self.buffer.popleft()
+        assert self.socket.outbound_backlog() == 12
+
+    def test_closed_stream_has_no_backlog(self):
+        self.socket.ws_connection.stream._write_buffer = None
+        assert self.socket.outbound_backlog() == 0
+
+    def test_drop_pauses_then_resyncs(self, monkeypatch):
+        monkeypatch.setattr(config, "slow_consumer_policy", "drop",
+                            raising=False)
+        self.buffer.append(b"x" * 101)
+        assert not self.socket.accepts_game_output()
+        assert self.socket.dropping_game_output
+        assert self.game.paused == [self.socket]
+
+        # Stays paused until the backlog is down to half the limit
+        self.buffer[0] = b"x" * 51
+        assert not self.socket.accepts_game_output()
+        assert self.game.resynced == []
+
+        self.buffer[0] = b"x" * 50
+        assert self.socket.accepts_game_output()
+        assert not self.socket.dropping_game_output
+        assert self.game.resynced == [self.socket]
+        assert not self.socket.ws_connection.aborted
+
+    def test_disconnect_aborts(self, monkeypatch):
+        monkeypatch.setattr(config, "slow_consumer_policy", "disconnect",
+                            raising=False)
+        self.buffer.append(b"x" * 100)
+        assert self.socket.accepts_game_output()
+
+        self.buffer.append(b"x")
+        assert not self.socket.accepts_game_output()
+        assert self.socket.ws_connection.aborted
+        assert self.game.paused == []
+
+    def test_buffer_is_measured_only_when_needed(self, monkeypatch):
+        monkeypatch.setattr(ws_handler, "backlog_check_interval", 60)
+        measured = []
+
+        def write_buffer_size(stream):
+            measured.append(stream)
+            return sum(len(chunk) for chunk in stream._write_buffer)
+        monkeypatch.setattr(ws_handler, "write_buffer_size", write_buffer_size)
+
+        assert self.socket.accepts_game_output()
+        assert len(measured) == 1
+        # Frames written since count as queued until the next measurement
+        for i in range(3):
+            self.socket._write_frame(b"x" * 30, True)
+            assert self.socket.accepts_game_output()
+        assert len(measured) == 1
+        assert self.socket.bytes_in_flight == 90
+
+        # Over the limit by the estimate, but most of it was sent already
+        self.buffer.clear()
+        self.socket._write_frame(b"x" * 30, True)
+        assert self.socket.accepts_game_output()
+        assert len(measured) == 2
+        assert self.socket.bytes_in_flight == 30
+        assert not self.socket.dropping_game_output
+
+    def test_players_are_not_throttled(self):
+        self.socket._watched_game = None
+        self.buffer.append(b"x" * 1000)
+        assert self.socket.accepts_game_output()
+
+
+class TestJsonOptions:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir, monkeypatch):
+        self.rcfile = str(tmpdir.join("player.rc"))
+        self.binary = str(tmpdir.join("crawl"))
+        for path in (self.rcfile, self.binary):
+            open(path, "w").close()
+            os.utime(path, (1000, 1000))
+        monkeypatch.setattr(config, "games",
+                            {"trunk": dict(crawl_binary=self.binary)})
+        monkeypatch.setattr(ws_handler, "json_options_cache", {})
+        monkeypatch.setattr(ws_handler, "json_options_pending", {})
+        self.calls = []
+        monkeypatch.setattr(ws_handler.checkoutput, "check_output",
+                            lambda call, callback:
+                                self.calls.append((call, callback)))
+        self.results = []
+
+    def get(self):
+        ws_handler.get_json_options("trunk", "player", self.rcfile,
+                                    lambda *result: self.results.append(result))
+
+    def finish(self, data='{"a":1}', returncode=0):
+        call, callback = self.calls[-1]
+        callback(data, returncode)
+
+    def test_cache_hit(self):
+        self.get()
+        assert self.calls[0][0] == [self.binary, "-name", "player",
+                                    "-rc", self.rcfile,
+                                    "-print-webtiles-options"]
+        self.finish()
+        self.get()
+
+        assert len(self.calls) == 1
+        assert self.results == [('{"a":1}', 0), ('{"a":1}', 0)]
+
+    @pytest.mark.parametrize("changed", ["rcfile", "binary"])
+    def test_invalidated_by_mtime(self, changed):
+        self.get()
+        self.finish()
+        os.utime(getattr(self, changed), (2000, 2000))
+        self.get()
+        assert len(self.calls) == 2
+        self.finish('{"a":2}')
+        self.get()
+
+        assert len(self.calls) == 2
+        assert self.results[1:] == [('{"a":2}', 0), ('{"a":2}', 0)]
+
+    def test_failures_are_not_cached(self):
+        self.get()
+        self.finish("", -11)
+        self.get()
+        assert len(self.calls) == 2
+
+    def test_concurrent_requests_share_one_subprocess(self):
+        self.get()
+        self.get()
+        assert len(self.calls) == 1
+        assert self.results == []
+
+        self.finish()
+        assert self.results == [('{"a":1}', 0), ('{"a":1}', 0)]
+        assert ws_handler.json_options_pending == {}
+
+    def test_failing_callback_doesnt_stop_the_others(self):
+        def fail(data, returncode):
+            raise ValueError("socket gone")
+        ws_handler.get_json_options("trunk", "player", self.rcfile, fail)
+        self.get()
+
+        self.finish()
+        assert self.results == [('{"a":1}', 0)]
+        assert ws_handler.json_options_pending == {}
+
+
+@pytest.fixture
+def registered():
+    """Sockets made with this are added to the socket indexes, and removed
+    from them again after the test."""
+    made = []
+
+    def make():
+        socket = make_socket()
+        ws_handler.add_socket(socket)
+        made.append(socket)
+        return socket
+    yield make
+    for socket in made:
+        if socket in ws_handler.sockets:
+            ws_handler.remove_socket(socket)
+
+
+class TestSocketIndexes:
+
+    def check_consistent(self):
+        by_state = dict((state, set()) for state in ws_handler.sockets_by_state)
+        by_user = {}
+        for socket in ws_handler.sockets:
+            by_state[socket.state()].add(socket)
+            if socket.username:
+                by_user.setdefault(socket.username.lower(), set()).add(socket)
+        assert by_state == ws_handler.sockets_by_state
+        assert by_user == ws_handler.sockets_by_user
+
+    def test_indexes_follow_state_and_user(self, registered):
+        socket = registered()
+        other = registered()
+        assert socket in ws_handler.lobby_sockets
+        self.check_consistent()
+
+        socket.username = "Bob"
+        other.username = "bob"
+        assert (set(ws_handler.find_user_sockets("BOB")) ==
+                set([socket, other]))
+        self.check_consistent()
+
+        socket.watched_game = FakeGame()
+        assert socket in ws_handler.sockets_by_state["watching"]
+        self.check_consistent()
+
+        socket.watched_game = None
+        socket.process = object()
+        assert socket in ws_handler.sockets_by_state["playing"]
+        self.check_consistent()
+
+        socket.username = "Alice"
+        assert ws_handler.sockets_by_user["bob"] == set([other])
+        self.check_consistent()
+
+        ws_handler.remove_socket(other)
+        assert "bob" not in ws_handler.sockets_by_user
+        assert other.index_key == (None, None)
+        self.check_consistent()
+
+    def test_unregistered_sockets_arent_indexed(self, registered):
+        socket = make_socket()
+        socket.username = "carol"
+        socket.watched_game = FakeGame()
+        assert "carol" not in ws_handler.sockets_by_user
+        assert socket not in ws_handler.sockets_by_state["watching"]
+        self.check_consistent()
+
+
+class FakeLobbyGame(object):
+    def __init__(self, game_id):
+        self.id = game_id
+        self.idle_time = 0
+
+    def lobby_entry(self):
+        return dict(id=self.id, idle_time=self.idle_time)
+
+
+class TestLobbyUpdates:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, registered, monkeypatch):
+        monkeypatch.setattr(config, "output_coalesce_window", 0,
+                            raising=False)
+        self.lobby = [registered(), registered()]
+        self.watcher = registered()
+        self.watcher.watched_game = FakeGame()
+        yield
+        if ws_handler.lobby_flush_timeout is not None:
+            IOLoop.current().remove_timeout(ws_handler.lobby_flush_timeout)
+            ws_handler.lobby_flush_timeout = None
+        ws_handler.lobby_updates.clear()
+        ws_handler.lobby_removals.clear()
+
+    def test_updates_are_batched(self, monkeypatch):
+        monkeypatch.setattr(config, "lobby_update_rate", 1, raising=False)
+        game = FakeLobbyGame(1)
+        ws_handler.update_all_lobbys(game)
+        game.idle_time = 5
+        ws_handler.update_all_lobbys(game)
+        ws_handler.update_all_lobbys(FakeLobbyGame(2))
+        ws_handler.remove_in_lobbys(FakeLobbyGame(2))
+        ws_handler.remove_in_lobbys(FakeLobbyGame(3))
+        assert ws_handler.lobby_flush_timeout is not None
+        assert self.lobby[0].ws_connection.frames == []
+
+        timeout = ws_handler.lobby_flush_timeout
+        IOLoop.current().remove_timeout(timeout)
+        ws_handler.flush_lobby_updates()
+
+        for socket in self.lobby:
+            messages = socket.ws_connection.received()
+            assert messages[0] == {"msg": "lobby_entry", "id": 1,
+                                   "idle_time": 5}
+            assert (sorted(m["id"] for m in messages[1:]) == [2, 3] and
+                    all(m["msg"] == "lobby_remove" for m in messages[1:]))
+        assert self.watcher.ws_connection.frames == []
+
+        # Nothing new, nothing sent
+        ws_handler.flush_lobby_updates()
+        assert self.lobby[0].ws_connection.frames == []
+
+    def test_sent_immediately_without_rate(self, monkeypatch):
+        monkeypatch.setattr(config, "lobby_update_rate", 0, raising=False)
+        ws_handler.update_all_lobbys(FakeLobbyGame(1))
+        assert ws_handler.lobby_flush_timeout is None
+        assert self.lobby[1].ws_connection.received() == [
+            {"msg": "lobby_entry", "id": 1, "idle_time": 0}]
+
+
+def precompressed(msg):
+    binmsg = utf8('{"msgs":[' + msg + ']}')
+    return binmsg, compress_frame(new_compressobj(), binmsg)
+
+
+class TestPrecompressed:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        monkeypatch.setattr(config, "output_coalesce_window", 0,
+                            raising=False)
+        self.socket = make_socket()
+        self.conn = self.socket.ws_connection
+
+    def test_client_inflater_stays_in_sync(self):
+        self.socket.send_message("before", n=1)
+        self.socket.queue_message("queued")
+        binmsg, compressed = precompressed('{"msg":"game_client"}')
+        self.socket.write_precompressed(binmsg, compressed, 1)
+        assert self.conn.frames[-1] == (compressed, True)
+        self.socket.send_message("after", n=2)
+
+        assert self.conn.received() == [{"msg": "before", "n": 1},
+                                        {"msg": "queued"},
+                                        {"msg": "game_client"},
+                                        {"msg": "after", "n": 2}]
+
+    def test_sent_uncompressed_during_broadcast(self):
+        self.socket.broadcast = object()
+        binmsg, compressed = precompressed('{"msg":"game_client"}')
+        self.socket.write_precompressed(binmsg, compressed, 1)
+        assert self.conn.frames == [(binmsg, False)]
+
+    def test_sent_uncompressed_without_deflate(self):
+        self.socket.deflate = False
+        binmsg, compressed = precompressed('{"msg":"game_client"}')
+        self.socket.write_precompressed(binmsg, compressed, 1)
+        assert self.conn.frames == [(binmsg, False)]
+
+    def test_nothing_sent_when_closed(self):
+        self.conn.client_terminated = True
+        binmsg, compressed = precompressed('{"msg":"game_client"}')
+        assert self.socket.write_precompressed(binmsg, compressed, 1) is None
+        assert self.conn.frames == []
+
+
+class TestBroadcastMessage:
+
+    def test_encoded_once_for_all_receivers(self, monkeypatch):
+        monkeypatch.setattr(config, "output_coalesce_window", 0,
+                            raising=False)
+        encoded = []
+
+        def json_encode(data):
+            encoded.append(data)
+            return tornado.escape.json_encode(data)
+        monkeypatch.setattr(ws_handler, "json_encode", json_encode)
+        receivers = [make_socket() for i in range(3)]
+        receivers[2].ws_connection.client_terminated = True
+
+        ws_handler.broadcast_message(receivers, "chat", content="hi")
+
+        assert len(encoded) == 1
+        for socket in receivers[:2]:
+            assert socket.ws_connection.received() == [
+                {"msg": "chat", "content": "hi"}]
+        assert receivers[2].ws_connection.frames == []
+
+
+class TestLogin:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        monkeypatch.setattr(config, "output_coalesce_window", 0,
+                            raising=False)
+        self.lookups = []
+        monkeypatch.setattr(ws_handler.userdb, "get_user_info_async",
+                            lambda username, callback:
+                                self.lookups.append((username, callback)))
+        self.socket = make_socket()
+        self.socket.deflate = False
+        self.socket.init_user = lambda callback: callback(0)
+        self.socket.send_game_links = lambda: None
+
+    def test_user_info_is_loaded_off_the_ioloop(self):
+        self.socket.do_login("Bob")
+        assert self.socket.username is None
+        assert self.socket.ws_connection.frames == []
+
+        username, callback = self.lookups[0]
+        assert username == "Bob"
+        callback((5, "bob@example.com", 0))
+        assert self.socket.username == "Bob"
+        assert self.socket.user_id == 5
+        self.socket.flush_messages()
+        assert self.socket.ws_connection.received() == [
+            {"msg": "login_success", "username": "Bob", "admin": False}]
+
+    def test_failed_lookup_fails_the_login(self):
+        self.socket.do_login("Bob")
+        self.lookups[0][1](None)
+        assert self.socket.username is None
+        assert self.socket.ws_connection.received() == [{"msg": "login_fail"}]
+
+    def test_closed_socket_is_left_alone(self):
+        self.socket.do_login("Bob")
+        self.socket.ws_connection.client_terminated = True
+        self.lookups[0][1]((5, "bob@example.com", 0))
+        assert self.socket.username is None